@@ -28,4 +28,22 @@ COMMON_APPLY_OPTIONS = [
         type=int,
         help="The maximum number of seconds to wait before a timeout error is thrown",
     ),
+    click.option(
+        "-p",
+        "--parallel",
+        type=click.IntRange(min=1),
+        default=1,
+        show_default=True,
+        help="The number of particles to apply concurrently",
+    ),
+    click.option(
+        "--no-cache",
+        is_flag=True,
+        help="Parse the config file again instead of using the cached parsed config",
+    ),
+    click.option(
+        "--metrics-file",
+        type=click.Path(dir_okay=False),
+        help="Write metrics in the Prometheus text format to this file when done",
+    ),
 ]
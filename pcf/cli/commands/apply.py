@@ -17,7 +17,7 @@ from pcf.cli.commands import COMMON_APPLY_OPTIONS
 @click_options(COMMON_APPLY_OPTIONS)
 @click.argument("pcf_name", required=False)
 @click.pass_context
-def apply(ctx, pcf_name, cascade, quiet, file_, timeout, state):
+def apply(ctx, pcf_name, cascade, quiet, file_, timeout, parallel, no_cache, metrics_file, state):
     """ Set a desired state and apply
 
         PCF_NAME : The deployment name to apply changes to as specified in your
@@ -30,5 +30,13 @@ def apply(ctx, pcf_name, cascade, quiet, file_, timeout, state):
     """
 
     execute_applying_command(
-        pcf_name, file_, state, cascade=cascade, quiet=quiet, timeout=timeout
+        pcf_name,
+        file_,
+        state,
+        cascade=cascade,
+        quiet=quiet,
+        timeout=timeout,
+        use_cache=not no_cache,
+        parallel=parallel,
+        metrics_file=metrics_file,
     )
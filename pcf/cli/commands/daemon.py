@@ -0,0 +1,90 @@
+""" Logic for pcf daemon command """
+
+import click
+from pcf.cli.utils import color, particles_from_file
+from pcf.core.reconciler import Reconciler
+
+
+@click.command(name="daemon", short_help="Keep particles at their desired state")
+@click.option(
+    "-f",
+    "--file",
+    "file_",
+    type=click.Path(dir_okay=False, resolve_path=True),
+    default="pcf.json",
+    show_default=True,
+    help="The JSON or YAML file defining your infrastructure configuration",
+)
+@click.option(
+    "-s",
+    "--state",
+    type=click.Choice(["running", "stopped", "terminated"], case_sensitive=False),
+    default="running",
+    show_default=True,
+    help="The desired state of particles that do not set desired_state in their definition",
+)
+@click.option(
+    "-i",
+    "--interval",
+    type=click.FloatRange(min=1),
+    default=60,
+    show_default=True,
+    help="Seconds between reconciles of particles that do not set reconcile_interval",
+)
+@click.option(
+    "-j",
+    "--jitter",
+    type=click.FloatRange(min=0, max=1),
+    default=0.1,
+    show_default=True,
+    help="Fraction of the interval reconciles are randomly moved by",
+)
+@click.option(
+    "-p",
+    "--parallel",
+    type=click.IntRange(min=1),
+    default=10,
+    show_default=True,
+    help="The number of particles reconciled concurrently",
+)
+@click.option(
+    "-t",
+    "--timeout",
+    type=int,
+    help="The maximum number of seconds a single reconcile may take",
+)
+@click.option("--host", default="127.0.0.1", show_default=True, help="Address the http api listens on")
+@click.option("--port", type=int, default=8089, show_default=True, help="Port the http api listens on")
+@click.option("--socket", "socket_path", type=click.Path(dir_okay=False), help="Serve the api on a unix socket")
+@click.option("--no-api", is_flag=True, help="Do not serve the http api")
+@click.argument("pcf_name", required=False)
+@click.pass_context
+def daemon(ctx, pcf_name, file_, state, interval, jitter, parallel, timeout, host, port, socket_path, no_api):
+    """ Keep particles at their desired state until interrupted
+
+        PCF_NAME : The deployment name to reconcile as specified in your PCF config
+        file, e.g.
+
+            pcf daemon my_ec2_instance
+
+        If no PCF_NAME is specified, this command will reconcile all Particles and
+        Quasiparticles in your PCF config file. The config file is loaded once and the
+        desired state of each particle can be changed through the http api, e.g.
+
+            curl -X PUT -d '{"desired_state": "stopped"}' localhost:8089/particles/my_ec2_instance
+    """
+
+    particles = particles_from_file(pcf_name, file_, quiet=True)
+    for particle in particles:
+        particle.set_desired_state(particle.particle_definition.get("desired_state", state))
+
+    reconciler = Reconciler(
+        particles, interval=interval, jitter=jitter, max_workers=parallel, max_timeout=timeout
+    )
+
+    if not no_api:
+        server = reconciler.serve(host=host, port=port, socket_path=socket_path)
+        click.secho("Serving the reconciler api on {}".format(server.server_address), fg=color("blue"))
+
+    click.secho("Reconciling {} particles, press Ctrl+C to stop".format(len(particles)), fg=color("blue"))
+    reconciler.run_forever()
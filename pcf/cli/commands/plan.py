@@ -0,0 +1,114 @@
+""" Logic for pcf plan command """
+
+import json
+import click
+from pcf.cli.utils import color, particles_from_file, click_options
+from pcf.core import State
+from pcf.core.pcf import PCF
+
+PLAN_OPTIONS = [
+    click.option(
+        "-f",
+        "--file",
+        "file_",
+        type=click.Path(dir_okay=False, resolve_path=True),
+        default="pcf.json",
+        show_default=True,
+        help="The JSON or YAML file defining your infrastructure configuration",
+    ),
+    click.option(
+        "-p",
+        "--parallel",
+        type=click.IntRange(min=1),
+        default=10,
+        show_default=True,
+        help="The number of particles to sync concurrently",
+    ),
+    click.option(
+        "-r",
+        "--rate-limit",
+        type=click.FloatRange(min=0),
+        default=0,
+        help="The maximum number of syncs per second for each flavor (0 for no limit)",
+    ),
+    click.option(
+        "--json", "json_", is_flag=True, help="Print the plan as JSON"
+    ),
+    click.option(
+        "--no-cache",
+        is_flag=True,
+        help="Parse the config file again instead of using the cached parsed config",
+    ),
+]
+
+ACTION_COLORS = {"start": "green", "update": "yellow", "stop": "yellow", "terminate": "red"}
+
+
+@click.command(name="plan", short_help="Show what apply would change")
+@click.option(
+    "-s",
+    "--state",
+    type=click.Choice(["running", "stopped", "terminated"], case_sensitive=False),
+    default="running",
+    show_default=True,
+    help="The desired state to plan for",
+)
+@click_options(PLAN_OPTIONS)
+@click.argument("pcf_name", required=False)
+@click.pass_context
+def plan(ctx, pcf_name, file_, parallel, rate_limit, json_, no_cache, state):
+    """ Show what apply would change without changing anything
+
+        PCF_NAME : The deployment name to plan as specified in your PCF config
+        file, e.g.
+
+            pcf plan my_ec2_instance
+
+        If no PCF_NAME is specified, this command will sync and plan all Particles
+        and Quasiparticles in your PCF config file.
+    """
+
+    particles = particles_from_file(pcf_name, file_, quiet=True, use_cache=not no_cache)
+
+    pcf_field = PCF([])
+    for particle in particles:
+        particle.set_desired_state(getattr(State, state))
+        pcf_field.add_particle(particle)
+
+    particle_plans = pcf_field.plan(max_workers=parallel, rate_limit=rate_limit)
+
+    if json_:
+        click.echo(json.dumps(particle_plans, indent=2, default=str))
+    else:
+        print_plan(particle_plans)
+
+
+def print_plan(particle_plans, indent=""):
+    """ Prints each particle plan with its action and definition diff """
+    for particle_plan in particle_plans:
+        if particle_plan.get("error"):
+            click.secho(
+                "{0}{1}: error ({2})".format(indent, particle_plan["pcf_id"], particle_plan["error"]),
+                fg=color("red"),
+            )
+        elif particle_plan.get("action"):
+            click.secho(
+                "{0}{1}: {2} ({3} -> {4})".format(
+                    indent,
+                    particle_plan["pcf_id"],
+                    particle_plan["action"],
+                    particle_plan["current_state"],
+                    particle_plan["desired_state"],
+                ),
+                fg=color(ACTION_COLORS.get(particle_plan["action"])),
+            )
+            if particle_plan["diff"]:
+                for line in json.dumps(particle_plan["diff"], indent=2, default=str).splitlines():
+                    click.echo("{0}    {1}".format(indent, line))
+        else:
+            click.echo(
+                "{0}{1}: no changes ({2})".format(indent, particle_plan["pcf_id"], particle_plan["current_state"])
+            )
+
+        if particle_plan.get("particles"):
+            print_plan(particle_plan["particles"], indent=indent + "  ")
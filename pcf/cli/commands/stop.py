@@ -10,7 +10,7 @@ from pcf.cli.commands import COMMON_APPLY_OPTIONS
 @click_options(COMMON_APPLY_OPTIONS)
 @click.argument("pcf_name", required=False)
 @click.pass_context
-def stop(ctx, pcf_name, cascade, quiet, file_, timeout):
+def stop(ctx, pcf_name, cascade, quiet, file_, timeout, parallel, no_cache, metrics_file):
     """ Set desired state to 'stopped' and apply
 
         PCF_NAME : The deployment name to apply changes to as specified in your
@@ -23,5 +23,13 @@ def stop(ctx, pcf_name, cascade, quiet, file_, timeout):
     """
 
     execute_applying_command(
-        pcf_name, file_, "stopped", cascade=cascade, quiet=quiet, timeout=timeout
+        pcf_name,
+        file_,
+        "stopped",
+        cascade=cascade,
+        quiet=quiet,
+        timeout=timeout,
+        use_cache=not no_cache,
+        parallel=parallel,
+        metrics_file=metrics_file,
     )
@@ -12,7 +12,7 @@ from pcf.cli.commands import COMMON_APPLY_OPTIONS
 @click_options(COMMON_APPLY_OPTIONS)
 @click.argument("pcf_name", required=False)
 @click.pass_context
-def terminate(ctx, pcf_name, cascade, quiet, file_, timeout):
+def terminate(ctx, pcf_name, cascade, quiet, file_, timeout, parallel, no_cache, metrics_file):
     """ Set desired state to 'terminated' and apply
 
         PCF_NAME : The deployment name to apply changes to as specified in your
@@ -25,5 +25,13 @@ def terminate(ctx, pcf_name, cascade, quiet, file_, timeout):
     """
 
     execute_applying_command(
-        pcf_name, file_, "terminated", cascade=cascade, quiet=quiet, timeout=timeout
+        pcf_name,
+        file_,
+        "terminated",
+        cascade=cascade,
+        quiet=quiet,
+        timeout=timeout,
+        use_cache=not no_cache,
+        parallel=parallel,
+        metrics_file=metrics_file,
     )
@@ -4,6 +4,7 @@ import os
 import sys
 import json
 import click
+import time
 import yaml
 import inspect
 import pkgutil
@@ -12,6 +13,11 @@ from math import ceil
 from Levenshtein import distance
 from pcf.core import State
 from pcf.core import pcf_exceptions
+from pcf.core import scheduler
+from pcf.core.pcf import PCF, link_batches
+from pcf.core.scheduler import ParticleScheduler
+from pcf.util import config_loader, metrics
+from pcf.util.aws import aws_lookup
 from pcf.util.pcf_util import particle_class_from_flavor
 
 
@@ -64,9 +70,9 @@ def did_you_mean(suggestions=[], fg=None, exit_after=True, exit_code=1):
         sys.exit(exit_code)
 
 
-def load_pcf_config_from_file(filename):
-    """ Attempts to load and return the config dict as specified in the given file with
-        the following default config file precedence:
+def find_pcf_config_file(filename):
+    """ Returns the PCF config file to use for the given filename with the following
+        default config file precedence:
         1. pcf.json
         2. pcf.yml
         3. pcf.yaml
@@ -85,7 +91,7 @@ def load_pcf_config_from_file(filename):
     if basename == "pcf.json":
         for default_config_file in ("pcf.json", "pcf.yml", "pcf.yaml"):
             if os.path.isfile(default_config_file):
-                return read_config_file(default_config_file)
+                return default_config_file
         fail(
             (
                 "Error: could not find a PCF config file.\n\n"
@@ -96,7 +102,7 @@ def load_pcf_config_from_file(filename):
         )
 
     if os.path.isfile(filename):
-        return read_config_file(filename)
+        return filename
     else:
         fail(
             (
@@ -108,18 +114,24 @@ def load_pcf_config_from_file(filename):
         )
 
 
+def load_pcf_config_from_file(filename):
+    """ Attempts to load and return the config dict as specified in the given file with
+        the default config file precedence of find_pcf_config_file()
+    """
+    return read_config_file(find_pcf_config_file(filename))
+
+
 def read_config_file(filename):
     """ Loads the JSON/YAML filename and returns it as a dict.
     """
     file_ext = os.path.splitext(filename)[1]
-    basename = os.path.basename(filename)
 
     with open(filename, "r") as config_file:
         try:
             if file_ext == ".json":
                 pcf_config = json.load(config_file)
             else:
-                pcf_config = yaml.safe_load(config_file.read())
+                pcf_config = config_loader.load_yaml(config_file)
 
             if isinstance(pcf_config, dict):
                 pcf_config = [pcf_config]
@@ -143,108 +155,267 @@ def particle_class_instance(flavor, particle_config):
         return particle_class(particle_config)
 
 
-def particles_from_file(pcf_name, filename, quiet=False):
+def particles_from_file(pcf_name, filename, quiet=False, use_cache=True):
     """ Return a list of Particles from a PCF config file, returning only one Particle
-        if pcf_name is not None
+        if pcf_name is not None. Config entries are read incrementally and only the
+        particles that are returned (and their parents) are instantiated. Parsed configs
+        are cached by file content unless use_cache is False. Particles loaded together
+        are linked to share batched api calls, see Particle.link_batch.
     """
-    pcf_config, used_config_filename = load_pcf_config_from_file(filename)
+    used_config_filename = find_pcf_config_file(filename)
+
+    if pcf_name:
+        return [particle_from_file(pcf_name, used_config_filename, quiet=quiet, use_cache=use_cache)]
 
-    user_pcf_names = []
     particles_to_return = []
-    for particle in pcf_config:
-        if not isinstance(particle, dict):
-            continue
-
-        name = particle.get("pcf_name")
-        flavor = particle.get("flavor")
-        user_pcf_names.append(name)
-
-        if flavor is None:
-            fail("Error: No flavor specified in {} configuration".format(name))
-
-        if pcf_name:
-            if name.strip() == pcf_name.strip():
-                if not quiet:
-                    click.secho(
-                        "Loading Particle/Quasiparticle flavor {0} for {1}...".format(
-                            flavor, pcf_name
-                        ),
-                        fg=color("blue"),
-                    )
-                return [particle_class_instance(flavor, particle)]
+    try:
+        if use_cache:
+            entries = config_loader.load_config_entries(used_config_filename)
         else:
+            entries = config_loader.iter_config_entries(used_config_filename)
+
+        for particle in entries:
+            if not isinstance(particle, dict):
+                continue
+
+            name = particle.get("pcf_name")
+            flavor = particle.get("flavor")
+
+            if flavor is None:
+                fail("Error: No flavor specified in {} configuration".format(name))
+
             particles_to_return.append(particle_class_instance(flavor, particle))
 
-    if pcf_name:
+    except (ValueError, yaml.YAMLError) as error:
+        fail("Error reading PCF config file {0}:\n\n{1}".format(used_config_filename, error))
+
+    # particles of a file share batched api calls, ie one run_instances call for matching instances
+    link_batches(particles_to_return)
+    return particles_to_return
+
+
+def particle_from_file(pcf_name, filename, quiet=False, use_cache=True):
+    """ Return the Particle named pcf_name from a PCF config file. Only the particle and
+        the particles it depends on are loaded and instantiated, and the particle is
+        linked to those parents.
+    """
+    try:
+        index = config_loader.load_config_index(filename, use_cache=use_cache)
+    except (ValueError, yaml.YAMLError) as error:
+        fail("Error reading PCF config file {0}:\n\n{1}".format(filename, error))
+
+    name = pcf_name.strip()
+    if name not in index:
+        name = next((n for n in index if isinstance(n, str) and n.strip() == name), None)
+
+    if name is None:
         click.secho(
             "Error: could not find Particle or Quasiparticle '{0}' in {1}".format(
-                pcf_name, os.path.basename(used_config_filename)
+                pcf_name, os.path.basename(filename)
             ),
             fg=color("red"),
         )
 
-        similar_names = similar_strings(pcf_name, user_pcf_names)
+        similar_names = similar_strings(pcf_name, [n for n in index if isinstance(n, str)])
         if similar_names:
             did_you_mean(similar_names)
         else:
             sys.exit(1)
-    else:
-        return particles_to_return
+
+    flavor = index[name].flavor
+    if flavor is None:
+        fail("Error: No flavor specified in {} configuration".format(name))
+
+    if not quiet:
+        click.secho(
+            "Loading Particle/Quasiparticle flavor {0} for {1}...".format(
+                flavor, pcf_name
+            ),
+            fg=color("blue"),
+        )
+
+    pcf_field = PCF([])
+    for closure_name in config_loader.dependency_closure(index, name):
+        config_entry = index[closure_name]
+        definition = config_loader.load_index_entry(filename, config_entry)
+        if config_entry.flavor is None:
+            fail("Error: No flavor specified in {} configuration".format(closure_name))
+        pcf_field.add_particle(particle_class_instance(config_entry.flavor, definition))
+
+    link_loaded_relatives(pcf_field)
+    pcf_field.link_batches()
+    return pcf_field.get_particle(flavor, name)
+
+
+def link_loaded_relatives(pcf_field):
+    """ Links the particles in pcf_field to the parents and children that were loaded
+        into the same field. Relatives that were not loaded are ignored.
+    """
+    for particles in pcf_field.get_particles().values():
+        for particle in particles.values():
+            for parent_pcf_id in particle.particle_definition.get("parents", []):
+                if pcf_field.get_particle_from_pcf_id(parent_pcf_id):
+                    particle.link_to_parent(pcf_field, parent_pcf_id)
+
+            for child_pcf_id in particle.particle_definition.get("children", []):
+                if pcf_field.get_particle_from_pcf_id(child_pcf_id):
+                    particle.link_to_child(pcf_field, child_pcf_id)
 
 
 def execute_applying_command(
-    pcf_name, config_file, desired_state, cascade=False, quiet=False, timeout=None
+    pcf_name,
+    config_file,
+    desired_state,
+    cascade=False,
+    quiet=False,
+    timeout=None,
+    use_cache=True,
+    parallel=None,
+    metrics_file=None,
 ):
     """ Executes the apply command for the desired particle(s) and state as specified in
         the config_file. Used for apply, run, stop, and terminate commands. Contains
-        CLI output for info.
+        CLI output for info. Metrics are written to metrics_file when it is set, also
+        when applying fails.
     """
-    particles = particles_from_file(pcf_name, config_file, quiet=quiet)
-    num_particles = len(particles)
+    try:
+        particles = particles_from_file(pcf_name, config_file, quiet=quiet, use_cache=use_cache)
+        num_particles = len(particles)
 
-    if num_particles == 0:
-        click.secho("No particle or quaisparticle definitions found.")
+        if num_particles == 0:
+            click.secho("No particle or quaisparticle definitions found.")
 
-    elif num_particles > 1:
-        with click.progressbar(
-            particles,
-            label="Applying changes to {} particles".format(num_particles),
-            length=num_particles,
-        ) as particle_progress:
+        elif num_particles > 1 and parallel and parallel > 1:
+            execute_parallel_apply(
+                particles, desired_state, parallel, cascade=cascade, quiet=quiet, timeout=timeout
+            )
 
-            for particle in particle_progress:
-                pcf_name = particle.name
+        elif num_particles > 1:
+            # desired states are set upfront so batches see every particle that changes, see Particle.link_batch
+            for particle in particles:
                 particle.set_desired_state(getattr(State, desired_state))
 
-                try:
-                    particle.apply(cascade=cascade, max_timeout=timeout)
-                except pcf_exceptions.MaxTimeoutException:
-                    fail("Error: Max timeout of {0} seconds reached".format(timeout))
+            with click.progressbar(
+                particles,
+                label="Applying changes to {} particles".format(num_particles),
+                length=num_particles,
+            ) as particle_progress:
 
-    else:
-        particle = particles[0]
-        pcf_name = particle.name
-
-        if not quiet:
-            click.secho(
-                "Setting desired state of {0} to {1}...".format(
-                    pcf_name, desired_state
-                ),
-                fg=color("blue"),
-            )
+                for particle in particle_progress:
+                    pcf_name = particle.name
 
-        particle.set_desired_state(getattr(State, desired_state))
+                    try:
+                        particle.apply(cascade=cascade, max_timeout=timeout)
+                    except pcf_exceptions.MaxTimeoutException:
+                        fail("Error: Max timeout of {0} seconds reached".format(timeout))
 
-        if not quiet:
-            click.secho("Applying changes to {0}...".format(pcf_name), fg=color("blue"))
+        else:
+            particle = particles[0]
+            pcf_name = particle.name
+
+            if not quiet:
+                click.secho(
+                    "Setting desired state of {0} to {1}...".format(
+                        pcf_name, desired_state
+                    ),
+                    fg=color("blue"),
+                )
+
+            particle.set_desired_state(getattr(State, desired_state))
+
+            if not quiet:
+                click.secho("Applying changes to {0}...".format(pcf_name), fg=color("blue"))
+
+            try:
+                particle.apply(cascade=cascade, max_timeout=timeout)
+            except pcf_exceptions.MaxTimeoutException:
+                fail("Error: Max timeout of {0} seconds reached".format(timeout))
+
+            if not quiet:
+                click.secho(
+                    "Successfully applied changes to {0}".format(pcf_name),
+                    fg=color("green"),
+                )
+    finally:
+        if metrics_file:
+            metrics.REGISTRY.write_to_file(metrics_file)
+
+
+EVENT_COLORS = {
+    scheduler.SUCCEEDED: "green",
+    scheduler.FAILED: "red",
+    scheduler.TIMED_OUT: "red",
+    scheduler.SKIPPED: "yellow",
+}
+
+
+def execute_parallel_apply(
+    particles, desired_state, parallel, cascade=False, quiet=False, timeout=None
+):
+    """ Applies the desired state to particles on a pool of parallel workers. Parents are
+        applied before their children, or after them when stopping or terminating. State
+        changes are printed as they happen, followed by a timing table. timeout is a
+        deadline for the whole run.
+    """
+    state = getattr(State, desired_state)
+    deadline = time.time() + timeout if timeout else None
+    aws_lookup.prefetch_lookups(particles)
+    # desired states are set upfront so batches see every particle that changes, see Particle.link_batch
+    for particle in particles:
+        particle.set_desired_state(state)
+    particle_scheduler = ParticleScheduler(
+        particles, max_workers=parallel, reverse=state != State.running
+    )
+    start_time = time.time()
+
+    if not quiet:
+        click.secho(
+            "Applying changes to {0} particles with {1} workers...".format(
+                len(particles), parallel
+            ),
+            fg=color("blue"),
+        )
 
-        try:
-            particle.apply(cascade=cascade, max_timeout=timeout)
-        except pcf_exceptions.MaxTimeoutException:
-            fail("Error: Max timeout of {0} seconds reached".format(timeout))
-
-        if not quiet:
-            click.secho(
-                "Successfully applied changes to {0}".format(pcf_name),
-                fg=color("green"),
+    def apply_particle(particle, remaining_timeout):
+        return particle.apply(cascade=cascade, max_timeout=remaining_timeout)
+
+    def print_event(event, result):
+        if quiet and event not in (scheduler.FAILED, scheduler.TIMED_OUT):
+            return
+
+        message = "[{0:7.1f}s] {1}: ".format(time.time() - start_time, result.pcf_id)
+        if event == scheduler.STARTED:
+            message += "applying {}".format(desired_state)
+        elif event == scheduler.STATE_CHANGED:
+            message += "state is {}".format(getattr(result.state, "name", result.state))
+        else:
+            message += event.replace("_", " ")
+            if result.error:
+                message += " ({})".format(result.error)
+
+        click.secho(message, fg=color(EVENT_COLORS.get(event)))
+
+    results = particle_scheduler.run(apply_particle, deadline=deadline, on_event=print_event)
+
+    if not quiet:
+        print_timing_table(results.values())
+
+    failed = [r for r in results.values() if r.status != scheduler.SUCCEEDED]
+    if any(r.status == scheduler.TIMED_OUT for r in failed):
+        fail("Error: Max timeout of {0} seconds reached".format(timeout))
+    elif failed:
+        fail("Error: failed to apply changes to {} particles".format(len(failed)))
+
+
+def print_timing_table(results):
+    """ Prints the status and duration of each particle result, slowest first """
+    results = sorted(results, key=lambda r: r.duration or 0, reverse=True)
+    width = max([len("PARTICLE")] + [len(r.pcf_id) for r in results])
+    click.echo("\n{0:<{width}}  {1:<10}  {2:>9}".format("PARTICLE", "STATUS", "DURATION", width=width))
+    for result in results:
+        duration = "-" if result.duration is None else "{:.1f}s".format(result.duration)
+        click.echo(
+            "{0:<{width}}  {1:<10}  {2:>9}".format(
+                result.pcf_id, result.status, duration, width=width
             )
+        )
@@ -14,8 +14,9 @@
 
 import boto3
 from pcf.core.particle import Particle
-from pcf.util import pcf_util
+from pcf.util import metrics, pcf_util
 from pcf.util.aws.aws_lookup import AWSLookup
+from pcf.util.aws.session_manager import SessionManager
 
 
 class AWSResource(Particle):
@@ -23,6 +24,10 @@ class AWSResource(Particle):
     and the arn (if known)
     """
     lookup = AWSLookup
+    # optional ClientPool shared by particles, ie by a long running Reconciler
+    client_pool = None
+    # assumes the role of particles with an account or role_arn in their definition
+    session_manager = SessionManager()
 
     def __init__(self, particle_definition, resource_name, arn=None, session=None):
         super(AWSResource, self).__init__(particle_definition)
@@ -35,11 +40,21 @@ class AWSResource(Particle):
         self._resource = None
         self._session = session
 
+    @property
+    def session(self):
+        """Returns the session passed in, or the session of the role set by account or role_arn in the particle definition"""
+        if self._session is None:
+            account = self.particle_definition.get("account")
+            role_arn = self.particle_definition.get("role_arn")
+            if account or role_arn:
+                self._session = self.session_manager.get_session(account=account, role_arn=role_arn)
+        return self._session
+
     @property
     def client(self):
         if not self._client:
             region_name = self.particle_definition["aws_resource"].get("region_name")
-            self._client = self._get_client(self._session, region_name=region_name)
+            self._client = self._get_client(self.session, region_name=region_name)
         return self._client
 
     @property
@@ -47,13 +62,16 @@ class AWSResource(Particle):
         """Returns the aws resource object"""
         if not self._resource:
             region_name = self.particle_definition["aws_resource"].get("region_name")
-            self._resource = self._get_resource(self._session, region_name=region_name)
+            self._resource = self._get_resource(self.session, region_name=region_name)
         return self._resource
 
     def _get_client(self, session, **kwargs):
-        if session: return session.client(self.resource_name, **kwargs)
+        if self.client_pool is not None: return self.client_pool.client(self.resource_name, session=session, **kwargs)
+        if session and self.session_manager.manages(session):
+            return self.session_manager.client_pool.client(self.resource_name, session=session, **kwargs)
+        if session: return metrics.instrument_client(session.client(self.resource_name, **kwargs))
 
-        return boto3.client(self.resource_name, **kwargs)
+        return metrics.instrument_client(boto3.client(self.resource_name, **kwargs))
 
     def _get_resource(self, session, **kwargs):
         try:
@@ -67,6 +85,11 @@ class AWSResource(Particle):
         self.id_replace()
         super().apply(sync=sync,cascade=cascade, validate_config=validate_config, max_timeout=max_timeout, src_cascade=src_cascade, cache_ttl=15)
 
+    def plan(self):
+        # replace and lookup id values so they are not reported as differences
+        self.id_replace()
+        return super().plan()
+
     def get_region(self):
         return self.client.meta.region_name
 
@@ -96,12 +119,29 @@ class AWSResource(Particle):
         """
         raise NotImplementedError
 
+    def get_lookups(self):
+        """
+        Returns:
+            list of (resource, names) for the $lookup variables in the desired state definition
+        """
+        var_lookup_list = pcf_util.find_nested_vars(self.desired_state_definition, var_list=[])
+        return [(id_var[1], id_var[2].split(':')) for (_nested_key, id_var) in var_lookup_list if id_var[0] == "lookup"]
+
+    def get_lookup(self):
+        """
+        Returns:
+            lookup for the region and session of the particle
+        """
+        return self.lookup(region_name=self.particle_definition["aws_resource"].get("region_name"), session=self.session)
+
     def id_replace(self):
         """
         Looks through the particle definition for $lookup and replaces them with specified resource with given name
         """
-        aws_lookup = self.lookup()
+        aws_lookup = self.get_lookup()
         var_lookup_list = pcf_util.find_nested_vars(self.desired_state_definition, var_list=[])
+        if any(id_var[0] == "lookup" for _nested_key, id_var in var_lookup_list):
+            self.keep_unresolved_definition()
         for (nested_key, id_var) in var_lookup_list:
             if id_var[0] == "lookup":
                 resource = id_var[1]
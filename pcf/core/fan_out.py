@@ -0,0 +1,200 @@
+# Copyright 2018 Capital One Services, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Applying one definition to many regions and sessions concurrently """
+
+import logging
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from pcf.core.pcf_exceptions import FanOutException
+
+logger = logging.getLogger(__name__)
+
+
+class FanOutTarget(object):
+    """
+    A region, and optionally a session for another account, that a definition is deployed to
+    """
+    __slots__ = ("region_name", "session", "name")
+
+    def __init__(self, region_name, session=None, name=None):
+        """
+        Args:
+            region_name (str): region written to aws_resource.region_name of every particle
+            session (boto3.session.Session): session used by the particles, defaults to the boto3 default session
+            name (str): label of the target in results, defaults to the region name
+        """
+        self.region_name = region_name
+        self.session = session
+        self.name = name or region_name
+
+    @classmethod
+    def from_value(cls, target):
+        """
+        Args:
+            target (FanOutTarget, str or tuple): a target, a region name or a (region_name, session) tuple
+
+        Returns:
+            FanOutTarget
+        """
+        if isinstance(target, cls):
+            return target
+        if isinstance(target, str):
+            return cls(target)
+        return cls(*target)
+
+    def __repr__(self):
+        return "FanOutTarget({})".format(self.name)
+
+
+class TargetResult(object):
+    """
+    Outcome of applying one target
+    """
+    __slots__ = ("target", "field", "error", "start_time", "end_time", "particle_results")
+
+    def __init__(self, target):
+        self.target = target
+        self.field = None
+        self.error = None
+        self.start_time = None
+        self.end_time = None
+        self.particle_results = {}
+
+    @property
+    def succeeded(self):
+        return self.field is not None and self.error is None
+
+    @property
+    def duration(self):
+        if self.start_time is None:
+            return None
+        return (self.end_time or time.time()) - self.start_time
+
+
+class FanOutResult(object):
+    """
+    Aggregated outcome of a fan out, one TargetResult per target in the order the targets were given
+    """
+
+    def __init__(self, results):
+        self.results = results
+
+    def __iter__(self):
+        return iter(self.results)
+
+    def __len__(self):
+        return len(self.results)
+
+    def __getitem__(self, name):
+        for result in self.results:
+            if result.target.name == name:
+                return result
+        raise KeyError(name)
+
+    @property
+    def succeeded(self):
+        return all(result.succeeded for result in self.results)
+
+    @property
+    def failures(self):
+        """
+        Returns:
+            dict of target name to the error of each failed target
+        """
+        return {result.target.name: result.error for result in self.results if not result.succeeded}
+
+    def raise_for_failures(self):
+        """
+        Raises FanOutException when any target failed
+        """
+        if not self.succeeded:
+            raise FanOutException(self.failures)
+
+
+def rewrite_region(definition, region_name):
+    """
+    Copies a particle or quasiparticle definition with aws_resource.region_name set on it and on all member
+    particles
+
+    Args:
+        definition (dict): particle or quasiparticle definition
+        region_name (str): new region
+
+    Returns:
+        new definition
+    """
+    definition = deepcopy(definition)
+    pending = [definition]
+    while pending:
+        particle_definition = pending.pop()
+        if isinstance(particle_definition.get("aws_resource"), dict):
+            particle_definition["aws_resource"]["region_name"] = region_name
+        pending.extend(member for member in particle_definition.get("particles", []) if isinstance(member, dict))
+    return definition
+
+
+def use_session(particles, session):
+    """
+    Makes aws particles, including the members of quasiparticles, use a session
+
+    Args:
+        particles (list): particles
+        session (boto3.session.Session): session, nothing is changed when None
+    """
+    if session is None:
+        return
+    for particle in particles:
+        if hasattr(particle, "_session"):
+            particle._session = session
+            particle._client = None
+            particle._resource = None
+        pcf_field = getattr(particle, "pcf_field", None)
+        if pcf_field is not None:
+            use_session(pcf_field.get_particle_list(), session)
+
+
+def fan_out(targets, build, apply, max_workers=None):
+    """
+    Builds a copy of a definition per target and applies all copies concurrently
+
+    Args:
+        targets (list): FanOutTargets, region names or (region_name, session) tuples
+        build (function): build(target) returns the copy applied to the target
+        apply (function): apply(copy, result) applies a copy and may fill result.particle_results
+        max_workers (int): number of targets applied concurrently, defaults to all of them
+
+    Returns:
+        FanOutResult
+    """
+    results = [TargetResult(FanOutTarget.from_value(target)) for target in targets]
+
+    def apply_target(result):
+        result.start_time = time.time()
+        try:
+            result.field = build(result.target)
+            apply(result.field, result)
+        except Exception as error:
+            logger.warning("{0}: fan out apply failed with {1}".format(result.target.name, error))
+            result.error = error
+        finally:
+            result.end_time = time.time()
+
+    if results:
+        with ThreadPoolExecutor(max_workers=max_workers or len(results)) as executor:
+            list(executor.map(apply_target, results))
+
+    return FanOutResult(results)
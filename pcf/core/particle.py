@@ -17,11 +17,17 @@ import logging
 import json
 import commentjson
 
+from copy import deepcopy
+from types import MappingProxyType
+
 from pcf.core import State, STATE_STRING_TO_ENUM, pcf_exceptions
-from pcf.util import pcf_util
+from pcf.util import metrics, pcf_util
 
 logger = logging.getLogger(__name__)
 
+# shared read-only default for particles without callbacks
+_NO_CALLBACKS = MappingProxyType({})
+
 
 class MetaParticle(type):
     def __new__(cls, name, bases, namespace):
@@ -44,6 +50,46 @@ class Particle(object, metaclass=MetaParticle):
     Type of particle
     """
 
+    # Engine fields are stored in slots rather than the instance __dict__ so very large fields stay compact.
+    # __dict__ is kept so that subclasses can continue to set their own attributes freely.
+    __slots__ = (
+        "particle_definition",
+        "name",
+        "persist_on_termination",
+        "persist_on_update",
+        "callbacks",
+        "desired_state",
+        "state",
+        "current_state_definition",
+        "desired_state_definition",
+        "custom_config",
+        "pcf_id",
+        "current_state_transiton",
+        "current_state_transition_start_time",
+        "state_last_refresh_time",
+        "state_cache_ttl",
+        "state_dirty",
+        "_parents",
+        "_children",
+        "_state_transition_overrides",
+        "_unresolved_definition",
+        "__dict__",
+        "__weakref__",
+    )
+
+    # Shared by every instance of the class. Maps (start_state, end_state) to the name of the transition method so
+    # that no particle has to carry its own table of bound methods. Use register_state_transition() to override
+    # a transition for a single particle.
+    STATE_TRANSITIONS = {
+        (State.terminated, State.running): "start",
+        (State.stopped, State.running): "start",
+        (State.stopped, State.terminated): "terminate",
+        (State.running, State.stopped): "stop",
+        (State.running, State.terminated): "terminate"
+    }
+
+    unique_keys = ()
+
     def __init__(self, particle_definition):
         """
         Args:
@@ -60,21 +106,19 @@ class Particle(object, metaclass=MetaParticle):
         self.validate_unique_id()
         self.persist_on_termination = self.particle_definition.get("persist_on_termination", False)
         self.persist_on_update = self.particle_definition.get("persist_on_update", False)
-        self.callbacks = self.particle_definition.get("callbacks", {})
+        self.callbacks = self.particle_definition.get("callbacks") or _NO_CALLBACKS
         self.desired_state = STATE_STRING_TO_ENUM.get(self.particle_definition.get("desired_state"))
         self.current_state_definition = {}
         self.desired_state_definition = {}
         self.custom_config = {}
         self.pcf_id = self.get_pcf_id()
-        self.state_transition_table = {
-            (State.terminated, State.running): self.start,
-            (State.stopped, State.running): self.start,
-            (State.stopped, State.terminated): self.terminate,
-            (State.running, State.stopped): self.stop,
-            (State.running, State.terminated): self.terminate
-        }
-        self.parents = set()
-        self.children = set()
+
+        # relatives and transition overrides are only allocated once they are used
+        self._parents = None
+        self._children = None
+        self._state_transition_overrides = None
+        # copy of the particle definition taken before variables are replaced in it, see get_unresolved_definition
+        self._unresolved_definition = None
 
         self.current_state_transiton = None
         self.current_state_transition_start_time = None
@@ -83,7 +127,47 @@ class Particle(object, metaclass=MetaParticle):
         self.state_cache_ttl = 15
         self.state_dirty = False
 
-        self.unique_keys = []
+    @property
+    def parents(self):
+        """
+        Returns:
+            set of parent particles
+        """
+        if self._parents is None:
+            self._parents = set()
+        return self._parents
+
+    @parents.setter
+    def parents(self, parents):
+        self._parents = parents
+
+    @property
+    def children(self):
+        """
+        Returns:
+            set of child particles
+        """
+        if self._children is None:
+            self._children = set()
+        return self._children
+
+    @children.setter
+    def children(self, children):
+        self._children = children
+
+    @property
+    def state_transition_table(self):
+        """
+        Builds the state transition table of this particle from the shared class table and any overrides registered
+        on this particle.
+
+        Returns:
+            dict of (start_state, end_state) to transition function
+        """
+        table = {transition: getattr(self, func_name) for transition, func_name in self.STATE_TRANSITIONS.items()}
+        if self._state_transition_overrides:
+            table.update(self._state_transition_overrides)
+        return table
 
     def get_pcf_id(self):
         """
@@ -127,10 +211,12 @@ class Particle(object, metaclass=MetaParticle):
             state
         """
         if not self.use_cached_state():
+            metrics.STATE_CACHE.inc(flavor=self.flavor, result="miss")
             self.sync_state()
             self.state_last_refresh_time = time.time()
             logger.info("Refreshed state for {0}: {1}".format(self.pcf_id, self.state))
         else:
+            metrics.STATE_CACHE.inc(flavor=self.flavor, result="hit")
             logger.debug("Using cached state for {0}: {1}".format(self.pcf_id, self.state))
         return self.state
 
@@ -174,7 +260,16 @@ class Particle(object, metaclass=MetaParticle):
         logger.info("{0}: setting desired state to {1}".format(self.pcf_id, self.desired_state))
 
     def measure(self):
-        return self.__dict__
+        """
+        Returns:
+            dict of the particle's attributes, including the ones stored in slots
+        """
+        attributes = {}
+        for slot in Particle.__slots__:
+            if slot not in ("__dict__", "__weakref__") and hasattr(self, slot):
+                attributes[slot] = getattr(self, slot)
+        attributes.update(self.__dict__)
+        return attributes
 
     def _validate_config(self):
         """
@@ -196,6 +291,23 @@ class Particle(object, metaclass=MetaParticle):
         Returns:
             State transition response
         """
+        start_time = time.time()
+        outcome = "failed"
+        try:
+            response = self._apply(sync=sync, cascade=cascade, validate_config=validate_config, max_timeout=max_timeout,
+                                   src_cascade=src_cascade, cache_ttl=cache_ttl)
+            outcome = "converged" if sync else "applied"
+            return response
+        except pcf_exceptions.MaxTimeoutException:
+            outcome = "timed_out"
+            raise
+        finally:
+            metrics.CONVERGE_SECONDS.observe(time.time() - start_time, flavor=self.flavor, outcome=outcome)
+
+    def _apply(self, sync, cascade, validate_config, max_timeout, src_cascade, cache_ttl):
+        """
+        State transition loop of apply(), see apply() for the arguments
+        """
         if max_timeout:
             start_timeout = time.time()
 
@@ -243,7 +355,7 @@ class Particle(object, metaclass=MetaParticle):
 
                     self.current_state_transiton = (self.state, self.desired_state)
                     self.current_state_transition_start_time = time.time()
-                    state_transition_response = state_transition_func(sync=sync, cascade=cascade)
+                    state_transition_response = self._call_transition(state_transition_func, sync=sync, cascade=cascade)
 
                     # trigger callback
                     if state_transition_response and self.callbacks.get(state_transition_func.__name__):
@@ -289,7 +401,7 @@ class Particle(object, metaclass=MetaParticle):
                     if not sync: break
                 else:
                     self.state_dirty = True
-                    self.update(sync=sync, cascade=cascade)
+                    self._call_transition(self.update, sync=sync, cascade=cascade)
 
                 if not sync: break
                 self.wait()
@@ -302,6 +414,64 @@ class Particle(object, metaclass=MetaParticle):
 
         return state_transition_response
 
+    def _call_transition(self, state_transition_func, **kwargs):
+        """
+        Calls a state transition function and counts its outcome
+
+        Args:
+            state_transition_func (function): function from the state transition table or update
+            **kwargs: passed to the function
+
+        Returns:
+            State transition response
+        """
+        outcome = "failed"
+        try:
+            response = state_transition_func(**kwargs)
+            outcome = "succeeded"
+            return response
+        finally:
+            transition = getattr(state_transition_func, "__name__", "unknown")
+            metrics.TRANSITIONS.inc(flavor=self.flavor, transition=transition, outcome=outcome)
+
+    def plan(self):
+        """
+        Syncs the particle and determines what apply() would do to reach the desired state without changing
+        anything.
+
+        Returns:
+            dict with the pcf_id, flavor, current_state, desired_state, action and diff of the particle. action is
+            the name of the state transition function that apply() would call, "update" when the state definitions
+            differ, "wait" when the particle is pending, or None when nothing would change.
+        """
+        self.sync_state()
+        self.state_last_refresh_time = time.time()
+        current_state = getattr(self, "state", None)
+
+        action = None
+        diff = {}
+        if self.desired_state and not (self.persist_on_termination and self.desired_state == State.terminated):
+            if not self.is_state_equivalent(current_state, self.desired_state):
+                if current_state == State.pending:
+                    action = "wait"
+                else:
+                    state_transition_func = self.get_state_transition_function(current_state, self.desired_state)
+                    action = state_transition_func.__name__ if state_transition_func else "invalid"
+            elif current_state == State.running == self.desired_state and not self.is_state_definition_equivalent():
+                diff = pcf_util.diff_dict(self.current_state_definition, self.get_desired_state_definition())
+                if diff.get("callbacks"):
+                    diff["callbacks"] = {"new": "<function>"}
+                action = None if self.persist_on_update else "update"
+
+        return {
+            "pcf_id": self.pcf_id,
+            "flavor": self.flavor,
+            "current_state": getattr(current_state, "name", current_state),
+            "desired_state": getattr(self.desired_state, "name", self.desired_state),
+            "action": action,
+            "diff": diff,
+        }
+
     def apply_cascade(self, direction, desired_state=None, sync=True, src_cascade=None):
         """
         Args:
@@ -347,6 +517,8 @@ class Particle(object, metaclass=MetaParticle):
         values to this particles desired_state_definition.
         """
         var_lookup_list = pcf_util.find_nested_vars(self.desired_state_definition, var_list=[])
+        if any(id_var[0] == "inherit" for _nested_key, id_var in var_lookup_list):
+            self.keep_unresolved_definition()
         for (nested_key, id_var) in var_lookup_list:
             if id_var[0] == "inherit":
                 pcf_id = id_var[1]
@@ -363,6 +535,24 @@ class Particle(object, metaclass=MetaParticle):
                 pcf_util.replace_value_nested_dict(curr_dict=self.desired_state_definition,
                                                      list_nested_keys=nested_key.split('.'), new_value=var)
 
+    def keep_unresolved_definition(self):
+        """
+        Keeps a copy of the particle definition before variables are replaced in it. Call before replacing values
+        of the desired state definition in place.
+        """
+        if self._unresolved_definition is None:
+            self._unresolved_definition = deepcopy(self.particle_definition)
+
+    def get_unresolved_definition(self):
+        """
+        Returns:
+            the particle definition as it was given, with its $lookup$ and $inherit$ variables, ie to clone the
+            particle for another region
+        """
+        if self._unresolved_definition is None:
+            return self.particle_definition
+        return self._unresolved_definition
+
     def register_state_transition(self, start_state, end_state, transition_function):
         """
         Registers the correct transition function
@@ -372,7 +562,9 @@ class Particle(object, metaclass=MetaParticle):
             end_state: ending state of the transition
             transition_function: associated transition function
         """
-        self.state_transition_table[(start_state, end_state)] = transition_function
+        if self._state_transition_overrides is None:
+            self._state_transition_overrides = {}
+        self._state_transition_overrides[(start_state, end_state)] = transition_function
 
     def get_state_transition_function(self, start_state, end_state):
         """
@@ -382,7 +574,13 @@ class Particle(object, metaclass=MetaParticle):
             start_state: starting state of the transition
             end_state: ending state of the transition
         """
-        return self.state_transition_table.get((start_state, end_state), None)
+        if self._state_transition_overrides and (start_state, end_state) in self._state_transition_overrides:
+            return self._state_transition_overrides[(start_state, end_state)]
+
+        func_name = self.STATE_TRANSITIONS.get((start_state, end_state))
+        if not func_name:
+            return None
+        return getattr(self, func_name)
 
     def start(self, sync=True, cascade=False):
         """
@@ -480,6 +678,17 @@ class Particle(object, metaclass=MetaParticle):
         """
         raise NotImplementedError
 
+    @classmethod
+    def link_batch(cls, particles):
+        """
+        Lets the particles of this flavor in a field share work when they are applied, ie batch their API calls.
+        Called by the field with all of its particles of the flavor. Does nothing by default.
+
+        Args:
+            particles (list): particles of the flavor in the field
+        """
+        pass
+
     def link_relatives(self, pcf):
         """
         links children and parents to each other
@@ -12,7 +12,33 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import logging
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from pcf.core import State, fan_out, scheduler
+from pcf.core.scheduler import ParticleScheduler
 from pcf.util import pcf_util
+from pcf.util.aws import aws_lookup
+from pcf.util.rate_limiter import RateLimiter
+
+logger = logging.getLogger(__name__)
+
+
+def link_batches(particles):
+    """
+    Calls link_batch() of each particle class with all of the particles of that class, ie particles loaded together
+    from a config file
+
+    Args:
+        particles (list): particles
+    """
+    particles_by_class = {}
+    for particle in particles:
+        particles_by_class.setdefault(type(particle), []).append(particle)
+    for particle_class, class_particles in particles_by_class.items():
+        particle_class.link_batch(class_particles)
 
 
 class PCF(object):
@@ -26,6 +52,7 @@ class PCF(object):
             self.load_particle_definition(particle_definition)
 
         self.link_particles(self.particles)
+        self.link_batches()
 
     def load_particle_definition(self, particle_definition):
         from pcf.core import particle_flavor_scanner
@@ -43,6 +70,12 @@ class PCF(object):
             else:
                 v.link_relatives(self)
 
+    def link_batches(self):
+        """
+        Calls link_batch() of each particle class with all particles of that class in the field
+        """
+        link_batches(self.get_particle_list())
+
     def get_particle(self, flavor, pcf_name):
         return self.particles.get(flavor, {}).get(pcf_name)
 
@@ -72,10 +105,137 @@ class PCF(object):
             self.add_particle(particle)
 
     def apply(self, sync=True, cascade=False, validate_config=False, max_timeout=None, particles_dict=None):
-        if not particles_dict: particles_dict = self.particles
+        if not particles_dict:
+            particles_dict = self.particles
+            self.prefetch_lookups()
         for k, v in particles_dict.items():
             if isinstance(v, dict):
                 self.apply(particles_dict=v, sync=sync, cascade=cascade, validate_config=validate_config, max_timeout=max_timeout)
             else:
                 v.apply(sync=sync, cascade=cascade, validate_config=validate_config, max_timeout=max_timeout)
 
+    def clone(self, region_name=None, session=None):
+        """
+        Creates a new field from the definitions of the particles in this field as they were given, with their
+        $lookup$ and $inherit$ variables, so the field can be cloned after it was applied. Desired states are copied.
+
+        Args:
+            region_name (str): region written to aws_resource.region_name of every particle, unchanged when None
+            session (boto3.session.Session): session used by the aws particles of the new field
+
+        Returns:
+            PCF
+        """
+        particles = self.get_particle_list()
+        # definitions as they were given, particles that were applied or planned replaced their variables in place
+        definitions = [p.get_unresolved_definition() for p in particles]
+        definitions = [
+            fan_out.rewrite_region(definition, region_name) if region_name else deepcopy(definition)
+            for definition in definitions
+        ]
+        pcf_field = PCF(definitions)
+        for particle in particles:
+            if particle.desired_state:
+                pcf_field.get_particle_from_pcf_id(particle.pcf_id).set_desired_state(particle.desired_state)
+        fan_out.use_session(pcf_field.get_particle_list(), session)
+        return pcf_field
+
+    def fan_out_apply(self, targets, max_workers=None, max_workers_per_target=1, sync=True, cascade=False,
+                      validate_config=False, max_timeout=None):
+        """
+        Applies a copy of this field to each target concurrently, see clone(). Within a target particles are applied
+        in dependency order by up to max_workers_per_target workers. Failures of one target do not stop the others.
+
+        Args:
+            targets (list): FanOutTargets, region names or (region_name, session) tuples
+            max_workers (int): number of targets applied concurrently, defaults to all of them
+            max_workers_per_target (int): number of particles applied concurrently within a target
+            sync (bool): apply state transitions synchronously
+            cascade (bool): apply state transitions to all family members
+            validate_config (bool): specify whether or not to call particle config validation function
+            max_timeout (int): seconds each target may take, defaults to no limit
+
+        Returns:
+            FanOutResult, call raise_for_failures() to raise when any target failed
+        """
+        def build(target):
+            return self.clone(region_name=target.region_name, session=target.session)
+
+        def apply_field(pcf_field, result):
+            if max_workers_per_target <= 1:
+                return pcf_field.apply(sync=sync, cascade=cascade, validate_config=validate_config,
+                                       max_timeout=max_timeout)
+
+            pcf_field.prefetch_lookups()
+            particles = pcf_field.get_particle_list()
+            reverse = any(p.desired_state and p.desired_state != State.running for p in particles)
+            deadline = time.time() + max_timeout if max_timeout else None
+            result.particle_results = ParticleScheduler(
+                particles, max_workers=max_workers_per_target, reverse=reverse
+            ).run(
+                lambda particle, timeout: particle.apply(sync=sync, cascade=cascade, validate_config=validate_config,
+                                                         max_timeout=timeout),
+                deadline=deadline,
+            )
+            failed = [r for r in result.particle_results.values() if r.status != scheduler.SUCCEEDED]
+            if failed:
+                raise failed[0].error or Exception("{} did not succeed".format(failed[0].pcf_id))
+
+        return fan_out.fan_out(targets, build, apply_field, max_workers=max_workers)
+
+    def prefetch_lookups(self):
+        """
+        Resolves the $lookup variables of all particles with batched calls before they are applied
+        """
+        aws_lookup.prefetch_lookups(self.get_particle_list())
+
+    def get_particle_list(self, particles_dict=None):
+        """
+        Returns:
+            list of all particles in the field
+        """
+        if particles_dict is None: particles_dict = self.particles
+        particle_list = []
+        for k, v in particles_dict.items():
+            if isinstance(v, dict):
+                particle_list += self.get_particle_list(particles_dict=v)
+            else:
+                particle_list.append(v)
+        return particle_list
+
+    def plan(self, max_workers=10, rate_limit=None):
+        """
+        Concurrently syncs every particle in the field and returns what apply() would do without changing anything.
+        Particles are synced grouped by flavor and each flavor is limited to rate_limit syncs per second so that
+        large fields do not get throttled by a single service.
+
+        Args:
+            max_workers (int): number of particles synced concurrently
+            rate_limit (float): maximum syncs per second per flavor, defaults to no limit
+
+        Returns:
+            list of particle plans (see Particle.plan()) sorted by pcf_id. Particles that failed to sync have an
+            error field instead of an action.
+        """
+        particles = sorted(self.get_particle_list(), key=lambda p: (p.flavor or "", p.pcf_id))
+        rate_limiters = {}
+        for particle in particles:
+            rate_limiters.setdefault(particle.flavor, RateLimiter(rate_limit))
+
+        def plan_particle(particle):
+            rate_limiters[particle.flavor].acquire()
+            try:
+                return particle.plan()
+            except Exception as error:
+                logger.debug("{0}: plan failed with {1}".format(particle.pcf_id, error))
+                return {
+                    "pcf_id": particle.pcf_id,
+                    "flavor": particle.flavor,
+                    "desired_state": getattr(particle.desired_state, "name", particle.desired_state),
+                    "error": str(error),
+                }
+
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            plans = list(executor.map(plan_particle, particles))
+
+        return sorted(plans, key=lambda p: p["pcf_id"])
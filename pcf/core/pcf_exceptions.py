@@ -96,3 +96,39 @@ class InvalidState(Exception):
 class MissingInput(Exception):
     def __init__(self, message="Missing Required Input"):
         Exception.__init__(self, message)
+
+
+class ParticleNotFoundException(Exception):
+    def __init__(self, pcf_id=None):
+        Exception.__init__(self, "Particle {} not found".format(pcf_id) if pcf_id else "Particle not found")
+
+
+class FanOutException(Exception):
+    def __init__(self, failures):
+        self.failures = failures
+        Exception.__init__(self, "Fan out failed for {}".format(
+            ", ".join("{0} ({1})".format(name, error) for name, error in sorted(failures.items()))))
+
+
+class ChecksumMismatchException(Exception):
+    def __init__(self, location, expected, actual):
+        self.location = location
+        self.expected = expected
+        self.actual = actual
+        Exception.__init__(self, "Checksum of {0} is {1}, expected {2}".format(location, actual, expected))
+
+
+class ObjectDeleteException(Exception):
+    def __init__(self, bucket, errors):
+        self.bucket = bucket
+        self.errors = errors
+        Exception.__init__(self, "Could not delete {0} objects of {1}, ie {2}: {3}".format(
+            len(errors), bucket, errors[0].get("Key"), errors[0].get("Message")))
+
+
+class BatchIncompleteException(Exception):
+    def __init__(self, table_name, unprocessed):
+        self.table_name = table_name
+        self.unprocessed = unprocessed
+        Exception.__init__(self, "{0} requests to {1} were still unprocessed after retrying".format(
+            len(unprocessed), table_name))
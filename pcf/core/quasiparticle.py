@@ -18,7 +18,7 @@ import logging
 
 from pcf.core.particle import Particle
 from pcf.core.pcf import PCF
-from pcf.core import State, STATE_STRING_TO_ENUM
+from pcf.core import State, STATE_STRING_TO_ENUM, fan_out
 from pcf.util import pcf_util
 from pcf.core.pcf_exceptions import MaxTimeoutException
 from pcf.util.pcf_util import particle_class_from_flavor
@@ -56,6 +56,8 @@ class Quasiparticle(Particle):
         particles in the quasiparticle. Finally link_particles is called on the pcf_field.
         """
         for particle in self.member_particles:
+            # names and parents are added to a copy so that the definition of the quasiparticle stays as it was given
+            particle = dict(particle)
             particle_class_from_flavor(particle.get("flavor"))
             if not particle.get("pcf_name"):
                 particle["pcf_name"] = self.name
@@ -89,6 +91,7 @@ class Quasiparticle(Particle):
                     self.pcf_field.load_particle_definition(particle_multiple)
 
         self.pcf_field.link_particles(self.pcf_field.particles)
+        self.pcf_field.link_batches()
 
     def add_parents_to_particle(self, particle_definition):
         """
@@ -132,6 +135,106 @@ class Quasiparticle(Particle):
             else:
                 raise error
 
+    def get_unresolved_definition(self):
+        """
+        Members share the nested values of their definitions with the definition of the quasiparticle and keep a copy
+        of their own before replacing variables in them, so the definition as it was given is put back together
+        from theirs rather than copied upfront.
+
+        Returns:
+            the quasiparticle definition as it was given, with the $lookup$ and $inherit$ variables of its members
+        """
+        if self._unresolved_definition is not None:
+            return self._unresolved_definition
+        members = {particle.pcf_id: particle for particle in self.pcf_field.get_particle_list()}
+        definition = dict(self.particle_definition)
+        definition["particles"] = []
+        for entry in self.member_particles:
+            member = members.get(pcf_util.generate_pcf_id(entry.get("flavor"), entry.get("pcf_name") or self.name))
+            if member is not None:
+                resolved = member.particle_definition
+                unresolved = member.get_unresolved_definition()
+                entry = dict((key, unresolved[key] if key in resolved and resolved[key] is value else value)
+                             for key, value in entry.items())
+            definition["particles"].append(entry)
+        return definition
+
+    def clone(self, region_name=None, session=None):
+        """
+        Creates a new quasiparticle from this quasiparticle's definition as it was given, with the same desired state
+
+        Args:
+            region_name (str): region written to aws_resource.region_name of every member particle, unchanged when None
+            session (boto3.session.Session): session used by the aws member particles
+
+        Returns:
+            Quasiparticle of the same class
+        """
+        if region_name:
+            definition = fan_out.rewrite_region(self.get_unresolved_definition(), region_name)
+        else:
+            definition = deepcopy(self.get_unresolved_definition())
+        quasiparticle = type(self)(definition)
+        if self.desired_state:
+            quasiparticle.set_desired_state(self.desired_state)
+        # members can have desired states of their own
+        for particle in self.pcf_field.get_particle_list():
+            member = quasiparticle.pcf_field.get_particle_from_pcf_id(particle.pcf_id)
+            if member and particle.desired_state:
+                member.set_desired_state(particle.desired_state)
+        fan_out.use_session([quasiparticle], session)
+        return quasiparticle
+
+    def fan_out_apply(self, targets, max_workers=None, sync=True, cascade=True, validate_config=False, rollback=False,
+                      max_timeout=None):
+        """
+        Applies a copy of this quasiparticle to each target concurrently with apply(), see clone(). Failures of one
+        target do not stop the others.
+
+        Args:
+            targets (list): FanOutTargets, region names or (region_name, session) tuples
+            max_workers (int): number of targets applied concurrently, defaults to all of them
+            sync (bool): sync or async mode. Defaults to True
+            cascade (bool): Defaults to True
+            validate_config (bool): specify whether or not to call particle config validation function
+            rollback (bool): terminate the particles of a target if applying it fails. Defaults to False
+            max_timeout (int): raise the max timeout exception after x(int) seconds reached, defaults to None
+
+        Returns:
+            FanOutResult, call raise_for_failures() to raise when any target failed
+        """
+        def build(target):
+            return self.clone(region_name=target.region_name, session=target.session)
+
+        def apply_quasiparticle(quasiparticle, result):
+            quasiparticle.apply(sync=sync, cascade=cascade, validate_config=validate_config, rollback=rollback,
+                                max_timeout=max_timeout)
+
+        return fan_out.fan_out(targets, build, apply_quasiparticle, max_workers=max_workers)
+
+    def plan(self, max_workers=10, rate_limit=None):
+        """
+        Plans all particles in the quasiparticle via pcf_field.plan()
+
+        Args:
+            max_workers (int): number of particles synced concurrently
+            rate_limit (float): maximum syncs per second per flavor
+
+        Returns:
+            dict with the plan of the quasiparticle and the plans of its particles
+        """
+        particle_plans = self.pcf_field.plan(max_workers=max_workers, rate_limit=rate_limit)
+        current_state = self.get_state()
+        return {
+            "pcf_id": self.pcf_id,
+            "flavor": self.flavor,
+            "current_state": getattr(current_state, "name", current_state),
+            "desired_state": getattr(self.desired_state, "name", self.desired_state),
+            "action": "apply" if any(p.get("action") or p.get("error") for p in particle_plans) else None,
+            "diff": {},
+            "particles": particle_plans,
+        }
+
     def sync_state(self):
         pass
 
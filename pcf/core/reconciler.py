@@ -0,0 +1,407 @@
+# Copyright 2018 Capital One Services, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import heapq
+import json
+import logging
+import os
+import random
+import socketserver
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from pcf.core import State
+from pcf.core.aws_resource import AWSResource
+from pcf.core.pcf_exceptions import ParticleNotFoundException
+from pcf.core.quasiparticle import Quasiparticle
+from pcf.util import metrics
+from pcf.util.aws.client_pool import ClientPool
+
+logger = logging.getLogger(__name__)
+
+
+class ReconcileEntry(object):
+    """
+    Scheduling state of one particle in a Reconciler
+    """
+    __slots__ = ("particle", "interval", "next_run", "last_run", "last_duration", "last_error", "reconciles",
+                 "failures", "running")
+
+    def __init__(self, particle, interval):
+        self.particle = particle
+        self.interval = interval
+        self.next_run = None
+        self.last_run = None
+        self.last_duration = None
+        self.last_error = None
+        self.reconciles = 0
+        self.failures = 0
+        self.running = False
+
+    def status(self):
+        """
+        Returns:
+            json serializable dict with the state of the particle and its last reconcile
+        """
+        return {
+            "pcf_id": self.particle.pcf_id,
+            "state": getattr(getattr(self.particle, "state", None), "name", None),
+            "desired_state": getattr(self.particle.desired_state, "name", None),
+            "interval": self.interval,
+            "next_run": self.next_run,
+            "last_run": self.last_run,
+            "last_duration": self.last_duration,
+            "last_error": self.last_error,
+            "reconciles": self.reconciles,
+            "failures": self.failures,
+            "running": self.running,
+        }
+
+
+class Reconciler(object):
+    """
+    Long running loop that keeps particles at their desired state. The particles, their clients and state caches
+    and a worker pool stay alive between reconciles, so each reconcile only costs the state polls of the particles.
+
+    Each particle is reconciled every interval seconds, set per particle by reconcile_interval in its definition.
+    A random jitter spreads reconciles of particles with the same interval out over time. A particle is never
+    reconciled concurrently with itself.
+    """
+
+    def __init__(self, particles, interval=60, jitter=0.1, max_workers=10, max_timeout=None, client_pool=None):
+        """
+        Args:
+            particles (list): particles and quasiparticles to reconcile, with their desired states set
+            interval (float): default seconds between reconciles of a particle
+            jitter (float): fraction of the interval reconciles are randomly moved by
+            max_workers (int): number of particles reconciled concurrently
+            max_timeout (int): seconds a single reconcile may take, defaults to no limit
+            client_pool (ClientPool): boto3 client pool shared by the aws particles, defaults to a new pool
+        """
+        self.interval = interval
+        self.jitter = jitter
+        self.max_workers = max_workers
+        self.max_timeout = max_timeout
+        self.client_pool = client_pool if client_pool is not None else ClientPool()
+        self.entries = {}
+        for particle in particles:
+            self._share_client_pool(particle)
+            interval = particle.particle_definition.get("reconcile_interval", self.interval)
+            self.entries.setdefault(particle.pcf_id, ReconcileEntry(particle, interval))
+
+        self._queue = []
+        self._condition = threading.Condition()
+        self._stopped = True
+        self._thread = None
+        self._executor = None
+        self._server = None
+
+    def _share_client_pool(self, particle):
+        if isinstance(particle, AWSResource):
+            particle.client_pool = self.client_pool
+            # clients created before the pool was shared are replaced by pooled ones
+            particle._client = None
+        if isinstance(particle, Quasiparticle):
+            for member in particle.pcf_field.get_particle_list():
+                self._share_client_pool(member)
+
+    def _next_run(self, entry, now):
+        spread = entry.interval * self.jitter
+        return now + entry.interval + random.uniform(-spread, spread)
+
+    def _schedule(self, entry, run_at):
+        """
+        Must be called with the condition held. Older queue items of the entry are ignored when popped.
+        """
+        entry.next_run = run_at
+        heapq.heappush(self._queue, (run_at, entry.particle.pcf_id))
+        self._condition.notify()
+
+    def get_entry(self, pcf_id):
+        """
+        Args:
+            pcf_id (str): pcf_id of the particle, or its pcf_name if the name is unique
+
+        Returns:
+            ReconcileEntry
+        """
+        entry = self.entries.get(pcf_id)
+        if entry:
+            return entry
+        matches = [e for e in self.entries.values() if e.particle.name == pcf_id]
+        if len(matches) != 1:
+            raise ParticleNotFoundException(pcf_id)
+        return matches[0]
+
+    def set_desired_state(self, pcf_id, desired_state):
+        """
+        Changes the desired state of a particle and reconciles it as soon as possible
+
+        Args:
+            pcf_id (str): pcf_id or unique pcf_name of the particle
+            desired_state (State or str): new desired state
+        """
+        entry = self.get_entry(pcf_id)
+        entry.particle.set_desired_state(desired_state)
+        self.reconcile_now(entry.particle.pcf_id)
+
+    def reconcile_now(self, pcf_id):
+        """
+        Reconciles a particle as soon as a worker is free
+
+        Args:
+            pcf_id (str): pcf_id or unique pcf_name of the particle
+        """
+        entry = self.get_entry(pcf_id)
+        with self._condition:
+            self._schedule(entry, time.time())
+
+    def reconcile(self, entry):
+        """
+        Applies the desired state of a single particle and records the outcome
+
+        Args:
+            entry (ReconcileEntry): particle to reconcile
+        """
+        start = time.time()
+        outcome = "failed"
+        try:
+            entry.particle.apply(sync=True, max_timeout=self.max_timeout)
+            entry.last_error = None
+            outcome = "succeeded"
+        except Exception as error:
+            logger.warning("{0}: reconcile failed with {1}".format(entry.particle.pcf_id, error))
+            entry.failures += 1
+            entry.last_error = str(error)
+        finally:
+            metrics.RECONCILES.inc(flavor=entry.particle.flavor, outcome=outcome)
+            end = time.time()
+            with self._condition:
+                entry.reconciles += 1
+                entry.last_run = start
+                entry.last_duration = end - start
+                entry.running = False
+                if entry.next_run and entry.next_run > start:
+                    # reconcile_now() was called while this reconcile was running
+                    self._schedule(entry, end)
+                else:
+                    self._schedule(entry, self._next_run(entry, end))
+
+    def _loop(self):
+        with self._condition:
+            while not self._stopped:
+                now = time.time()
+                while self._queue and self._queue[0][0] <= now:
+                    run_at, pcf_id = heapq.heappop(self._queue)
+                    entry = self.entries[pcf_id]
+                    # stale queue item, or the reconcile is rescheduled when the running one finishes
+                    if entry.running or run_at != entry.next_run:
+                        continue
+                    entry.running = True
+                    self._executor.submit(self.reconcile, entry)
+
+                timeout = self._queue[0][0] - now if self._queue else None
+                self._condition.wait(timeout=timeout)
+
+    def start(self):
+        """
+        Starts reconciling in a background thread. Particles are first reconciled at a random time within their
+        interval times the jitter.
+        """
+        with self._condition:
+            if not self._stopped:
+                return
+            self._stopped = False
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+            now = time.time()
+            for entry in self.entries.values():
+                self._schedule(entry, now + random.uniform(0, entry.interval * self.jitter))
+
+        self._thread = threading.Thread(target=self._loop, name="pcf-reconciler", daemon=True)
+        self._thread.start()
+
+    def stop(self, wait=True):
+        """
+        Stops scheduling reconciles and the http api
+
+        Args:
+            wait (bool): wait for running reconciles to finish
+        """
+        with self._condition:
+            self._stopped = True
+            self._queue = []
+            self._condition.notify()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        if self._executor:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            if isinstance(self._server, ThreadingUnixHTTPServer) and os.path.exists(self._server.server_address):
+                os.remove(self._server.server_address)
+            self._server = None
+
+    def run_forever(self):
+        """
+        Starts reconciling and blocks until interrupted
+        """
+        self.start()
+        try:
+            while self._thread and self._thread.is_alive():
+                self._thread.join(1)
+        except KeyboardInterrupt:
+            logger.info("Stopping reconciler")
+        finally:
+            self.stop(wait=False)
+
+    def status(self):
+        """
+        Returns:
+            list of ReconcileEntry.status() sorted by pcf_id
+        """
+        return [self.entries[pcf_id].status() for pcf_id in sorted(self.entries)]
+
+    def metrics(self):
+        """
+        Returns:
+            dict of reconciler wide counters
+        """
+        entries = list(self.entries.values())
+        now = time.time()
+        return {
+            "particles": len(entries),
+            "running": sum(1 for e in entries if e.running),
+            "overdue": sum(1 for e in entries if not e.running and e.next_run and e.next_run <= now),
+            "reconciles": sum(e.reconciles for e in entries),
+            "failures": sum(e.failures for e in entries),
+            "failing_particles": sum(1 for e in entries if e.last_error),
+            "pooled_clients": len(self.client_pool),
+        }
+
+    def render_metrics(self):
+        """
+        Returns:
+            all pcf metrics in the Prometheus text format, with the reconciler gauges up to date
+        """
+        reconciler_metrics = self.metrics()
+        metrics.QUEUE_DEPTH.set(reconciler_metrics["overdue"], queue="reconciler")
+        metrics.RECONCILES_RUNNING.set(reconciler_metrics["running"])
+        return metrics.REGISTRY.render()
+
+    def serve(self, host="127.0.0.1", port=8089, socket_path=None):
+        """
+        Serves the http api in a background thread
+
+            GET /particles                          status of all particles
+            GET /particles/<pcf_id>                 status of one particle
+            PUT /particles/<pcf_id>                 {"desired_state": "running"} changes the desired state
+            POST /particles/<pcf_id>/reconcile      reconciles the particle now
+            GET /status                             reconciler counters
+            GET /metrics                            metrics in the Prometheus text format
+
+        Args:
+            host (str): address to listen on, defaults to localhost only
+            port (int): port to listen on, 0 picks a free port
+            socket_path (str): listen on this unix socket instead of host and port
+
+        Returns:
+            the server, server_address holds the address it listens on
+        """
+        handler = type("Handler", (ReconcilerRequestHandler,), {"reconciler": self})
+        if socket_path:
+            self._server = ThreadingUnixHTTPServer(socket_path, handler)
+        else:
+            self._server = ThreadingTCPHTTPServer((host, port), handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="pcf-reconciler-api", daemon=True).start()
+        logger.info("Reconciler api listening on {}".format(self._server.server_address))
+        return self._server
+
+
+class ThreadingTCPHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    # http.server.ThreadingHTTPServer is only in python 3.7+
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class ReconcilerRequestHandler(BaseHTTPRequestHandler):
+    """
+    Http api of a Reconciler, see Reconciler.serve()
+    """
+    reconciler = None
+
+    def _send(self, status, content, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _send_json(self, status, body):
+        self._send(status, json.dumps(body, default=str).encode("utf-8"), "application/json")
+
+    def _path_parts(self):
+        return [part for part in self.path.split("?")[0].split("/") if part]
+
+    def do_GET(self):
+        parts = self._path_parts()
+        try:
+            if parts == ["particles"]:
+                return self._send_json(200, self.reconciler.status())
+            if len(parts) == 2 and parts[0] == "particles":
+                return self._send_json(200, self.reconciler.get_entry(parts[1]).status())
+            if parts == ["status"]:
+                return self._send_json(200, self.reconciler.metrics())
+            if parts == ["metrics"]:
+                return self._send(200, self.reconciler.render_metrics().encode("utf-8"), metrics.CONTENT_TYPE)
+        except ParticleNotFoundException as error:
+            return self._send_json(404, {"error": str(error)})
+        self._send_json(404, {"error": "Not found"})
+
+    def do_PUT(self):
+        parts = self._path_parts()
+        if len(parts) != 2 or parts[0] != "particles":
+            return self._send_json(404, {"error": "Not found"})
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            desired_state = json.loads(self.rfile.read(length).decode("utf-8") or "{}").get("desired_state")
+            if desired_state not in (State.running.name, State.stopped.name, State.terminated.name):
+                return self._send_json(400, {"error": "Invalid desired_state {}".format(desired_state)})
+            self.reconciler.set_desired_state(parts[1], desired_state)
+            self._send_json(200, self.reconciler.get_entry(parts[1]).status())
+        except ParticleNotFoundException as error:
+            self._send_json(404, {"error": str(error)})
+        except ValueError as error:
+            self._send_json(400, {"error": str(error)})
+
+    def do_POST(self):
+        parts = self._path_parts()
+        if len(parts) != 3 or parts[0] != "particles" or parts[2] != "reconcile":
+            return self._send_json(404, {"error": "Not found"})
+        try:
+            self.reconciler.reconcile_now(parts[1])
+            self._send_json(202, self.reconciler.get_entry(parts[1]).status())
+        except ParticleNotFoundException as error:
+            self._send_json(404, {"error": str(error)})
+
+    def log_message(self, format, *args):
+        logger.debug("Reconciler api: " + format % args)
@@ -0,0 +1,201 @@
+# Copyright 2018 Capital One Services, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import time
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pcf.core.pcf_exceptions import MaxTimeoutException
+from pcf.util import metrics
+
+logger = logging.getLogger(__name__)
+
+STARTED = "started"
+STATE_CHANGED = "state_changed"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+SKIPPED = "skipped"
+TIMED_OUT = "timed_out"
+
+FINAL_STATUSES = (SUCCEEDED, FAILED, SKIPPED, TIMED_OUT)
+
+
+class ParticleResult(object):
+    """
+    Outcome of running a function against one particle in the scheduler
+    """
+    __slots__ = ("particle", "status", "state", "start_time", "end_time", "response", "error")
+
+    def __init__(self, particle):
+        self.particle = particle
+        self.status = None
+        self.state = None
+        self.start_time = None
+        self.end_time = None
+        self.response = None
+        self.error = None
+
+    @property
+    def pcf_id(self):
+        return self.particle.pcf_id
+
+    @property
+    def duration(self):
+        """
+        Returns:
+            seconds the particle took, None if it never started
+        """
+        if self.start_time is None:
+            return None
+        return (self.end_time or time.time()) - self.start_time
+
+
+class ParticleScheduler(object):
+    """
+    Runs a function against many particles on a worker pool. A particle is only started once all the particles
+    it depends on have succeeded. Particles depend on their parents, or on their children when reverse is set
+    (e.g. when stopping or terminating). Particles whose dependencies failed are skipped.
+    """
+
+    def __init__(self, particles, max_workers=1, reverse=False, poll_interval=0.5):
+        """
+        Args:
+            particles (list): particles to schedule
+            max_workers (int): number of particles run concurrently
+            reverse (bool): run children before their parents
+            poll_interval (float): seconds between checks of the state of running particles
+        """
+        self.particles = {}
+        for particle in particles:
+            self.particles.setdefault(particle.pcf_id, particle)
+        self.max_workers = max(1, max_workers or 1)
+        self.reverse = reverse
+        self.poll_interval = poll_interval
+        self.dependencies = self._build_dependencies()
+        self.results = {pcf_id: ParticleResult(particle) for pcf_id, particle in self.particles.items()}
+        self.queue_depth = 0
+
+    @staticmethod
+    def _parent_ids(particle):
+        """
+        Returns:
+            pcf ids of the parents of a particle, linked or only named in its definition
+        """
+        parent_ids = {parent.pcf_id for parent in particle.parents}
+        parent_ids.update(particle.particle_definition.get("parents", []))
+        return parent_ids
+
+    def _build_dependencies(self):
+        dependencies = {pcf_id: set() for pcf_id in self.particles}
+
+        for pcf_id, particle in self.particles.items():
+            relations = [(parent_id, pcf_id) for parent_id in self._parent_ids(particle)]
+            relations += [(pcf_id, child_id) for child_id in particle.particle_definition.get("children", [])]
+            relations += [(pcf_id, child.pcf_id) for child in particle.children]
+
+            for parent_id, child_id in relations:
+                if parent_id == child_id or parent_id not in self.particles or child_id not in self.particles:
+                    continue
+                if self.reverse:
+                    dependencies[parent_id].add(child_id)
+                else:
+                    dependencies[child_id].add(parent_id)
+
+        return dependencies
+
+    def run(self, func, deadline=None, on_event=None):
+        """
+        Runs func(particle, timeout) for every particle. timeout is the number of seconds left until the deadline
+        or None.
+
+        Args:
+            func (function): function applied to each particle
+            deadline (float): time.time() after which no particle is started and running particles time out
+            on_event (function): called with (event, ParticleResult) on the calling thread whenever a particle
+                starts, changes state or finishes
+
+        Returns:
+            dict of pcf_id to ParticleResult
+        """
+        waiting = list(self.particles)
+        running = {}
+
+        def emit(event, result):
+            if on_event:
+                on_event(event, result)
+
+        def finish(result, status, error=None):
+            result.status = status
+            result.error = error
+            result.end_time = time.time()
+            emit(status, result)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while waiting or running:
+                # repeat until nothing changes so that skips and timeouts reach every descendant before the
+                # remaining particles are taken for a cycle
+                changed = True
+                while changed:
+                    changed = False
+                    for pcf_id in list(waiting):
+                        dependency_statuses = [self.results[d].status for d in self.dependencies[pcf_id]]
+                        if any(status in (FAILED, SKIPPED, TIMED_OUT) for status in dependency_statuses):
+                            waiting.remove(pcf_id)
+                            finish(self.results[pcf_id], SKIPPED, "a dependency did not succeed")
+                            changed = True
+                        elif (all(status == SUCCEEDED for status in dependency_statuses)
+                              and len(running) < self.max_workers):
+                            waiting.remove(pcf_id)
+                            result = self.results[pcf_id]
+                            if deadline and time.time() >= deadline:
+                                finish(result, TIMED_OUT, MaxTimeoutException())
+                                changed = True
+                                continue
+                            result.start_time = time.time()
+                            timeout = deadline - result.start_time if deadline else None
+                            running[executor.submit(func, result.particle, timeout)] = result
+                            emit(STARTED, result)
+
+                self.queue_depth = len(waiting)
+                metrics.QUEUE_DEPTH.set(self.queue_depth, queue="scheduler")
+
+                if not running:
+                    # nothing can start, the remaining particles depend on each other
+                    for pcf_id in waiting:
+                        finish(self.results[pcf_id], FAILED, Exception("Circular dependency for {}".format(pcf_id)))
+                    break
+
+                done, _ = wait(list(running), timeout=self.poll_interval, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    result = running.pop(future)
+                    try:
+                        result.response = future.result()
+                        result.state = getattr(result.particle, "state", None)
+                        finish(result, SUCCEEDED)
+                    except MaxTimeoutException as error:
+                        finish(result, TIMED_OUT, error)
+                    except Exception as error:
+                        logger.debug("{0}: failed in scheduler with {1}".format(result.pcf_id, error))
+                        finish(result, FAILED, error)
+
+                for result in running.values():
+                    state = getattr(result.particle, "state", None)
+                    if state != result.state:
+                        result.state = state
+                        emit(STATE_CHANGED, result)
+
+        self.queue_depth = 0
+        metrics.QUEUE_DEPTH.set(0, queue="scheduler")
+        return self.results
@@ -14,8 +14,7 @@
 
 from pcf.particle.aws.lambda_function.lambda_function import LambdaFunction
 from pcf.core.pcf_exceptions import MissingException
-from zipfile import ZipFile
-import os
+from pcf.util.zip_builder import ZipBuilder
 import importlib
 import logging
 
@@ -25,7 +24,8 @@ logger = logging.getLogger(__name__)
 class LambdaPython(LambdaFunction):
     """
     This extends the LambdaFunction. It adds the functionality to autogenerate a zip file of your python packages and files.
-    THe python packages are autodiscovered using importlib.
+    THe python packages are autodiscovered using importlib. The zip is deterministic and rebuilt incrementally, so an
+    unchanged function keeps its CodeSha256 and is not uploaded again.
 
     """
     flavor = "lambda_python_function"
@@ -55,25 +55,21 @@ class LambdaPython(LambdaFunction):
         with open(self.directory + "/" + self.lambda_requirements,'r') as f:
             requirements = [line.strip().split('=')[0] for line in f]
 
-        with ZipFile(self.name + ".zip", "w") as zip:
-            # zip python files
-            for p_file in python_files:
-                zip.write(p_file)
-
-            # zip requirements from requirements.txt
-            for requirement in requirements:
-                try:
-                    path = importlib.util.find_spec(requirement).submodule_search_locations[0]
-                    if path:
-                        rootdir = requirement
-                        for root, dirs, files in os.walk(path):
-                            for file in files:
-                                filepath = os.path.join(root, file)
-                                parentpath = os.path.relpath(filepath,path)
-                                arcname = os.path.join(rootdir, parentpath)
-                                zip.write(filepath,arcname)
-                except:
-                    logger.debug("Could not find {0}. Skipping".format(requirement))
+        builder = ZipBuilder(self.name + ".zip", max_workers=self.custom_config.get("zip_workers"))
+        # zip python files
+        for p_file in python_files:
+            builder.add(p_file)
+
+        # zip requirements from requirements.txt
+        for requirement in requirements:
+            try:
+                path = importlib.util.find_spec(requirement).submodule_search_locations[0]
+                if path:
+                    builder.add(path, requirement)
+            except:
+                logger.debug("Could not find {0}. Skipping".format(requirement))
+
+        builder.build()
 
         self.desired_state_definition["Code"] = {"ZipFile": self.name + ".zip"}
 
@@ -15,11 +15,11 @@
 from pcf.core.aws_resource import AWSResource
 from pcf.core import State
 from pcf.util import pcf_util
+from pcf.util.template_cache import TEMPLATES
 from pcf.core.pcf_exceptions import NoResourceException
 import json
 from botocore.errorfactory import ClientError
 import logging
-from jinja2 import Template
 
 logger = logging.getLogger(__name__)
 
@@ -174,7 +174,7 @@ class CloudFormationStack(AWSResource):
 
     def render_template(self):
         """
-        Opens the userdata template file and renders the file with userdata parameters.
+        Renders the template body with the template parameters. The body is compiled once per content hash.
         Returns:
             None
         """
@@ -182,6 +182,5 @@ class CloudFormationStack(AWSResource):
 
         if template_body:
             context = self.desired_state_definition.get("custom_config", {}).get("template_parameters", {})
-            template = Template(template_body)
-            self.desired_state_definition["TemplateBody"] = template.render(context)
+            self.desired_state_definition["TemplateBody"] = TEMPLATES.render_string(template_body, context)
 
@@ -14,11 +14,16 @@
 
 from pcf.core.aws_resource import AWSResource
 from pcf.core import State
+from pcf.core.pcf_exceptions import BatchIncompleteException
 from pcf.util import pcf_util
 from botocore.errorfactory import ClientError
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 
+import json
 import logging
 import itertools
+import random
+import time
 
 logger = logging.getLogger(__name__)
 
@@ -26,6 +31,9 @@ logger = logging.getLogger(__name__)
 class DynamoDB(AWSResource):
     """
     This is the implementation of Amazon's DynamoDB service
+
+    batch_write, batch_delete and batch_get split any iterable of items or keys into requests of the API limits and
+    send custom_config batch_concurrency of them at the same time, 4 by default.
     """
 
     flavor = "dynamodb_table"
@@ -67,6 +75,13 @@ class DynamoDB(AWSResource):
         "WriteCapacityUnits"
     }
 
+    # items per batch_write_item and keys per batch_get_item call
+    BATCH_WRITE_SIZE = 25
+    BATCH_GET_SIZE = 100
+    BATCH_ATTEMPTS = 10
+    BATCH_BACKOFF = 0.05
+    MAX_BATCH_BACKOFF = 5
+
     def __init__(self, particle_definition, session=None):
         super().__init__(particle_definition=particle_definition, resource_name="dynamodb", session=session)
         self.table_name = self.desired_state_definition["TableName"]
@@ -163,6 +178,142 @@ class DynamoDB(AWSResource):
         """
         return self.client.get_item(TableName=self.table_name, Key=key_value, **kwargs)
 
+    def _key(self, item):
+        """
+        Returns:
+            the primary key of an item, None when the key schema is not in the definition
+        """
+        key_names = [key["AttributeName"] for key in self.desired_state_definition.get("KeySchema", [])]
+        if not key_names:
+            return None
+        return tuple(json.dumps(item.get(name), sort_keys=True) for name in key_names)
+
+    def _chunks(self, requests, size, key):
+        """
+        Groups requests in chunks of at most size. The API rejects chunks with duplicate keys, a request for a key
+        already in the chunk replaces the earlier request so the last one wins.
+
+        Returns:
+            generator of dicts of key to request
+        """
+        chunk = {}
+        for request in requests:
+            request_key = key(request)
+            if request_key is None:
+                request_key = object()
+            if request_key not in chunk and len(chunk) == size:
+                yield chunk
+                chunk = {}
+            chunk[request_key] = request
+        if chunk:
+            yield chunk
+
+    def _run_chunks(self, chunks, function):
+        """
+        Calls function with the requests of every chunk on a thread pool. Only a few chunks are taken from the
+        iterator ahead of the calls, so the requests are never all in memory. A chunk repeating a key of a chunk
+        still in flight waits for it, so requests for the same key are applied in order.
+
+        Returns:
+            generator of the results in the order the calls finished
+        """
+        max_workers = self.custom_config.get("batch_concurrency", 4)
+        pending = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for chunk in chunks:
+                while len(pending) >= 2 * max_workers or any(not keys.isdisjoint(chunk) for keys in pending.values()):
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        del pending[future]
+                        yield future.result()
+                pending[executor.submit(function, list(chunk.values()))] = chunk.keys()
+            for future in as_completed(pending):
+                yield future.result()
+
+    def _backoff(self, attempt):
+        time.sleep(random.uniform(0, min(DynamoDB.MAX_BATCH_BACKOFF, DynamoDB.BATCH_BACKOFF * 2 ** attempt)))
+
+    def _write_chunk(self, requests):
+        """
+        Sends up to 25 put or delete requests with batch_write_item and retries the unprocessed ones
+
+        Returns:
+            number of requests
+        """
+        request_items = {self.table_name: requests}
+        for attempt in range(DynamoDB.BATCH_ATTEMPTS):
+            if attempt:
+                self._backoff(attempt)
+            request_items = self.client.batch_write_item(RequestItems=request_items).get("UnprocessedItems")
+            if not request_items or not request_items.get(self.table_name):
+                return len(requests)
+        raise BatchIncompleteException(self.table_name, request_items[self.table_name])
+
+    def _get_chunk(self, keys, kwargs):
+        """
+        Reads up to 100 keys with batch_get_item and retries the unprocessed ones
+
+        Returns:
+            list of items
+        """
+        items = []
+        request_items = {self.table_name: dict(kwargs, Keys=keys)}
+        for attempt in range(DynamoDB.BATCH_ATTEMPTS):
+            if attempt:
+                self._backoff(attempt)
+            response = self.client.batch_get_item(RequestItems=request_items)
+            items.extend(response.get("Responses", {}).get(self.table_name, []))
+            request_items = response.get("UnprocessedKeys")
+            if not request_items or not request_items.get(self.table_name):
+                return items
+        raise BatchIncompleteException(self.table_name, request_items[self.table_name]["Keys"])
+
+    def batch_write(self, items):
+        """
+        Puts items in the DynamoDB table with batch_write_item
+
+        Args:
+            items (iterable): maps of attribute name/value pairs, ie a generator
+
+        Returns:
+            number of items written, an item replaced by a later one with the same key in the same chunk is not
+            counted
+        """
+        chunks = self._chunks(({"PutRequest": {"Item": item}} for item in items), DynamoDB.BATCH_WRITE_SIZE,
+                              lambda request: self._key(request["PutRequest"]["Item"]))
+        return sum(self._run_chunks(chunks, self._write_chunk))
+
+    def batch_delete(self, keys):
+        """
+        Deletes items of the DynamoDB table by primary key with batch_write_item
+
+        Args:
+            keys (iterable): maps of attribute names to AttributeValue objects, ie a generator
+
+        Returns:
+            number of items deleted, repeated keys in the same chunk are counted once
+        """
+        chunks = self._chunks(({"DeleteRequest": {"Key": key}} for key in keys), DynamoDB.BATCH_WRITE_SIZE,
+                              lambda request: self._key(request["DeleteRequest"]["Key"]))
+        return sum(self._run_chunks(chunks, self._write_chunk))
+
+    def batch_get(self, keys, **kwargs):
+        """
+        Reads items of the DynamoDB table by primary key with batch_get_item. Keys are read as the items are
+        consumed.
+
+        Args:
+            keys (iterable): maps of attribute names to AttributeValue objects, ie a generator
+            **kwargs: options of the table in batch_get_item, ie ConsistentRead or ProjectionExpression
+
+        Returns:
+            generator of the items that exist, in no particular order
+        """
+        chunks = self._chunks(keys, DynamoDB.BATCH_GET_SIZE, self._key)
+        for items in self._run_chunks(chunks, lambda chunk: self._get_chunk(chunk, kwargs)):
+            for item in items:
+                yield item
+
     def _update(self):
         """
         Updates the dynamodb particle to match current state definition.
@@ -15,11 +15,17 @@
 from pcf.core.aws_resource import AWSResource
 from pcf.core import State
 from pcf.util import pcf_util
-from jinja2 import Template
+from pcf.util.template_cache import TEMPLATES
 from pcf.core.pcf_exceptions import *
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
 import base64
+import copy
+import json
 import logging
 import pkg_resources
+import threading
+import time
 from pcf.util.aws.tag_specifications import EC2InstanceTagSpecifications
 
 logger = logging.getLogger(__name__)
@@ -81,6 +87,9 @@ class EC2Instance(AWSResource):
 
     UNIQUE_KEYS = ["aws_resource.custom_config.instance_name"]
 
+    # values per describe_instances filter
+    FILTER_VALUES_LIMIT = 200
+
     def __init__(self, particle_definition):
         super(EC2Instance, self).__init__(particle_definition, "ec2")
 
@@ -92,8 +101,23 @@ class EC2Instance(AWSResource):
 
         if not self.instance_name: raise Exception("EC2Instance must have 'instance_name' defined")
 
+        # shared with the other instances of the field, see link_batch
+        self.launch_batch = None
+        self._waiting_for_userdata = False
+        # the UserdataWatcher forgets instances once it reported them finished
+        self._userdata_finished_instance_id = None
         self._set_unique_keys()
 
+    @classmethod
+    def link_batch(cls, particles):
+        """
+        Instances in one field, ie the replicas of a multiplier, share a LaunchBatch so missing instances with the same
+        launch parameters are created with one run_instances call
+        """
+        launch_batch = LaunchBatch(particles) if len(particles) > 1 else None
+        for particle in particles:
+            particle.launch_batch = launch_batch
+
     def _set_unique_keys(self):
         """
         Logic that sets keys from state definition that are used to uniquely identify the EC2 instance
@@ -103,7 +127,8 @@ class EC2Instance(AWSResource):
 
     def render_desired_user_data(self):
         """
-        Opens the userdata template file and renders the file with userdata parameters.
+        Renders the userdata template file with userdata parameters. The template is compiled once and the output is
+        cached by the userdata parameters.
 
         Returns:
             userdate
@@ -116,12 +141,7 @@ class EC2Instance(AWSResource):
 
             if template_filename:
                 context = self.desired_state_definition.get("custom_config").get("userdata_params", {})
-                template = Template(
-                    open(template_filename, 'r').read()
-                )
-
-                userdata = template.render(context)
-                return userdata
+                return TEMPLATES.render_file(template_filename, context)
             else:
                 return "#No userdata provided"
 
@@ -273,9 +293,45 @@ class EC2Instance(AWSResource):
         Returns:
            boto3 create_instances() response
         """
+        if self.launch_batch:
+            instance_id = self.launch_batch.launch(self)
+            if instance_id:
+                return [self.resource.Instance(instance_id)]
+
         create_definition = pcf_util.param_filter(self.get_desired_state_definition(), EC2Instance.START_PARAM_FILTER)
         return self.resource.create_instances(**create_definition)
 
+    def get_launch_definition(self):
+        """
+        Returns:
+            run_instances parameters this instance shares with the other instances of a batch, without the PCFName tag
+            and counts
+        """
+        launch_definition = pcf_util.param_filter(self.get_desired_state_definition(), EC2Instance.START_PARAM_FILTER)
+        launch_definition.pop("MinCount", None)
+        launch_definition.pop("MaxCount", None)
+        tag_specifications = []
+        for tag_specification in launch_definition.get("TagSpecifications", []):
+            tags = [tag for tag in tag_specification["Tags"] if tag["Key"] != "PCFName"]
+            if tags:
+                tag_specifications.append(dict(tag_specification, Tags=tags))
+        launch_definition["TagSpecifications"] = tag_specifications
+        if not tag_specifications:
+            launch_definition.pop("TagSpecifications")
+        return launch_definition
+
+    def get_launch_key(self):
+        """
+        Returns:
+            key that is equal for instances that can be launched by one run_instances call
+        """
+        return (
+            self.particle_definition["aws_resource"].get("region_name"),
+            id(self.session),
+            frozenset(parent.pcf_id for parent in self.parents),
+            json.dumps(self.get_launch_definition(), sort_keys=True, default=str),
+        )
+
     def _start(self):
         """
         Calls boto3 start_instances(). This is called for stopped to running state transition.
@@ -306,30 +362,20 @@ class EC2Instance(AWSResource):
         """
         Calls get_current_definition() and updates the current_state_definition and the state.
         """
+        self._waiting_for_userdata = False
         try:
             self.current_state_definition = self.get_current_definition()
         except NoResourceException:
             self.state = EC2Instance.state_lookup.get('missing')
         else:
             if self.desired_state_definition["custom_config"].get("userdata_wait"):
-                tags = self.client.describe_tags(
-                    Filters=[
-                        {
-                            'Name': 'resource-id',
-                            'Values': [
-                                self.get_instance_id(),
-                            ]
-                        },
-                    ],
-                )
-
-                userdata_finished = None
-                for tag in tags["Tags"]:
-                    if tag["Key"] == 'UserdataFinished':
-                        userdata_finished = tag["Value"]
-                        break
+                instance_id = self.get_instance_id()
+                userdata_finished = (instance_id == self._userdata_finished_instance_id
+                                     or UserdataWatcher.for_particle(self).is_finished(instance_id))
+                self._waiting_for_userdata = not userdata_finished
 
                 if userdata_finished:
+                    self._userdata_finished_instance_id = instance_id
                     self.state = EC2Instance.state_lookup[self.current_state_definition['State']['Name']]
                 else:
                     self.state = EC2Instance.state_lookup['pending']
@@ -337,6 +383,15 @@ class EC2Instance(AWSResource):
             else:
                 self.state = EC2Instance.state_lookup[self.current_state_definition['State']['Name']]
 
+    def wait(self):
+        """
+        Instances waiting for their userdata sleep until the next shared poll of their UserdataWatcher
+        """
+        if self._waiting_for_userdata:
+            UserdataWatcher.for_particle(self).wait()
+        else:
+            super(EC2Instance, self).wait()
+
     def _update(self):
        #TODO: This needs to be implemented
         raise NotImplementedError
@@ -358,6 +413,290 @@ class EC2Instance(AWSResource):
         #     logger.debug("State is not equivalent for {0} with diff: {1}".format(self.get_pcf_id(), json.dumps(diff)))
         #     return False
 
+    @classmethod
+    def get_private_ips(cls, particles):
+        """
+        Looks up the private ips of many instances with one paginated describe_instances per region and session
+
+        Args:
+            particles (list): EC2Instance particles
+
+        Returns:
+            dict of pcf_id to PrivateIpAddress, None for instances that do not exist
+        """
+        groups = {}
+        for particle in particles:
+            groups.setdefault((particle.client.meta.region_name, particle.session), []).append(particle)
+
+        ips = {}
+        for group in groups.values():
+            names = {}
+            for particle in group:
+                names.setdefault(particle.instance_name, []).append(particle)
+                ips[particle.pcf_id] = None
+            paginator = group[0].client.get_paginator("describe_instances")
+            name_list = sorted(names)
+            for i in range(0, len(name_list), cls.FILTER_VALUES_LIMIT):
+                filters = [
+                    {'Name': 'tag:PCFName', 'Values': name_list[i:i + cls.FILTER_VALUES_LIMIT]},
+                    {'Name': 'instance-state-name', 'Values': ['pending', 'running', 'shutting-down', 'stopping', 'stopped']},
+                ]
+                for page in paginator.paginate(Filters=filters):
+                    for reservation in page["Reservations"]:
+                        for instance in reservation.get("Instances", []):
+                            for tag in instance.get("Tags", []):
+                                if tag["Key"] == "PCFName":
+                                    for particle in names.get(tag["Value"], []):
+                                        ips[particle.pcf_id] = instance.get("PrivateIpAddress")
+        return ips
+
+class LaunchBatch(object):
+    """
+    EC2 instances of a field that are launched together. The first instance that has to be created launches every
+    other instance of the batch that should be running, does not exist yet and shares its launch parameters, parents,
+    region and session with one run_instances call. Each instance is tagged with its PCFName afterwards and the new
+    instance ids are handed to the particles, which then only wait for their instance. Instances that cannot be tagged
+    are terminated. Instances with a start
+    callback are always launched on their own so the callback runs.
+    """
+
+    # concurrent create_tags calls when tagging launched instances
+    TAGGING_WORKERS = 10
+    CAPACITY_ERROR_CODES = {"InsufficientInstanceCapacity", "InstanceLimitExceeded", "VcpuLimitExceeded"}
+
+    def __init__(self, particles):
+        """
+        Args:
+            particles (list): EC2Instance particles
+        """
+        self.particles = particles
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _resolved_launch_key(other, replace_parent_variables):
+        """
+        Launch key of a batch mate with its parent variables and lookups resolved the way its own apply resolves
+        them. They are resolved on a copy through the shared lookup cache, the mate may be applied on another thread.
+        """
+        mate = copy.copy(other)
+        mate.desired_state_definition = copy.deepcopy(other.desired_state_definition)
+        if replace_parent_variables:
+            mate.get_and_replace_parent_variables()
+        mate.id_replace()
+        return mate.get_launch_key()
+
+    def _candidates(self, particle):
+        """
+        Returns:
+            instances that can be launched together with particle, particle first
+        """
+        # parent variables are replaced when particle is applied with cascade, its batch mates would do the same
+        replace_parent_variables = not any(
+            var[0] == "inherit" for _key, var in pcf_util.find_nested_vars(particle.desired_state_definition, var_list=[])
+        )
+        launch_key = particle.get_launch_key()
+        candidates = [particle]
+        for other in self.particles:
+            if other is particle or other._arn or other.desired_state != State.running or other.callbacks.get("start"):
+                continue
+            try:
+                if self._resolved_launch_key(other, replace_parent_variables) == launch_key:
+                    candidates.append(other)
+            except Exception as e:
+                logger.debug("{0} is launched on its own: {1}".format(other.pcf_id, e))
+        return candidates
+
+    @staticmethod
+    def _existing_names(particle, names):
+        """
+        Returns:
+            PCFNames of the instances that already exist, looked up with one paginated describe_instances
+        """
+        existing = set()
+        paginator = particle.client.get_paginator("describe_instances")
+        filters = [
+            {'Name': 'tag:PCFName', 'Values': names},
+            {'Name': 'instance-state-name', 'Values': ['pending', 'running', 'shutting-down', 'stopping', 'stopped']},
+        ]
+        for page in paginator.paginate(Filters=filters):
+            for reservation in page["Reservations"]:
+                for instance in reservation.get("Instances", []):
+                    existing.update(tag["Value"] for tag in instance.get("Tags", []) if tag["Key"] == "PCFName")
+        return existing
+
+    def launch(self, particle):
+        """
+        Launches particle together with the other missing instances of the batch
+
+        Args:
+            particle (EC2Instance): instance that has to be created
+
+        Returns:
+            instance id of particle, None when particle has to be created on its own
+        """
+        with self._lock:
+            if particle._arn:
+                return particle.get_instance_id()
+            if particle.callbacks.get("start"):
+                return None
+
+            candidates = self._candidates(particle)
+            if len(candidates) < 2:
+                return None
+            existing = self._existing_names(particle, [p.instance_name for p in candidates])
+            launches = [p for p in candidates if p is particle or p.instance_name not in existing]
+            if len(launches) < 2:
+                return None
+
+            logger.info("Launching {0} instances with one run_instances call for {1}".format(len(launches), particle.pcf_id))
+            try:
+                response = particle.client.run_instances(
+                    MinCount=len(launches), MaxCount=len(launches), **particle.get_launch_definition()
+                )
+            except ClientError as e:
+                if e.response["Error"]["Code"] not in LaunchBatch.CAPACITY_ERROR_CODES:
+                    raise e
+                # all or nothing, the instances are created one by one instead
+                logger.info("Could not launch {0} instances at once: {1}".format(len(launches), e))
+                return None
+            launched = list(zip(launches, response["Instances"]))
+
+            def tag(launch):
+                launched_particle, instance = launch
+                try:
+                    launched_particle.client.create_tags(
+                        Resources=[instance["InstanceId"]], Tags=[{"Key": "PCFName", "Value": launched_particle.instance_name}]
+                    )
+                except Exception as e:
+                    return e
+                launched_particle._arn = _construct_arn(
+                    region_name=launched_particle.client.meta.region_name,
+                    owner_id=response["OwnerId"],
+                    instance_id=instance["InstanceId"],
+                )
+                launched_particle.state_dirty = True
+
+            with ThreadPoolExecutor(max_workers=min(LaunchBatch.TAGGING_WORKERS, len(launched))) as executor:
+                errors = list(executor.map(tag, launched))
+
+            # instances without their PCFName would be orphaned, they are terminated and created again by their particle
+            untagged = [(launch, error) for launch, error in zip(launched, errors) if error is not None]
+            if untagged:
+                logger.warning("Terminating {0} launched instances that could not be tagged: {1}".format(
+                    len(untagged), untagged[0][1]))
+                particle.client.terminate_instances(InstanceIds=[instance["InstanceId"] for (_p, instance), _e in untagged])
+                for (launched_particle, _instance), error in untagged:
+                    if launched_particle is particle:
+                        raise error
+
+            return particle.get_instance_id()
+
+
+class UserdataWatcher(object):
+    """
+    Tracks the UserdataFinished tag of all instances of a region and session that wait for their userdata. Instead of
+    polling describe_tags for their own instance every second, particles share one poll per tick that covers every
+    pending instance with batched resource-id filters. The interval between polls backs off while no instance
+    finishes and is reset when one finishes or a new instance starts waiting. Waiting particles sleep until the next
+    poll.
+    """
+
+    RESOURCE_ID_BATCH = 200
+    _watchers = {}
+    _watchers_lock = threading.Lock()
+
+    def __init__(self, client, min_interval=1, max_interval=15, backoff=1.5):
+        """
+        Args:
+            client: ec2 client
+            min_interval (float): seconds between polls while instances finish
+            max_interval (float): longest interval between polls
+            backoff (float): factor the interval grows by after a poll without finished instances
+        """
+        self.client = client
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.interval = min_interval
+        self.last_poll_time = None
+        # pending instance ids and when a particle last asked about them
+        self.pending = {}
+        # finished instance ids and when their tag was found, until the waiting particle is told
+        self.finished = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_particle(cls, particle):
+        """
+        Returns:
+            the shared watcher of the region and session of the particle
+        """
+        key = (particle.client.meta.region_name, particle.session)
+        watcher = cls._watchers.get(key)
+        if watcher is None:
+            with cls._watchers_lock:
+                watcher = cls._watchers.setdefault(key, cls(particle.client))
+        return watcher
+
+    @property
+    def next_poll_time(self):
+        if self.last_poll_time is None:
+            return 0
+        return self.last_poll_time + self.interval
+
+    def is_finished(self, instance_id):
+        """
+        Polls when a poll is due, otherwise answers from the last poll. Once True was returned the instance is no
+        longer tracked.
+
+        Args:
+            instance_id (str): instance id
+
+        Returns:
+            True if the instance has the UserdataFinished tag
+        """
+        with self._lock:
+            if self.finished.pop(instance_id, None) is not None:
+                return True
+            if instance_id not in self.pending:
+                self.interval = self.min_interval
+            self.pending[instance_id] = time.time()
+            if time.time() >= self.next_poll_time:
+                self._poll()
+            return self.finished.pop(instance_id, None) is not None
+
+    def _poll(self):
+        # instances nobody asked about for a while are no longer waited for
+        expired = time.time() - 5 * self.max_interval
+        self.pending = {instance_id: asked for instance_id, asked in self.pending.items() if asked >= expired}
+        self.finished = {instance_id: found for instance_id, found in self.finished.items() if found >= expired}
+
+        instance_ids = sorted(self.pending)
+        newly_finished = set()
+        paginator = self.client.get_paginator("describe_tags")
+        for i in range(0, len(instance_ids), self.RESOURCE_ID_BATCH):
+            filters = [
+                {'Name': 'resource-id', 'Values': instance_ids[i:i + self.RESOURCE_ID_BATCH]},
+                {'Name': 'key', 'Values': ['UserdataFinished']},
+            ]
+            for page in paginator.paginate(Filters=filters):
+                newly_finished.update(tag["ResourceId"] for tag in page["Tags"] if tag["Value"])
+
+        logger.debug("Userdata of {0} of {1} pending instances finished".format(len(newly_finished), len(instance_ids)))
+        found = time.time()
+        for instance_id in newly_finished:
+            self.pending.pop(instance_id, None)
+            self.finished[instance_id] = found
+        self.interval = self.min_interval if newly_finished else min(self.interval * self.backoff, self.max_interval)
+        self.last_poll_time = time.time()
+
+    def wait(self):
+        """
+        Sleeps until the next poll is due
+        """
+        time.sleep(max(0, self.next_poll_time - time.time()))
+
+
 def _construct_arn(owner_id, region_name, instance_id):
     """
     Args:
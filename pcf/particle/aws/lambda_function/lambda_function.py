@@ -14,13 +14,17 @@
 
 from pcf.core.aws_resource import AWSResource
 from pcf.core import State
-from pcf.util import pcf_util
-import hashlib
+from pcf.util import metrics, pcf_util
+import base64
 import logging
+import os
+import threading
 import boto3
 import codecs
 
+from boto3.s3.transfer import TransferConfig
 from botocore.errorfactory import ClientError
+from urllib.parse import urlencode
 
 logger = logging.getLogger(__name__)
 
@@ -28,6 +32,11 @@ logger = logging.getLogger(__name__)
 class LambdaFunction(AWSResource):
     """This is the implementation of Amazon's lambda service. This particle works with function code in a zipfile located
     locally and in s3. Note that having a zipfile locally versus s3 has a slightly different configuration format.
+
+    Local zips of at least staging_threshold bytes (50MB by default) are staged when custom_config sets a
+    staging_bucket. They are uploaded to <staging_prefix><sha256>.zip with a parallel multipart transfer, unless that
+    object already exists, and passed to lambda as S3Bucket and S3Key. The bucket has to be in the region of the
+    function.
     """
     flavor = "lambda_function"
     START_PARAM_FILTER = {
@@ -87,13 +96,24 @@ class LambdaFunction(AWSResource):
 
     UNIQUE_KEYS = ["aws_resource.FunctionName"]
 
+    # CodeSha256 of artifacts by (path, size, mtime) for local zips and by (bucket, key, version, etag) for s3 objects,
+    # shared by all lambda particles so an artifact used by many functions is only hashed once
+    code_sha256_cache = {}
+    _code_sha256_lock = threading.Lock()
+
+    STAGING_THRESHOLD = 50 * 1024 * 1024
+    STAGING_CHUNK_SIZE = 16 * 1024 * 1024
+    # one upload per staged object at a time, so functions sharing an artifact upload it once
+    _staging_locks = {}
+
     def __init__(self, particle_definition):
         super(LambdaFunction, self).__init__(particle_definition=particle_definition,
                                      resource_name="lambda")
         self.function_name = self.desired_state_definition["FunctionName"]
         self.is_zip_local = True if self.desired_state_definition['Code'].get("ZipFile") else False
         self._s3_client = None
-        self.desired_state_definition["CodeSha256"] = self.__zipfile_to_sha256()
+        # the code is only hashed once a diff needs it, see get_desired_state_definition
+        self._code_hashed = False
 
         self._set_unique_keys()
 
@@ -139,7 +159,9 @@ class LambdaFunction(AWSResource):
         """
         new_desired_state_def, diff_dict = pcf_util.update_dict(self.current_state_definition, self.get_desired_state_definition())
         start_definition = pcf_util.param_filter(new_desired_state_def, LambdaFunction.START_PARAM_FILTER)
-        if self.is_zip_local:
+        if self.is_code_staged():
+            start_definition["Code"] = self.stage_code()
+        elif self.is_zip_local:
             start_definition["Code"]["ZipFile"] = self.file_get_contents()
 
         self.client.create_function(**start_definition)
@@ -173,6 +195,50 @@ class LambdaFunction(AWSResource):
             return f.read()
 
 
+    def is_code_staged(self):
+        """
+        Returns:
+            True if the local zip is uploaded to the staging bucket instead of being sent inline
+        """
+        if not self.is_zip_local or not self.custom_config.get("staging_bucket"):
+            return False
+        threshold = self.custom_config.get("staging_threshold", LambdaFunction.STAGING_THRESHOLD)
+        return os.path.getsize(self.desired_state_definition["Code"]["ZipFile"]) >= threshold
+
+    def stage_code(self):
+        """
+        Uploads the local zip to the staging bucket, keyed by its hash. Nothing is uploaded when the object already
+        exists.
+
+        Returns:
+            Code with the S3Bucket and S3Key of the staged zip
+        """
+        bucket = self.custom_config["staging_bucket"]
+        code_sha256 = self.get_desired_state_definition()["CodeSha256"]
+        key = "{0}{1}.zip".format(self.custom_config.get("staging_prefix", ""), base64.b64decode(code_sha256).hex())
+
+        with self._code_sha256_lock:
+            lock = LambdaFunction._staging_locks.setdefault((bucket, key), threading.Lock())
+        with lock:
+            try:
+                self.s3client.head_object(Bucket=bucket, Key=key)
+                logger.info("Code of {0} is already staged in s3://{1}/{2}".format(self.function_name, bucket, key))
+            except ClientError as e:
+                if e.response['Error']['Code'] not in ('404', 'NoSuchKey', 'NotFound'):
+                    raise e
+                logger.info("Staging code of {0} in s3://{1}/{2}".format(self.function_name, bucket, key))
+                config = TransferConfig(
+                    multipart_threshold=LambdaFunction.STAGING_CHUNK_SIZE,
+                    multipart_chunksize=LambdaFunction.STAGING_CHUNK_SIZE,
+                    max_concurrency=self.custom_config.get("staging_concurrency", 10),
+                )
+                # the tag lets particles that reference the staged object skip hashing it
+                self.s3client.upload_file(
+                    self.desired_state_definition["Code"]["ZipFile"], bucket, key,
+                    ExtraArgs={"Tagging": urlencode({"CodeSha256": code_sha256})}, Config=config
+                )
+        return {"S3Bucket": bucket, "S3Key": key}
+
     @property
     def s3client(self):
         """
@@ -183,7 +249,7 @@ class LambdaFunction(AWSResource):
         """
         if not self._s3_client:
             region_name = self.particle_definition["aws_resource"].get("region_name")
-            self._s3_client = boto3.client("s3", region_name=region_name)
+            self._s3_client = metrics.instrument_client((self.session or boto3).client("s3", region_name=region_name))
         return self._s3_client
 
     def _update(self):
@@ -192,13 +258,15 @@ class LambdaFunction(AWSResource):
             function call if the update is the function code in the zipfile or a configuration variable.
 
         """
-        if self.desired_state_definition["CodeSha256"] != self.current_state_definition["CodeSha256"]:
-            if self.is_zip_local:
+        if self.get_desired_state_definition()["CodeSha256"] != self.current_state_definition["CodeSha256"]:
+            if self.is_code_staged():
+                self.client.update_function_code(FunctionName=self.function_name, **self.stage_code())
+            elif self.is_zip_local:
                 self.client.update_function_code(FunctionName=self.function_name, ZipFile=self.file_get_contents())
             else:
                 self.client.update_function_code(FunctionName=self.function_name, **self.desired_state_definition["Code"])
 
-            self.desired_state_definition["CodeSha256"] = self.__zipfile_to_sha256()
+            self._code_hashed = False
 
         # update lambda configuration other than the code
         new_desired_state_def, diff_dict = pcf_util.update_dict(self.current_state_definition, self.get_desired_state_definition())
@@ -214,33 +282,71 @@ class LambdaFunction(AWSResource):
             bool
         """
         self.get_state()
-        desired_definition = pcf_util.param_filter(self.desired_state_definition, LambdaFunction.RETURN_PARAM_FILTER)
+        desired_definition = pcf_util.param_filter(self.get_desired_state_definition(), LambdaFunction.RETURN_PARAM_FILTER)
         new_desired_state_def, diff_dict = pcf_util.update_dict(self.current_state_definition, desired_definition)
         return diff_dict == {}
 
-    def __zip_local_to_sha256(self):
+    def get_desired_state_definition(self):
+        """
+        Hashes the function code the first time the desired definition is needed, so loading a config does not read
+        any artifacts.
+
+        Returns:
+            desired_state_definition with CodeSha256
+        """
+        if not self._code_hashed:
+            self.desired_state_definition["CodeSha256"] = self.__zipfile_to_sha256()
+            self._code_hashed = True
+        return self.desired_state_definition
+
+    @staticmethod
+    def _sha256_to_b64(hashed_zfile):
+        return codecs.encode(codecs.decode(hashed_zfile, 'hex'), 'base64').decode().strip('\n')
+
+    @classmethod
+    def _cached_sha256(cls, key, compute):
         """
-        Hashes the contents of a local zipfile using sha256
+        Args:
+            key (tuple): cache key that changes whenever the artifact changes
+            compute (function): returns the base 64 hash on a cache miss
 
         Returns:
             base 64 hash
         """
-        with open(self.desired_state_definition["Code"]["ZipFile"], "rb") as f:
-            zfile = f.read()
-        hashed_zfile = hashlib.sha256(zfile).hexdigest()
-        hashed_b64 = codecs.encode(codecs.decode(hashed_zfile, 'hex'), 'base64').decode().strip('\n')
+        hashed_b64 = cls.code_sha256_cache.get(key)
+        if hashed_b64 is None:
+            hashed_b64 = compute()
+            with cls._code_sha256_lock:
+                cls.code_sha256_cache[key] = hashed_b64
         return hashed_b64
 
+    def __zip_local_to_sha256(self):
+        """
+        Hashes the contents of a local zipfile using sha256, reading it in chunks. The hash is cached by the path, size
+        and mtime of the zip.
+
+        Returns:
+            base 64 hash
+        """
+        filename = self.desired_state_definition["Code"]["ZipFile"]
+        stat = os.stat(filename)
+        key = ("file", os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+        return self._cached_sha256(key, lambda: self._sha256_to_b64(pcf_util.file_sha256(filename)))
+
     def __s3_to_sha256(self):
         """
        Looks to see if the zipfile located in s3 has a tag with the latest sha256. If there is no tag it calculates the hash
-       and adds the tag.
+       while streaming the object and adds the tag. The hash is cached by the ETag of the object.
 
        Returns:
            base 64 hash
        """
         s3_kwargs = pcf_util.keep_and_replace_keys(self.desired_state_definition["Code"], LambdaFunction.S3_PARAM_CONVERSIONS)
+        etag = self.s3client.head_object(**s3_kwargs)["ETag"]
+        key = ("s3", s3_kwargs["Bucket"], s3_kwargs["Key"], s3_kwargs.get("VersionId"), etag)
+        return self._cached_sha256(key, lambda: self.__s3_object_to_sha256(s3_kwargs))
 
+    def __s3_object_to_sha256(self, s3_kwargs):
         # check if tag already contains hashed value
         tags = self.s3client.get_object_tagging(**s3_kwargs)
         for kv in tags["TagSet"]:
@@ -248,9 +354,7 @@ class LambdaFunction(AWSResource):
                 return kv['Value']
 
         obj = self.s3client.get_object(**s3_kwargs)
-        zfile = obj["Body"].read()
-        hashed_zfile = hashlib.sha256(zfile).hexdigest()
-        hashed_b64 = codecs.encode(codecs.decode(hashed_zfile, 'hex'), 'base64').decode().strip('\n')
+        hashed_b64 = self._sha256_to_b64(pcf_util.stream_sha256(obj["Body"].iter_chunks(pcf_util.HASH_CHUNK_SIZE)))
         self.s3client.put_object_tagging(Tagging={"TagSet": [{"Key": "CodeSha256", "Value": hashed_b64}]}, **s3_kwargs)
         return hashed_b64
 
@@ -267,11 +371,3 @@ class LambdaFunction(AWSResource):
 
         else:
             return self.__s3_to_sha256()
-
-
-
-
-
-
-
-
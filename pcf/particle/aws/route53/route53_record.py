@@ -18,6 +18,10 @@ from pcf.particle.aws.ec2.ec2_instance import EC2Instance
 from pcf.util import pcf_util
 import logging
 import json
+import re
+import threading
+import time
+import weakref
 from botocore.exceptions import ClientError
 
 
@@ -38,11 +42,15 @@ class Route53Record(AWSResource):
     :type HostedZoneId: string
     :type ResourceRecords: object list
     :type Type: string
+
+    Changes of the records in a field that share a hosted zone are submitted together, see ZoneChangeCoalescer. Set
+    custom_config wait_for_sync to wait until a change has propagated.
     """
     flavor='route53_record'
 
     REMOVE_PARAM_CONVERSIONS = {
         "HostedZoneId": "",
+        "custom_config": "",
     }
 
     equivalent_states = {
@@ -62,9 +70,22 @@ class Route53Record(AWSResource):
             self.desired_state_definition['Name'] = self.desired_state_definition['Name'] + '.'
         self.record_name = self.desired_state_definition['Name']
         self.hosted_zone = self.desired_state_definition['HostedZoneId']
+        # records of the same field, see link_batch
+        self.batch_particles = [self]
+        # pcf_id of EC2 parents to (ip, lookup time) and the resource records derived from them
+        self._parent_ips = {}
+        self._derived_records = None
 
         self._set_unique_keys()
 
+    @classmethod
+    def link_batch(cls, particles):
+        """
+        Records of a field submit their changes together when they are in the same hosted zone
+        """
+        for particle in particles:
+            particle.batch_particles = particles
+
     def _set_unique_keys(self):
         """
         Logic that sets keys from state definition that are used to uniquely identify the Route53 Record
@@ -74,32 +95,28 @@ class Route53Record(AWSResource):
 
     def get_status(self):
         """
-        Get the current status of your route 53 record set
+        Get the current status of your route 53 record set from the shared index of its hosted zone, matched by name,
+        type and set identifier
 
-        :return: list of record sets sorted by record name
+        :return: list with the matching record set, empty when there is none
         """
-        try:
-            service_status_resp = self.client.list_resource_record_sets(HostedZoneId=self.hosted_zone,StartRecordName=self.record_name)
-        except ClientError as e:
-            if e.response["Error"]["Code"] == 'NoSuchHostedZone':
-                return []
-        else:
-            return service_status_resp.get('ResourceRecordSets', [])
+        record_set = ZoneRecordIndex.for_particle(self).get(
+            self.record_name, self.desired_state_definition.get('Type'), self.desired_state_definition.get('SetIdentifier')
+        )
+        return [record_set] if record_set else []
 
     def sync_state(self):
         """
         Sync state calls get_status to determines and set the state of the route53 record set particle.
         """
+        ZoneChangeCoalescer.for_particle(self).forget(self)
         full_status = self.get_status()
         if len(full_status) == 0:
             self.state = State.terminated
             self.current_state_definition = {}
         else:
-            self.current_state_definition = full_status[0] ##returns first item in ResourceRecordSets, if record_name exists then it would be in index 0
-            if full_status[0].get('Name') == self.record_name:
-                self.state = State.running
-            else:
-                self.state = State.terminated
+            self.current_state_definition = full_status[0]
+            self.state = State.running
 
     def _terminate(self):
         """
@@ -107,14 +124,7 @@ class Route53Record(AWSResource):
 
         :return: response of boto3 change resource record set with action DELETE
         """
-        change_entry = {
-            'Action':'DELETE',
-            'ResourceRecordSet':self.current_state_definition,
-        }
-        change_batch = {
-            'Changes':[change_entry],
-        }
-        return self.client.change_resource_record_sets(HostedZoneId=self.hosted_zone,ChangeBatch=change_batch)
+        return self.change('DELETE', self.current_state_definition)
 
     def _start(self):
         """
@@ -129,16 +139,8 @@ class Route53Record(AWSResource):
 
         start_definition = pcf_util.keep_and_remove_keys(desired_state_def, Route53Record.REMOVE_PARAM_CONVERSIONS)
 
-        change_entry = {
-            'Action':'CREATE',
-            'ResourceRecordSet':start_definition,
-        }
-
         #TTL, Name including zone ending, type required
-        change_batch = {
-            'Changes':[change_entry],
-        }
-        return self.client.change_resource_record_sets(HostedZoneId=self.hosted_zone,ChangeBatch=change_batch)
+        return self.change('CREATE', start_definition)
 
 
     def _stop(self):
@@ -161,14 +163,45 @@ class Route53Record(AWSResource):
 
         update_definition = pcf_util.keep_and_remove_keys(desired_state_def, Route53Record.REMOVE_PARAM_CONVERSIONS)
 
-        change_entry = {
-            'Action':'UPSERT',
-            'ResourceRecordSet':update_definition,
-        }
-        change_batch = {
-            'Changes':[change_entry],
-        }
-        return self.client.change_resource_record_sets(HostedZoneId=self.hosted_zone,ChangeBatch=change_batch)
+        return self.change('UPSERT', update_definition)
+
+    def change(self, action, record_set):
+        """
+        Submits a change of this record together with the pending changes of the other records of the field in the
+        hosted zone
+
+        :param action: CREATE, UPSERT or DELETE
+        :param record_set: resource record set of the change
+        :return: response of boto3 change resource record sets of the batch that contained the change
+        """
+        response = ZoneChangeCoalescer.for_particle(self).change(self, action, record_set)
+        if self.custom_config.get("wait_for_sync"):
+            ZoneChangeCoalescer.for_particle(self).wait_for_sync(response['ChangeInfo']['Id'])
+        return response
+
+    def get_pending_change(self):
+        """
+        Determines the change apply() would submit to reach the desired state. Records with parents or callbacks are
+        left to their own apply().
+
+        :return: (action, record set) or None
+        """
+        if not self.desired_state or self.parents or self.callbacks:
+            return None
+
+        state = self.get_state()
+        if self.desired_state == State.running:
+            desired_state_def = self.get_desired_state_definition()
+            if not list(desired_state_def.get("ResourceRecords")):
+                return None
+            record_set = pcf_util.keep_and_remove_keys(desired_state_def, Route53Record.REMOVE_PARAM_CONVERSIONS)
+            if state == State.terminated:
+                return 'CREATE', record_set
+            if not self.is_state_definition_equivalent():
+                return 'UPSERT', record_set
+        elif state == State.running and not self.persist_on_termination:
+            return 'DELETE', self.current_state_definition
+        return None
 
     def is_state_equivalent(self, state1, state2):
         """
@@ -200,30 +233,299 @@ class Route53Record(AWSResource):
             logger.debug("State is not equivalent for {0} with diff: {1}".format(self.get_pcf_id(), json.dumps(diff)))
             return False
 
+    def get_parent_ips(self, ec2_instance_parents):
+        """
+        Private ips of the EC2 instance parents. A parent with a fresh cached state answers from it, the others are
+        looked up together with EC2Instance.get_private_ips and remembered for state_cache_ttl.
+
+        :param ec2_instance_parents: EC2Instance parents
+        :return: list of ips in the order of the parents, None for parents without an instance
+        """
+        now = time.time()
+        stale = []
+        for parent in ec2_instance_parents:
+            if parent.state_last_refresh_time and not parent.state_dirty and parent.current_state_definition and \
+                    now - parent.state_last_refresh_time <= parent.state_cache_ttl:
+                self._parent_ips[parent.pcf_id] = (parent.current_state_definition.get("PrivateIpAddress"), now)
+            else:
+                cached = self._parent_ips.get(parent.pcf_id)
+                if cached is None or now - cached[1] > self.state_cache_ttl:
+                    stale.append(parent)
+        if stale:
+            for pcf_id, ip in EC2Instance.get_private_ips(stale).items():
+                self._parent_ips[pcf_id] = (ip, now)
+        return [self._parent_ips[parent.pcf_id][0] for parent in ec2_instance_parents]
+
     def get_desired_state_definition(self):
         """
         Returns the desires state definition. If Route53 Record has parents that are EC2 instances then ip addresses of those instances are automatically added to the resource_records in the
-        desired state definition.
+        desired state definition. The resource records are only rebuilt when an ip changed, see get_parent_ips.
 
         :return: desired_state_definition
         """
         record_type = self.desired_state_definition.get("Type")
         if record_type == "A" and len(self.parents) > 0:
-            ec2_instance_parents = list(filter(lambda x: isinstance(x, EC2Instance), self.parents))
+            ec2_instance_parents = sorted(filter(lambda x: isinstance(x, EC2Instance), self.parents), key=lambda x: x.pcf_id)
 
             if len(ec2_instance_parents) > 0:
-                resource_records = list(self.desired_state_definition.get("ResourceRecords"))
-                existing_records = set(x["Value"] for x in resource_records)
-
-                for ec2_instance in ec2_instance_parents:
-                    ec2_instance.sync_state()
-                    ec2_ip = ec2_instance.get_attribute_value("PrivateIpAddress")
-                    if ec2_ip not in existing_records:
-                        resource_records.append({"Value": ec2_ip})
-
-                return {**self.desired_state_definition, "ResourceRecords": resource_records}
+                resource_records = self.desired_state_definition.get("ResourceRecords")
+                key = (tuple(self.get_parent_ips(ec2_instance_parents)), json.dumps(resource_records, sort_keys=True))
+                if self._derived_records is None or self._derived_records[0] != key:
+                    derived_records = list(resource_records)
+                    existing_records = set(x["Value"] for x in derived_records)
+                    for ec2_ip in key[0]:
+                        if ec2_ip and ec2_ip not in existing_records:
+                            existing_records.add(ec2_ip)
+                            derived_records.append({"Value": ec2_ip})
+                    self._derived_records = (key, derived_records)
+
+                return {**self.desired_state_definition, "ResourceRecords": list(self._derived_records[1])}
             else:
                 return self.desired_state_definition
 
         else:
             return self.desired_state_definition
+
+
+class ZoneChangeCoalescer(object):
+    """
+    Submits the record changes of a hosted zone in as few change batches as the API limits allow. The first record
+    of a field that changes collects the pending changes of the other records of its field in the zone, submits them
+    together and marks them dirty so they sync and find their change done. A batch is atomic, so when it fails the
+    change is retried on its own and the other records change themselves. Propagation is awaited once per batch.
+    """
+
+    # a batch can hold 1000 record sets with 32000 characters of values, an UPSERT counts twice
+    MAX_RECORD_SETS = 1000
+    MAX_VALUE_CHARACTERS = 32000
+    SYNC_POLL_INTERVAL = 2
+
+    _coalescers = {}
+    _coalescers_lock = threading.Lock()
+
+    def __init__(self, client, hosted_zone, index=None):
+        """
+        :param client: route53 client
+        :param hosted_zone: hosted zone id
+        :param index: ZoneRecordIndex of the zone, invalidated after changes
+        """
+        self.client = client
+        self.hosted_zone = hosted_zone
+        self.index = index or ZoneRecordIndex(client, hosted_zone)
+        # responses of changes submitted on behalf of records, by record. Records are weak keys so an entry cannot
+        # outlive its record and be picked up by another record.
+        self.submitted = weakref.WeakKeyDictionary()
+        self.insync = set()
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+
+    @classmethod
+    def for_particle(cls, particle):
+        """
+        :return: the shared coalescer of the hosted zone and session of the record
+        """
+        key = (particle.hosted_zone, particle.session)
+        coalescer = cls._coalescers.get(key)
+        if coalescer is None:
+            with cls._coalescers_lock:
+                coalescer = cls._coalescers.setdefault(
+                    key, cls(particle.client, particle.hosted_zone, ZoneRecordIndex.for_particle(particle))
+                )
+        return coalescer
+
+    @staticmethod
+    def _weight(change):
+        multiplier = 2 if change['Action'] == 'UPSERT' else 1
+        record_set = change['ResourceRecordSet']
+        characters = sum(len(str(record.get('Value', ''))) for record in record_set.get('ResourceRecords', []))
+        return multiplier, multiplier * characters
+
+    def _batches(self, changes):
+        """
+        Splits (record, change) pairs into batches within the API limits
+        """
+        batch, record_sets, characters = [], 0, 0
+        for record, change in changes:
+            weight, change_characters = self._weight(change)
+            if batch and (record_sets + weight > self.MAX_RECORD_SETS or
+                          characters + change_characters > self.MAX_VALUE_CHARACTERS):
+                yield batch
+                batch, record_sets, characters = [], 0, 0
+            batch.append((record, change))
+            record_sets += weight
+            characters += change_characters
+        if batch:
+            yield batch
+
+    def _collect(self, particle):
+        """
+        :return: (record, change) pairs of the other records of the field in the zone with a pending change
+        """
+        changes = []
+        for other in particle.batch_particles:
+            if other is particle or other.hosted_zone != self.hosted_zone or other.session is not particle.session:
+                continue
+            if other in self.submitted:
+                continue
+            try:
+                pending_change = other.get_pending_change()
+            except Exception as e:
+                logger.debug("{0} changes on its own: {1}".format(other.pcf_id, e))
+                continue
+            if pending_change:
+                action, record_set = pending_change
+                changes.append((other, {'Action': action, 'ResourceRecordSet': record_set}))
+        return changes
+
+    def _submit(self, batch):
+        try:
+            response = self.client.change_resource_record_sets(
+                HostedZoneId=self.hosted_zone, ChangeBatch={'Changes': [change for _record, change in batch]}
+            )
+        finally:
+            self.index.invalidate()
+        for record, _change in batch:
+            self.submitted[record] = response
+            record.state_dirty = True
+        return response
+
+    def change(self, particle, action, record_set):
+        """
+        Submits a change of a record with the pending changes of the other records of its field
+
+        :param particle: Route53Record
+        :param action: CREATE, UPSERT or DELETE
+        :param record_set: resource record set
+        :return: response of boto3 change resource record sets of the batch that contained the change
+        """
+        with self._lock:
+            # another record already submitted this change
+            response = self.submitted.pop(particle, None)
+            if response is not None:
+                return response
+
+            changes = [(particle, {'Action': action, 'ResourceRecordSet': record_set})] + self._collect(particle)
+            batches = list(self._batches(changes))
+            logger.info("Submitting {0} changes to {1} in {2} batches".format(len(changes), self.hosted_zone, len(batches)))
+            response = None
+            for batch in batches:
+                # the change of particle is always the first of the first batch
+                contains_particle = batch[0][0] is particle
+                try:
+                    batch_response = self._submit(batch)
+                except ClientError as e:
+                    if not contains_particle:
+                        logger.debug("Batch of {0} changes failed, the records change on their own: {1}".format(len(batch), e))
+                        continue
+                    if len(batch) == 1:
+                        raise e
+                    logger.debug("Batch of {0} changes failed, retrying the change of {1}: {2}".format(
+                        len(batch), particle.pcf_id, e))
+                    batch_response = self._submit(batch[:1])
+                if contains_particle:
+                    response = batch_response
+            self.submitted.pop(particle, None)
+            return response
+
+    def forget(self, particle):
+        """
+        Drops a change submitted on behalf of a record once the record synced and can see it
+
+        :param particle: Route53Record
+        """
+        self.submitted.pop(particle, None)
+
+    def wait_for_sync(self, change_id):
+        """
+        Waits until a change is INSYNC. Records of one batch share the change id and its get_change polls.
+
+        :param change_id: id of the change
+        """
+        with self._sync_lock:
+            while change_id not in self.insync:
+                status = self.client.get_change(Id=change_id)['ChangeInfo']['Status']
+                if status == 'INSYNC':
+                    self.insync.add(change_id)
+                else:
+                    time.sleep(self.SYNC_POLL_INTERVAL)
+
+
+class ZoneRecordIndex(object):
+    """
+    Snapshot of all record sets of a hosted zone indexed by name, type and set identifier. The zone is paged through
+    at most once per ttl and every record of the zone syncs from the snapshot. Changes submitted by PCF invalidate it.
+    """
+
+    _indexes = {}
+    _indexes_lock = threading.Lock()
+
+    def __init__(self, client, hosted_zone, ttl=15):
+        """
+        :param client: route53 client
+        :param hosted_zone: hosted zone id
+        :param ttl: seconds a snapshot is used for
+        """
+        self.client = client
+        self.hosted_zone = hosted_zone
+        self.ttl = ttl
+        self.records = {}
+        self.refresh_time = None
+        # changes since the snapshot started, a snapshot taken during a change is outdated
+        self.generation = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_particle(cls, particle):
+        """
+        :return: the shared index of the hosted zone and session of the record
+        """
+        key = (particle.hosted_zone, particle.session)
+        index = cls._indexes.get(key)
+        if index is None:
+            with cls._indexes_lock:
+                index = cls._indexes.setdefault(key, cls(particle.client, particle.hosted_zone))
+        return index
+
+    @staticmethod
+    def _key(name, record_type, set_identifier=None):
+        # route53 returns special characters as octal escapes, ie \\052 for *
+        name = re.sub(r'\\(\d{3})', lambda match: chr(int(match.group(1), 8)), name).lower()
+        if not name.endswith('.'):
+            name = name + '.'
+        return name, record_type, set_identifier
+
+    def refresh(self):
+        """
+        Pages through all record sets of the zone. A missing zone has no records.
+        """
+        generation = self.generation
+        records = {}
+        try:
+            for page in self.client.get_paginator('list_resource_record_sets').paginate(HostedZoneId=self.hosted_zone):
+                for record_set in page.get('ResourceRecordSets', []):
+                    records[self._key(record_set['Name'], record_set['Type'], record_set.get('SetIdentifier'))] = record_set
+        except ClientError as e:
+            if e.response["Error"]["Code"] != 'NoSuchHostedZone':
+                raise e
+        self.records = records
+        if generation == self.generation:
+            self.refresh_time = time.time()
+
+    def invalidate(self):
+        """
+        Makes the next lookup page through the zone again
+        """
+        self.generation += 1
+        self.refresh_time = None
+
+    def get(self, name, record_type, set_identifier=None):
+        """
+        :param name: record name
+        :param record_type: record type, ie A
+        :param set_identifier: set identifier of weighted, latency or failover records
+        :return: the record set or None
+        """
+        with self._lock:
+            if self.refresh_time is None or time.time() - self.refresh_time > self.ttl:
+                self.refresh()
+            return self.records.get(self._key(name, record_type, set_identifier))
@@ -12,14 +12,34 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import datetime
+import logging
+import threading
+import time
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from pcf.core import State
+from pcf.core.pcf_exceptions import ObjectDeleteException
 from pcf.util import pcf_util
 from pcf.core.aws_resource import AWSResource
+from pcf.util.aws import s3_sync, s3_transfer
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger(__name__)
 
 
 class S3Bucket(AWSResource):
     """
     This is the implementation of Amazon's S3 service.
+
+    Objects are transferred in parts on thread pools shared by all buckets with the same client. custom_config
+    transfer_part_size and transfer_concurrency tune the transfers and verify_checksums set to False skips the sha256
+    verification.
+
+    Buckets with objects can only be terminated with custom_config force_delete, which deletes all object versions
+    and delete markers first. delete_concurrency sets the number of delete_objects calls running at the same time.
+
+    Buckets of a field sync from the shared BucketInventory of their account, a bucket on its own uses head_bucket.
     """
     flavor = "s3_bucket"
     state_lookup = {
@@ -47,11 +67,25 @@ class S3Bucket(AWSResource):
 
     UNIQUE_KEYS = ["aws_resource.Bucket"]
 
+    # keys per delete_objects call
+    DELETE_BATCH_SIZE = 1000
+    DELETE_ATTEMPTS = 5
+
     def __init__(self, particle_definition, session=None):
         super().__init__(particle_definition=particle_definition, resource_name="s3", session=session)
         self.bucket_name = self.desired_state_definition["Bucket"]
+        # buckets of the same field, see link_batch
+        self.batch_particles = [self]
         self._set_unique_keys()
 
+    @classmethod
+    def link_batch(cls, particles):
+        """
+        Buckets of a field share the bucket inventory of their account instead of checking each bucket on its own
+        """
+        for particle in particles:
+            particle.batch_particles = particles
+
     def _set_unique_keys(self):
         """
         Logic that sets keys from state definition that are used to uniquely identify the S3 Bucket
@@ -60,23 +94,103 @@ class S3Bucket(AWSResource):
 
     def get_status(self):
         """
-        Determines if the bucket exists
+        Determines if the bucket exists, from the bucket inventory when the bucket is part of a field and with
+        head_bucket otherwise
         Returns:
              status (dict)
         """
-        bucket_object = self.resource.Bucket(self.bucket_name)
-        if bucket_object.creation_date:
+        if len(self.batch_particles) > 1:
+            exists = BucketInventory.for_particle(self).get(self.bucket_name) is not None
+        else:
+            exists = self._head_bucket()
+        if exists:
             return {"status":"active"}
         else:
             return {"status": "missing"}
 
+    def _head_bucket(self):
+        """
+        Returns:
+            True if the bucket exists, False if it does not
+
+        Raises:
+            ClientError when the bucket exists but is not accessible, ie it belongs to another account
+        """
+        try:
+            self.client.head_bucket(Bucket=self.bucket_name)
+            return True
+        except ClientError as e:
+            code = e.response["Error"]["Code"]
+            if code in ("404", "NoSuchBucket"):
+                return False
+            if code in ("403", "AccessDenied"):
+                logger.warning("S3 bucket {0} exists but is not accessible, it may belong to another account".format(
+                    self.bucket_name))
+            raise e
+
     def _terminate(self):
         """
-        Deletes the S3 bucket
+        Deletes the S3 bucket, emptied first when custom_config force_delete is set
         Returns:
              response of boto3 delete_bucket
         """
-        return self.client.delete_bucket(Bucket=self.bucket_name)
+        if self.custom_config.get("force_delete"):
+            self.empty()
+        response = self.client.delete_bucket(Bucket=self.bucket_name)
+        BucketInventory.for_particle(self).discard(self.bucket_name)
+        return response
+
+    def _delete_batch(self, objects):
+        """
+        Deletes up to 1000 object versions with delete_objects and retries the ones that failed
+        Args:
+            objects (list): dicts with Key and VersionId
+        Returns:
+            number of deleted versions
+        """
+        count = len(objects)
+        for attempt in range(S3Bucket.DELETE_ATTEMPTS):
+            if attempt:
+                time.sleep(min(2 ** attempt, 10))
+            errors = self.client.delete_objects(
+                Bucket=self.bucket_name, Delete={"Objects": objects, "Quiet": True}
+            ).get("Errors", [])
+            if not errors:
+                return count
+            failed = set((error["Key"], error.get("VersionId")) for error in errors)
+            objects = [obj for obj in objects if (obj["Key"], obj.get("VersionId")) in failed]
+            logger.debug("Retrying the delete of {0} objects of {1}".format(len(objects), self.bucket_name))
+        raise ObjectDeleteException(self.bucket_name, errors)
+
+    def empty(self):
+        """
+        Deletes every object version and delete marker of the bucket. Versions are streamed from a paginated
+        list_object_versions and deleted in batches of 1000 by concurrent delete_objects calls. The bucket is listed
+        again until a listing finds nothing, which also removes objects written while it was emptied.
+        Returns:
+            number of deleted versions and delete markers
+        """
+        max_workers = self.custom_config.get("delete_concurrency", 10)
+        deleted = 0
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while True:
+                pending = set()
+                listed = 0
+                for page in self.client.get_paginator("list_object_versions").paginate(Bucket=self.bucket_name):
+                    objects = [{"Key": version["Key"], "VersionId": version["VersionId"]}
+                               for version in page.get("Versions", []) + page.get("DeleteMarkers", [])]
+                    listed += len(objects)
+                    for i in range(0, len(objects), S3Bucket.DELETE_BATCH_SIZE):
+                        # only a few batches are listed ahead of the deletes
+                        while len(pending) >= 2 * max_workers:
+                            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                            deleted += sum(future.result() for future in done)
+                        pending.add(executor.submit(self._delete_batch, objects[i:i + S3Bucket.DELETE_BATCH_SIZE]))
+                deleted += sum(future.result() for future in pending)
+                if not listed:
+                    break
+        logger.info("Deleted {0} object versions of {1}".format(deleted, self.bucket_name))
+        return deleted
 
     def _start(self):
         """
@@ -87,6 +201,7 @@ class S3Bucket(AWSResource):
         """
         create_definition = pcf_util.param_filter(self.get_desired_state_definition(), S3Bucket.START_PARAMS_FILTER)
         response = self.client.create_bucket(**create_definition)
+        BucketInventory.for_particle(self).add(self.bucket_name)
 
         if self.custom_config.get("Tags"):
             tags = self.custom_config.get("Tags")
@@ -131,6 +246,108 @@ class S3Bucket(AWSResource):
         """
         pass
 
+    def _transfer_args(self, part_size, max_concurrency, verify):
+        return {
+            "part_size": part_size or self.custom_config.get("transfer_part_size", s3_transfer.DEFAULT_PART_SIZE),
+            "max_concurrency": max_concurrency or self.custom_config.get("transfer_concurrency",
+                                                                         s3_transfer.DEFAULT_CONCURRENCY),
+            "verify": self.custom_config.get("verify_checksums", True) if verify is None else verify,
+        }
+
+    def upload_file(self, filename, key, extra_args=None, callback=None, part_size=None, max_concurrency=None,
+                    verify=None):
+        """
+        Uploads a file to the bucket, see s3_transfer.upload
+        Args:
+            filename (str): path of the file
+            key (str): object key
+            extra_args (dict): ExtraArgs of boto3 upload_file, ie ContentType
+            callback (function): called with the number of bytes transferred since the last call
+            part_size (int): bytes per part, defaults to custom_config transfer_part_size
+            max_concurrency (int): parts uploaded at the same time, defaults to custom_config transfer_concurrency
+            verify (bool): tag the object with its sha256, defaults to custom_config verify_checksums
+        Returns:
+            sha256 hex digest of the file, None without verify
+        """
+        return s3_transfer.upload(self.client, self.bucket_name, key, filename, extra_args=extra_args,
+                                  callback=callback, **self._transfer_args(part_size, max_concurrency, verify))
+
+    def upload_fileobj(self, fileobj, key, extra_args=None, callback=None, part_size=None, max_concurrency=None,
+                       verify=None):
+        """
+        Uploads a file object or streams an iterable of bytes, ie a generator, to the bucket, see s3_transfer.upload
+        Args:
+            fileobj (file object or iterable): readable file object or iterable of bytes
+            key (str): object key
+            extra_args (dict): ExtraArgs of boto3 upload_fileobj, ie ContentType
+            callback (function): called with the number of bytes transferred since the last call
+            part_size (int): bytes per part, defaults to custom_config transfer_part_size
+            max_concurrency (int): parts uploaded at the same time, defaults to custom_config transfer_concurrency
+            verify (bool): tag the object with its sha256, defaults to custom_config verify_checksums
+        Returns:
+            sha256 hex digest of the uploaded bytes, None without verify
+        """
+        return s3_transfer.upload(self.client, self.bucket_name, key, fileobj, extra_args=extra_args,
+                                  callback=callback, **self._transfer_args(part_size, max_concurrency, verify))
+
+    def download_file(self, key, filename, extra_args=None, callback=None, part_size=None, max_concurrency=None,
+                      verify=None):
+        """
+        Downloads an object of the bucket to a file, see s3_transfer.download
+        Args:
+            key (str): object key
+            filename (str): path of the file
+            extra_args (dict): ExtraArgs of boto3 download_file, ie VersionId
+            callback (function): called with the number of bytes transferred since the last call
+            part_size (int): bytes per ranged get, defaults to custom_config transfer_part_size
+            max_concurrency (int): parts downloaded at the same time, defaults to custom_config transfer_concurrency
+            verify (bool): check the sha256 tag of the object, defaults to custom_config verify_checksums
+        Returns:
+            sha256 hex digest of the file, None when it was not verified
+        """
+        return s3_transfer.download(self.client, self.bucket_name, key, filename, extra_args=extra_args,
+                                    callback=callback, **self._transfer_args(part_size, max_concurrency, verify))
+
+    def download_fileobj(self, key, fileobj, extra_args=None, callback=None, part_size=None, max_concurrency=None,
+                         verify=None):
+        """
+        Downloads an object of the bucket to a file object, see s3_transfer.download
+        Args:
+            key (str): object key
+            fileobj (file object): writable file object
+            extra_args (dict): ExtraArgs of boto3 download_fileobj, ie VersionId
+            callback (function): called with the number of bytes transferred since the last call
+            part_size (int): bytes per ranged get, defaults to custom_config transfer_part_size
+            max_concurrency (int): parts downloaded at the same time, defaults to custom_config transfer_concurrency
+            verify (bool): check the sha256 tag of the object, defaults to custom_config verify_checksums
+        Returns:
+            sha256 hex digest of the downloaded bytes, None when they were not verified
+        """
+        return s3_transfer.download(self.client, self.bucket_name, key, fileobj, extra_args=extra_args,
+                                    callback=callback, **self._transfer_args(part_size, max_concurrency, verify))
+
+    def sync(self, local_dir, prefix="", delete=False, manifest_path=None, max_workers=8, part_size=None,
+             max_concurrency=None, verify=None):
+        """
+        Uploads the files of a local directory that are missing or changed below a prefix of the bucket, see
+        s3_sync.sync. Local ETags are cached in a manifest so unchanged files are not hashed again.
+        Args:
+            local_dir (str): directory
+            prefix (str): key prefix the directory maps to
+            delete (bool): delete objects below prefix without a local file
+            manifest_path (str): path of the local manifest, defaults to a manifest of the directory, bucket and
+                prefix below the pcf cache directory
+            max_workers (int): files hashed and uploaded at the same time
+            part_size (int): bytes per part, defaults to custom_config transfer_part_size
+            max_concurrency (int): parts uploaded at the same time, defaults to custom_config transfer_concurrency
+            verify (bool): tag the objects with their sha256, defaults to custom_config verify_checksums
+        Returns:
+            dict with the uploaded and deleted keys and the number of unchanged files
+        """
+        return s3_sync.sync(self.client, self.bucket_name, local_dir, prefix=prefix, delete=delete,
+                            manifest_path=manifest_path, max_workers=max_workers,
+                            **self._transfer_args(part_size, max_concurrency, verify))
+
     def is_state_equivalent(self, state1, state2):
         """
         Determines if states are equivalent. Uses equivalent_states defined in the S3Bucket class.
@@ -141,3 +358,106 @@ class S3Bucket(AWSResource):
             bool
         """
         return S3Bucket.equivalent_states.get(state1) == S3Bucket.equivalent_states.get(state2)
+
+
+class BucketInventory(object):
+    """
+    Names and creation dates of all buckets of an account. ListBuckets is called at most once per ttl and every
+    bucket of a field in the account syncs from the result. Buckets created or deleted by PCF update it in place.
+    """
+
+    _inventories = {}
+    _inventories_lock = threading.Lock()
+
+    def __init__(self, client, ttl=15):
+        """
+        Args:
+            client: s3 client
+            ttl (int): seconds a listing is used for
+        """
+        self.client = client
+        self.ttl = ttl
+        self.buckets = {}
+        self.refresh_time = None
+        # buckets created or deleted while a listing is running, applied on top of the listing
+        self._changes = None
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    @classmethod
+    def for_particle(cls, particle):
+        """
+        Returns:
+            the shared inventory of the session of the bucket. ListBuckets lists the buckets of every region of the
+            account, so buckets of all regions share one inventory.
+        """
+        key = particle.session
+        inventory = cls._inventories.get(key)
+        if inventory is None:
+            with cls._inventories_lock:
+                inventory = cls._inventories.setdefault(key, cls(particle.client))
+        return inventory
+
+    def refresh(self):
+        """
+        Lists all buckets of the account
+        """
+        with self._lock:
+            self._changes = {}
+        try:
+            buckets = {bucket["Name"]: bucket["CreationDate"] for bucket in self.client.list_buckets().get("Buckets", [])}
+        except Exception:
+            with self._lock:
+                self._changes = None
+            raise
+        with self._lock:
+            for bucket_name, creation_date in self._changes.items():
+                if creation_date is None:
+                    buckets.pop(bucket_name, None)
+                else:
+                    buckets[bucket_name] = creation_date
+            self._changes = None
+            self.buckets = buckets
+            self.refresh_time = time.time()
+
+    def _record(self, bucket_name, creation_date):
+        with self._lock:
+            if self._changes is not None:
+                self._changes[bucket_name] = creation_date
+            if creation_date is None:
+                self.buckets.pop(bucket_name, None)
+            else:
+                self.buckets[bucket_name] = creation_date
+
+    def add(self, bucket_name):
+        """
+        Records a bucket created by PCF
+        """
+        self._record(bucket_name, self.buckets.get(bucket_name) or datetime.datetime.now(datetime.timezone.utc))
+
+    def discard(self, bucket_name):
+        """
+        Records a bucket deleted by PCF
+        """
+        self._record(bucket_name, None)
+
+    def invalidate(self):
+        """
+        Makes the next lookup list the buckets again
+        """
+        self.refresh_time = None
+
+    def get(self, bucket_name):
+        """
+        Args:
+            bucket_name (str): bucket name
+
+        Returns:
+            creation date of the bucket or None
+        """
+        if self.refresh_time is None or time.time() - self.refresh_time > self.ttl:
+            with self._refresh_lock:
+                # another particle may have listed the buckets while this one waited
+                if self.refresh_time is None or time.time() - self.refresh_time > self.ttl:
+                    self.refresh()
+        return self.buckets.get(bucket_name)
@@ -12,9 +12,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import io
+
 from pcf.core.quasiparticle import Quasiparticle
 from pcf.particle.gcp.storage.bucket import Bucket
 from pcf.particle.aws.s3.s3_bucket import S3Bucket
+from pcf.util.aws import s3_transfer
 
 
 class CrossCloudStorage(Quasiparticle):
@@ -46,14 +49,21 @@ class CrossCloudStorage(Quasiparticle):
     def put_object(self, Bucket, Key, Body=None, Filename=None):
         """
         Puts a file or object in the GCP Storage bucket AWS S3 Bucket
+
+        Args:
+            Bucket (str): S3 bucket name
+            Key (str): object key and blob name
+            Body (bytes or str): content of the object, str is encoded as utf-8
+            Filename (str): path of a file to upload instead of Body
         """
         if Body:
-            self.s3.client.put_object(Bucket=Bucket, Key="test-object",Body=Body)
-            self.storage.put_object(blob_name="test-object",file_obj=Body)
+            if isinstance(Body, str):
+                Body = Body.encode("utf-8")
+            s3_transfer.upload(self.s3.client, Bucket, Key, io.BytesIO(Body), verify=False)
+            self.storage.put_object(blob_name=Key, file_obj=Body)
         elif Filename:
-            self.s3.resource.Bucket(Bucket).upload_file(Key="test-file", Filename=Filename)
-            self.storage.put_file(blob_name="test-file", file=Filename)
-
+            s3_transfer.upload(self.s3.client, Bucket, Key, Filename, verify=False)
+            self.storage.put_file(blob_name=Key, file=Filename)
 
     def delete_object(self, Bucket, Key):
         """
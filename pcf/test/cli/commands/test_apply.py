@@ -1,5 +1,6 @@
 """ Tests for pcf apply command """
 
+import os
 import pytest
 from mock import patch
 from pcf.cli.commands.apply import apply
@@ -80,3 +81,33 @@ class TestApply:
             assert expected in result.output
             assert result.exit_code == 0
             assert apply_mock.called
+
+    @patch.object(EC2Instance, "apply", return_value=None)
+    @pytest.mark.parametrize("config_file", ["pcf.json", "pcf.yml"])
+    def test_apply_no_cache(
+        self, apply_mock, config_file, cli_runner, copy_pcf_config_file, config_cache_dir
+    ):
+        """ Ensure the parsed config is cached unless the --no-cache flag is given """
+
+        with cli_runner.isolated_filesystem():
+            copy_pcf_config_file(config_file)
+            result = cli_runner.invoke(apply, [self.particle_pcf_name, "--no-cache"])
+            assert result.exit_code == 0
+            assert not os.path.isdir(config_cache_dir)
+
+            result = cli_runner.invoke(apply, [self.particle_pcf_name])
+            assert result.exit_code == 0
+            assert len(os.listdir(config_cache_dir)) == 1
+            assert apply_mock.called
+
+    @patch.object(EC2Instance, "apply", return_value=None)
+    def test_apply_metrics_file(self, apply_mock, cli_runner, copy_pcf_config_file):
+        """ Ensure metrics are written in the Prometheus text format with --metrics-file """
+
+        with cli_runner.isolated_filesystem():
+            copy_pcf_config_file("pcf.json")
+            result = cli_runner.invoke(apply, [self.particle_pcf_name, "--metrics-file", "metrics/pcf.prom"])
+            assert result.exit_code == 0
+
+            with open("metrics/pcf.prom") as metrics_file:
+                assert "# TYPE pcf_transitions_total counter" in metrics_file.read()
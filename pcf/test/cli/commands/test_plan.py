@@ -0,0 +1,59 @@
+""" Tests for pcf plan command """
+
+import json
+import pytest
+from mock import patch
+from pcf.cli.commands.plan import plan
+from pcf.particle.aws.ec2.ec2_instance import EC2Instance
+
+PLAN = {
+    "pcf_id": "ec2_instance:test_ec2",
+    "flavor": "ec2_instance",
+    "current_state": "terminated",
+    "desired_state": "running",
+    "action": "start",
+    "diff": {},
+}
+
+
+class TestPlan:
+    """ Test 'pcf plan' command against a particle from a file """
+
+    particle_pcf_name = "test_ec2"
+
+    @patch.object(EC2Instance, "plan", return_value=PLAN)
+    @pytest.mark.parametrize("config_file", ["pcf.json", "pcf.yml"])
+    def test_plan(self, plan_mock, config_file, cli_runner, copy_pcf_config_file):
+        """ Ensure the plan command prints the action for the particle without applying """
+
+        with cli_runner.isolated_filesystem():
+            copy_pcf_config_file(config_file)
+            with patch.object(EC2Instance, "apply") as apply_mock:
+                result = cli_runner.invoke(plan, [self.particle_pcf_name])
+
+            assert result.exit_code == 0
+            assert "ec2_instance:test_ec2: start (terminated -> running)" in result.output
+            assert plan_mock.called
+            assert not apply_mock.called
+
+    @patch.object(EC2Instance, "plan", return_value=PLAN)
+    def test_plan_json(self, plan_mock, cli_runner, copy_pcf_config_file):
+        """ Ensure the plan command prints the plan as JSON with --json """
+
+        with cli_runner.isolated_filesystem():
+            copy_pcf_config_file("pcf.json")
+            result = cli_runner.invoke(plan, [self.particle_pcf_name, "--json"])
+
+            assert result.exit_code == 0
+            assert json.loads(result.output) == [PLAN]
+
+    @patch.object(EC2Instance, "plan", side_effect=Exception("access denied"))
+    def test_plan_error(self, plan_mock, cli_runner, copy_pcf_config_file):
+        """ Ensure particles that fail to sync are reported instead of failing the plan """
+
+        with cli_runner.isolated_filesystem():
+            copy_pcf_config_file("pcf.json")
+            result = cli_runner.invoke(plan, [self.particle_pcf_name])
+
+            assert result.exit_code == 0
+            assert "ec2_instance:test_ec2: error (access denied)" in result.output
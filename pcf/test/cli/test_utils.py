@@ -1,6 +1,9 @@
 """ Tests for the utility functions used by the PCF CLI """
 
 import os
+import json
+import boto3
+import moto
 import pytest
 from mock import patch
 from pcf.cli.utils import *
@@ -12,6 +15,7 @@ from pcf.particle.aws.ec2 import elb
 from pcf.particle.aws.ec2.ec2_instance import EC2Instance
 from pcf.quasiparticle.aws.ecs_instance_quasi.ecs_instance_quasi import ECSInstanceQuasi
 from pcf.core.pcf_exceptions import MaxTimeoutException
+from pcf.util import metrics
 
 
 class TestUtils:
@@ -277,3 +281,117 @@ class TestUtils:
                 assert sys_exit.value.code == 1
                 assert apply_mock.called
                 assert "Error: Max timeout of 50 seconds reached" in stdout
+
+    @staticmethod
+    @patch.object(EC2Instance, "apply", return_value=None)
+    def test_execute_applying_command_parallel(apply_mock, cli_runner, capsys):
+        """ Ensure --parallel applies every particle and prints a timing table """
+        with cli_runner.isolated_filesystem():
+            with open("fleet.json", "w") as config_file:
+                json.dump(
+                    [
+                        {
+                            "pcf_name": "ec2-{}".format(i),
+                            "flavor": "ec2_instance",
+                            "aws_resource": {"custom_config": {"instance_name": "ec2-{}".format(i)}},
+                        }
+                        for i in range(4)
+                    ],
+                    config_file,
+                )
+
+            execute_applying_command(None, "fleet.json", "running", parallel=4)
+            stdout, _ = capsys.readouterr()
+            assert apply_mock.call_count == 4
+            assert "ec2_instance:ec2-3: succeeded" in stdout
+            assert "PARTICLE" in stdout and "DURATION" in stdout
+
+    @staticmethod
+    @patch.object(EC2Instance, "apply", side_effect=MaxTimeoutException())
+    def test_execute_applying_command_parallel_timeout(apply_mock, cli_runner, capsys):
+        """ Ensure the CLI fails when the global deadline is reached with --parallel """
+        with cli_runner.isolated_filesystem():
+            with open("fleet.yml", "w") as config_file:
+                config_file.write(
+                    "- {pcf_name: a, flavor: ec2_instance, aws_resource: {custom_config: {instance_name: a}}}\n"
+                    "- {pcf_name: b, flavor: ec2_instance, aws_resource: {custom_config: {instance_name: b}}}\n"
+                )
+
+            with pytest.raises(SystemExit) as sys_exit:
+                execute_applying_command(None, "fleet.yml", "running", parallel=2, timeout=50)
+            stdout, _ = capsys.readouterr()
+            assert sys_exit.value.code == 1
+            assert "Error: Max timeout of 50 seconds reached" in stdout
+
+    @staticmethod
+    @moto.mock_route53
+    @pytest.mark.parametrize("parallel", [None, 5])
+    def test_execute_applying_command_batches_zone_changes(parallel, cli_runner):
+        """ Ensure records loaded from a config file submit one change batch per zone """
+        conn = boto3.client("route53", region_name="us-east-1")
+        hosted_zone_id = conn.create_hosted_zone(Name="cli.catz.com", CallerReference="cli")["HostedZone"]["Id"]
+        with cli_runner.isolated_filesystem():
+            with open("records.json", "w") as config_file:
+                json.dump(
+                    [
+                        {
+                            "pcf_name": "record-{}".format(i),
+                            "flavor": "route53_record",
+                            "aws_resource": {
+                                "Name": "record-{}.cli.catz.com".format(i),
+                                "HostedZoneId": hosted_zone_id,
+                                "TTL": 10,
+                                "ResourceRecords": [{"Value": "10.0.0.{}".format(i)}],
+                                "Type": "A",
+                            },
+                        }
+                        for i in range(5)
+                    ],
+                    config_file,
+                )
+            changes = metrics.API_CALLS.get(service="route53", operation="ChangeResourceRecordSets")
+
+            execute_applying_command(None, "records.json", "running", quiet=True, parallel=parallel)
+
+        assert metrics.API_CALLS.get(service="route53", operation="ChangeResourceRecordSets") == changes + 1
+        record_sets = conn.list_resource_record_sets(HostedZoneId=hosted_zone_id)["ResourceRecordSets"]
+        assert len([record_set for record_set in record_sets if record_set["Type"] == "A"]) == 5
+
+    @staticmethod
+    @moto.mock_ec2
+    @pytest.mark.parametrize("parallel", [None, 3])
+    def test_execute_applying_command_batches_launches(parallel, cli_runner):
+        """ Ensure instances loaded from a config file are launched with one run_instances call """
+        ec2_client = boto3.client("ec2", "us-east-1")
+        vpc_id = ec2_client.create_vpc(CidrBlock="10.0.0.0/16")["Vpc"]["VpcId"]
+        subnet_id = ec2_client.create_subnet(VpcId=vpc_id, CidrBlock="10.0.1.0/24")["Subnet"]["SubnetId"]
+        security_group_id = ec2_client.create_security_group(Description="cli", GroupName="cli", VpcId=vpc_id)["GroupId"]
+        with cli_runner.isolated_filesystem():
+            with open("fleet.json", "w") as config_file:
+                json.dump(
+                    [
+                        {
+                            "pcf_name": "ec2-{}".format(i),
+                            "flavor": "ec2_instance",
+                            "aws_resource": {
+                                "custom_config": {"instance_name": "ec2-{}".format(i)},
+                                "ImageId": "ami-12345678",
+                                "InstanceType": "m4.large",
+                                "MaxCount": 1,
+                                "MinCount": 1,
+                                "SubnetId": subnet_id,
+                                "SecurityGroupIds": [security_group_id],
+                                "region_name": "us-east-1",
+                            },
+                        }
+                        for i in range(3)
+                    ],
+                    config_file,
+                )
+            run_instances = metrics.API_CALLS.get(service="ec2", operation="RunInstances")
+
+            execute_applying_command(None, "fleet.json", "running", quiet=True, parallel=parallel)
+
+        assert metrics.API_CALLS.get(service="ec2", operation="RunInstances") == run_instances + 1
+        reservations = ec2_client.describe_instances()["Reservations"]
+        assert len([instance for reservation in reservations for instance in reservation["Instances"]]) == 3
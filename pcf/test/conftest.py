@@ -29,3 +29,23 @@ def copy_pcf_config_file():
         shutil.copy(filepath, os.getcwd())
 
     return move_pcf_config_file
+
+
+@pytest.fixture(autouse=True)
+def config_cache_dir(tmpdir, monkeypatch):
+    """ Keep parsed config caches written during tests out of the user's home directory """
+    from pcf.util import config_loader
+
+    cache_dir = str(tmpdir.join("pcf_cache"))
+    monkeypatch.setattr(config_loader, "CACHE_DIR", cache_dir)
+    return cache_dir
+
+
+@pytest.fixture(autouse=True)
+def clear_lookup_cache():
+    """ Resolved lookups must not leak between tests that mock different resources """
+    from pcf.util.aws.aws_lookup import AWSLookup
+
+    AWSLookup.cache.clear()
+    yield
+    AWSLookup.cache.clear()
@@ -0,0 +1,149 @@
+# Copyright 2018 Capital One Services, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+
+from copy import deepcopy
+from pcf.core import State
+from pcf.core.fan_out import FanOutTarget, rewrite_region
+from pcf.core.particle import Particle
+from pcf.core.pcf import PCF
+from pcf.core.pcf_exceptions import FanOutException
+from pcf.core.quasiparticle import Quasiparticle
+from pytest import raises
+
+APPLIED = []
+APPLIED_LOCK = threading.Lock()
+
+
+class FanOutParticle(Particle):
+    flavor = "fan_out_particle"
+    UNIQUE_KEYS = ["pcf_name"]
+
+    def __init__(self, particle_definition):
+        super(FanOutParticle, self).__init__(particle_definition)
+        self.desired_state_definition = self.particle_definition["aws_resource"]
+        self.current_state_definition = {}
+        self.state = State.terminated
+
+    def sync_state(self):
+        pass
+
+    def wait(self):
+        pass
+
+    def _start(self):
+        region_name = self.desired_state_definition["region_name"]
+        if region_name == "broken-1":
+            raise Exception("region is broken")
+        time.sleep(0.2)
+        with APPLIED_LOCK:
+            APPLIED.append((region_name, self.name))
+        self.current_state_definition = self.desired_state_definition
+        self.state = State.running
+
+    def _terminate(self):
+        self.state = State.terminated
+
+    def _update(self):
+        pass
+
+
+def definition(name, **kwargs):
+    return dict({"pcf_name": name, "flavor": "fan_out_particle", "aws_resource": {"region_name": "us-east-1"}}, **kwargs)
+
+
+def test_rewrite_region():
+    quasiparticle_definition = {"pcf_name": "quasi", "flavor": "quasiparticle", "particles": [definition("a")]}
+    rewritten = rewrite_region(quasiparticle_definition, "us-west-2")
+    assert rewritten["particles"][0]["aws_resource"]["region_name"] == "us-west-2"
+    assert quasiparticle_definition["particles"][0]["aws_resource"]["region_name"] == "us-east-1"
+
+
+def test_pcf_fan_out_apply():
+    del APPLIED[:]
+    pcf_field = PCF([
+        definition("parent"),
+        definition("child", parents=["fan_out_particle:parent"]),
+        definition("other"),
+    ])
+    for particle in pcf_field.get_particle_list():
+        particle.set_desired_state(State.running)
+
+    regions = ["us-east-1", "us-west-2", "eu-west-1", "ap-south-1"]
+    start = time.time()
+    results = pcf_field.fan_out_apply(regions + [FanOutTarget("broken-1", name="broken")], max_workers_per_target=2)
+    duration = time.time() - start
+
+    # targets and independent particles within a target run concurrently
+    assert duration < 4 * 3 * 0.2
+    assert [result.target.name for result in results] == regions + ["broken"]
+    assert not results.succeeded
+    assert list(results.failures) == ["broken"]
+    assert results["us-west-2"].succeeded
+    assert results["us-west-2"].field.get_particle("fan_out_particle", "child").state == State.running
+    assert sorted(APPLIED) == sorted((region, name) for region in regions for name in ("parent", "child", "other"))
+    for region in regions:
+        assert APPLIED.index((region, "parent")) < APPLIED.index((region, "child"))
+
+    # the original field is untouched
+    assert pcf_field.get_particle("fan_out_particle", "parent").state == State.terminated
+    assert pcf_field.get_particle("fan_out_particle", "parent").particle_definition["aws_resource"]["region_name"] == "us-east-1"
+
+    with raises(FanOutException):
+        results.raise_for_failures()
+
+
+def test_quasiparticle_fan_out_apply():
+    del APPLIED[:]
+    quasiparticle = Quasiparticle({
+        "pcf_name": "quasi",
+        "flavor": "quasiparticle",
+        "particles": [definition("member", multiplier=2)],
+    })
+    quasiparticle.set_desired_state(State.running)
+
+    results = quasiparticle.fan_out_apply([("us-east-1", None), ("eu-west-1", None)])
+    assert results.succeeded
+    assert sorted(APPLIED) == [
+        ("eu-west-1", "member-0"), ("eu-west-1", "member-1"), ("us-east-1", "member-0"), ("us-east-1", "member-1")
+    ]
+    assert results["eu-west-1"].field.get_state() == State.running
+
+
+def test_clone_keeps_unresolved_variables():
+    inherited = "$inherit$fan_out_particle:parent$region_name"
+    child_definition = definition("child", parents=["fan_out_particle:parent"])
+    child_definition["aws_resource"]["parent_region"] = inherited
+    pcf_field = PCF([definition("parent"), deepcopy(child_definition)])
+    pcf_field.get_particle("fan_out_particle", "parent").current_state_definition = {"region_name": "us-east-1"}
+    child = pcf_field.get_particle("fan_out_particle", "child")
+    child.get_and_replace_parent_variables()
+    assert child.particle_definition["aws_resource"]["parent_region"] == "us-east-1"
+
+    clone = pcf_field.clone(region_name="eu-west-1").get_particle("fan_out_particle", "child")
+    assert clone.particle_definition["aws_resource"] == {"region_name": "eu-west-1", "parent_region": inherited}
+
+    quasiparticle = Quasiparticle({
+        "pcf_name": "quasi",
+        "flavor": "quasiparticle",
+        "particles": [definition("parent"), deepcopy(child_definition)],
+    })
+    quasiparticle.pcf_field.get_particle("fan_out_particle", "parent").current_state_definition = {"region_name": "x"}
+    quasiparticle.pcf_field.get_particle("fan_out_particle", "child").get_and_replace_parent_variables()
+    clone = quasiparticle.clone()
+    assert clone.pcf_field.get_particle("fan_out_particle", "child").particle_definition["aws_resource"][
+        "parent_region"] == inherited
+    assert clone.particle_definition["particles"] == [definition("parent"), child_definition]
@@ -12,7 +12,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from copy import deepcopy
+import gc
 import os.path
+import sys
+import tracemalloc
 
 from pcf.core.particle import Particle
 from pcf.core.quasiparticle import Quasiparticle
@@ -344,3 +348,82 @@ def test_update_protection():
     particle.apply(sync=False)
     assert particle.state == State.running
     assert particle.current_state_definition != particle.desired_state_definition
+
+
+def test_shared_state_transition_table():
+    first = PlainParticle({"pcf_name": "first", "flavor": "plain_particle"})
+    second = PlainParticle({"pcf_name": "second", "flavor": "plain_particle"})
+
+    assert "state_transition_table" not in first.__dict__
+    assert first.get_state_transition_function(State.terminated, State.running) == first.start
+    assert first.get_state_transition_function(State.running, State.running) is None
+
+    def custom_start(sync=True, cascade=False):
+        return "custom"
+
+    first.register_state_transition(State.terminated, State.running, custom_start)
+    assert first.get_state_transition_function(State.terminated, State.running) == custom_start
+    assert first.state_transition_table[(State.terminated, State.running)] == custom_start
+    assert second.get_state_transition_function(State.terminated, State.running) == second.start
+
+
+def test_particle_memory_footprint():
+    num_particles = 2000
+    definitions = [{"pcf_name": "particle-{}".format(i), "flavor": "plain_particle"} for i in range(num_particles)]
+    PlainParticle({"pcf_name": "warm_up", "flavor": "plain_particle"})
+
+    gc.collect()
+    tracemalloc.start()
+    start_snapshot = tracemalloc.take_snapshot()
+    particles = [PlainParticle(definition) for definition in definitions]
+    end_snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    allocated = sum(stat.size_diff for stat in end_snapshot.compare_to(start_snapshot, "filename"))
+    bytes_per_particle = (allocated - sys.getsizeof(particles)) / num_particles
+    assert bytes_per_particle < 1024, "bytes per particle: {}".format(bytes_per_particle)
+    assert particles[0].parents == set()
+
+    # members share their definitions with the quasiparticle rather than it keeping a copy of them
+    member_config = {"tags": [{"Key": str(i), "Value": str(i)} for i in range(20)]}
+    definition = {"pcf_name": "quasi", "flavor": "quasiparticle", "particles": [
+        {"pcf_name": "member-{}".format(i), "flavor": "plain_particle", "config": deepcopy(member_config)}
+        for i in range(num_particles)]}
+    Quasiparticle({"pcf_name": "warm_up", "flavor": "quasiparticle", "particles": [deepcopy(definitions[0])]})
+    gc.collect()
+    tracemalloc.start()
+    start_snapshot = tracemalloc.take_snapshot()
+    quasiparticle = Quasiparticle(definition)
+    end_snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    allocated = sum(stat.size_diff for stat in end_snapshot.compare_to(start_snapshot, "filename"))
+    bytes_per_member = allocated / num_particles
+    assert bytes_per_member < 2048, "bytes per member: {}".format(bytes_per_member)
+    assert len(quasiparticle.pcf_field.get_particle_list()) == num_particles
+
+
+def test_plan():
+    from pcf.core.pcf import PCF
+
+    running = PlainParticle({"pcf_name": "running", "flavor": "plain_particle"})
+    running.state = State.running
+    running.current_state_definition = {"size": 1}
+    running.desired_state_definition = {"size": 2}
+    running.set_desired_state(State.running)
+
+    missing = PlainParticle({"pcf_name": "missing", "flavor": "plain_particle"})
+    missing.set_desired_state(State.running)
+
+    pcf_field = PCF([])
+    pcf_field.add_particles([running, missing])
+    plans = pcf_field.plan(max_workers=2, rate_limit=100)
+
+    assert [p["pcf_id"] for p in plans] == ["plain_particle:missing", "plain_particle:running"]
+    assert plans[0]["action"] == "start"
+    assert plans[0]["current_state"] == "terminated"
+    assert plans[1]["action"] == "update"
+    assert plans[1]["diff"]
+    # planning never applies changes
+    assert running.current_state_definition == {"size": 1}
+    assert missing.state == State.terminated
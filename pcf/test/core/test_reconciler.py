@@ -0,0 +1,140 @@
+# Copyright 2018 Capital One Services, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import time
+import urllib.request
+
+from pcf.core import State
+from pcf.core.particle import Particle
+from pcf.core.reconciler import Reconciler
+from pcf.particle.aws.ec2.ec2_instance import EC2Instance
+from pcf.util.aws.client_pool import ClientPool
+
+
+class ReconcilerParticle(Particle):
+    flavor = "reconciler_particle"
+
+    def __init__(self, particle_definition):
+        super(ReconcilerParticle, self).__init__(particle_definition)
+        self.desired_state_definition = {}
+        self.current_state_definition = {}
+        self.state = State.terminated
+        self.applied = []
+
+    def sync_state(self):
+        pass
+
+    def _start(self):
+        self.applied.append("start")
+        self.state = State.running
+
+    def _stop(self):
+        self.applied.append("stop")
+        self.state = State.stopped
+
+    def _terminate(self):
+        self.state = State.terminated
+
+    def _update(self):
+        pass
+
+    def apply(self, *args, **kwargs):
+        if self.name == "broken":
+            raise Exception("broken particle")
+        return super(ReconcilerParticle, self).apply(*args, **kwargs)
+
+
+def wait_for(condition, timeout=5):
+    end = time.time() + timeout
+    while time.time() < end:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def make_reconciler(*names, **kwargs):
+    particles = [ReconcilerParticle({"pcf_name": name, "flavor": "reconciler_particle"}) for name in names]
+    for particle in particles:
+        particle.set_desired_state(State.running)
+    return Reconciler(particles, **kwargs), particles
+
+
+def test_reconciles_on_interval():
+    reconciler, (particle, broken) = make_reconciler("particle", "broken", interval=0.05, jitter=0.5)
+    reconciler.start()
+    try:
+        assert wait_for(lambda: reconciler.get_entry("particle").reconciles >= 3)
+        assert wait_for(lambda: reconciler.get_entry("broken").failures >= 2)
+    finally:
+        reconciler.stop()
+
+    assert particle.state == State.running
+    # the particle is only started once, later reconciles only poll
+    assert particle.applied == ["start"]
+    assert reconciler.get_entry("reconciler_particle:broken").last_error == "broken particle"
+    metrics = reconciler.metrics()
+    assert metrics["particles"] == 2
+    assert metrics["failing_particles"] == 1
+
+
+def test_http_api():
+    reconciler, (particle,) = make_reconciler("particle", interval=3600, jitter=0)
+    server = reconciler.serve(port=0)
+    url = "http://{0}:{1}".format(*server.server_address)
+    reconciler.start()
+    try:
+        assert wait_for(lambda: particle.state == State.running)
+
+        request = urllib.request.Request(
+            url + "/particles/particle", data=json.dumps({"desired_state": "stopped"}).encode(), method="PUT"
+        )
+        with urllib.request.urlopen(request) as response:
+            assert json.loads(response.read())["desired_state"] == "stopped"
+        assert wait_for(lambda: reconciler.get_entry("particle").reconciles == 2)
+        assert particle.state == State.stopped
+
+        with urllib.request.urlopen(url + "/metrics") as response:
+            assert 'pcf_reconciles_total{flavor="reconciler_particle",outcome="succeeded"}' in response.read().decode()
+
+        with urllib.request.urlopen(url + "/particles") as response:
+            assert [s["pcf_id"] for s in json.loads(response.read())] == ["reconciler_particle:particle"]
+
+        try:
+            urllib.request.urlopen(url + "/particles/missing")
+            assert False
+        except urllib.error.HTTPError as error:
+            assert error.code == 404
+    finally:
+        reconciler.stop()
+
+    assert particle.applied == ["start", "stop"]
+
+
+def test_client_pool_shared():
+    def definition(name):
+        return {
+            "pcf_name": name,
+            "flavor": "ec2_instance",
+            "aws_resource": {"region_name": "us-east-1", "custom_config": {"instance_name": name}},
+        }
+
+    first = EC2Instance(definition("instance"))
+    second = EC2Instance(definition("other"))
+    reconciler = Reconciler([first, second])
+
+    assert first.client is second.client
+    assert len(reconciler.client_pool) == 1
+    assert ClientPool().client("ec2", region_name="us-east-1") is not first.client
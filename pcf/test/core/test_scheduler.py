@@ -0,0 +1,121 @@
+# Copyright 2018 Capital One Services, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+
+from pcf.core import State, scheduler
+from pcf.core.particle import Particle
+from pcf.core.pcf_exceptions import MaxTimeoutException
+from pcf.core.scheduler import ParticleScheduler
+
+
+class SchedulerParticle(Particle):
+    flavor = "scheduler_particle"
+
+    def sync_state(self):
+        self.state = State.running
+
+
+def make_particles(*definitions):
+    return [SchedulerParticle(dict(definition, flavor="scheduler_particle")) for definition in definitions]
+
+
+def test_independent_particles_run_concurrently():
+    particles = make_particles(*[{"pcf_name": "p{}".format(i)} for i in range(8)])
+    barrier = threading.Barrier(8, timeout=5)
+
+    def func(particle, timeout):
+        barrier.wait()
+        return particle.name
+
+    results = ParticleScheduler(particles, max_workers=8).run(func)
+    assert all(r.status == scheduler.SUCCEEDED for r in results.values())
+    assert results["scheduler_particle:p3"].response == "p3"
+
+
+def test_dependencies_ordering_and_skips():
+    particles = make_particles(
+        {"pcf_name": "parent"},
+        {"pcf_name": "child", "parents": ["scheduler_particle:parent"]},
+        {"pcf_name": "grandchild", "parents": ["scheduler_particle:child"]},
+    )
+    order = []
+
+    def func(particle, timeout):
+        order.append(particle.name)
+
+    ParticleScheduler(particles, max_workers=4).run(func)
+    assert order == ["parent", "child", "grandchild"]
+
+    order.clear()
+    ParticleScheduler(particles, max_workers=4, reverse=True).run(func)
+    assert order == ["grandchild", "child", "parent"]
+
+    def fail_parent(particle, timeout):
+        if particle.name == "parent":
+            raise Exception("boom")
+
+    events = []
+    results = ParticleScheduler(particles, max_workers=4).run(fail_parent, on_event=lambda e, r: events.append((e, r.pcf_id)))
+    assert results["scheduler_particle:parent"].status == scheduler.FAILED
+    assert results["scheduler_particle:grandchild"].status == scheduler.SKIPPED
+    assert (scheduler.STARTED, "scheduler_particle:parent") in events
+    assert (scheduler.SKIPPED, "scheduler_particle:child") in events
+
+
+def test_skips_reach_descendants_waiting_before_their_parent():
+    # the grandchild is checked before the child it waits on
+    particles = make_particles(
+        {"pcf_name": "grandchild", "parents": ["scheduler_particle:child"]},
+        {"pcf_name": "child", "parents": ["scheduler_particle:parent"]},
+        {"pcf_name": "parent"},
+    )
+
+    def fail_parent(particle, timeout):
+        raise Exception("boom")
+
+    results = ParticleScheduler(particles, max_workers=4).run(fail_parent)
+    assert results["scheduler_particle:parent"].status == scheduler.FAILED
+    assert results["scheduler_particle:child"].status == scheduler.SKIPPED
+    assert results["scheduler_particle:grandchild"].status == scheduler.SKIPPED
+
+    # the parent times out in the same pass the grandchild was checked in
+    results = ParticleScheduler(particles, max_workers=4).run(lambda particle, timeout: None, deadline=time.time())
+    assert results["scheduler_particle:parent"].status == scheduler.TIMED_OUT
+    assert results["scheduler_particle:child"].status == scheduler.SKIPPED
+    assert results["scheduler_particle:grandchild"].status == scheduler.SKIPPED
+
+
+def test_deadline():
+    particles = make_particles({"pcf_name": "slow"}, {"pcf_name": "late"})
+
+    def func(particle, timeout):
+        assert timeout is not None and timeout <= 1
+        time.sleep(timeout)
+        raise MaxTimeoutException
+
+    results = ParticleScheduler(particles, max_workers=1).run(func, deadline=time.time() + 0.2)
+    assert results["scheduler_particle:slow"].status == scheduler.TIMED_OUT
+    assert results["scheduler_particle:late"].status == scheduler.TIMED_OUT
+    assert results["scheduler_particle:late"].start_time is None
+
+
+def test_circular_dependency():
+    particles = make_particles(
+        {"pcf_name": "a", "parents": ["scheduler_particle:b"]},
+        {"pcf_name": "b", "parents": ["scheduler_particle:a"]},
+    )
+    results = ParticleScheduler(particles, max_workers=2).run(lambda particle, timeout: None)
+    assert all(r.status == scheduler.FAILED for r in results.values())
@@ -0,0 +1,79 @@
+# Copyright 2018 Capital One Services, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import moto
+import time
+
+from pcf.particle.aws.dynamodb.dynamodb_table import DynamoDB
+from pcf.core import State
+from pcf.util import metrics
+
+
+class TestDynamoDB():
+    particle_definition = {
+        "pcf_name": "pcf_dynamodb_batch",
+        "flavor": "dynamodb_table",
+        "aws_resource": {
+            "region_name": "us-east-1",
+            "TableName": "pcf_batch",
+            "AttributeDefinitions": [{"AttributeName": "id", "AttributeType": "S"}],
+            "KeySchema": [{"AttributeName": "id", "KeyType": "HASH"}],
+            "ProvisionedThroughput": {"ReadCapacityUnits": 5, "WriteCapacityUnits": 5},
+            "custom_config": {"batch_concurrency": 2},
+        }
+    }
+
+    @moto.mock_dynamodb
+    def test_batch_helpers(self, monkeypatch):
+        # moto only serves the regional endpoint
+        monkeypatch.setenv("AWS_ACCOUNT_ID_ENDPOINT_MODE", "disabled")
+        particle = DynamoDB(self.particle_definition)
+        particle.set_desired_state(State.running)
+        particle.apply()
+        writes = metrics.API_CALLS.get(service="dynamodb", operation="BatchWriteItem")
+
+        # generators are chunked to 25 items, the last request for a key wins even when the chunk with the first
+        # request is slower
+        unpatched_batch_write_item = particle.client.batch_write_item
+        def slow_batch_write_item(RequestItems):
+            if {"PutRequest": {"Item": {"id": {"S": "item-10"}, "value": {"N": "10"}}}} in RequestItems[particle.table_name]:
+                time.sleep(0.3)
+            return unpatched_batch_write_item(RequestItems=RequestItems)
+        monkeypatch.setattr(particle.client, "batch_write_item", slow_batch_write_item)
+        values = [(i, i) for i in range(6)] + [(3, 100)] + [(i, i) for i in range(6, 49)] + [(10, 300), (30, 400)]
+        items = ({"id": {"S": "item-{}".format(i)}, "value": {"N": str(v)}} for i, v in values)
+        assert particle.batch_write(items) == 50
+        assert metrics.API_CALLS.get(service="dynamodb", operation="BatchWriteItem") == writes + 2
+
+        keys = [{"id": {"S": "item-{}".format(i)}} for i in range(150)]
+        items = {item["id"]["S"]: item["value"]["N"] for item in particle.batch_get(iter(keys), ConsistentRead=True)}
+        assert sorted(items) == sorted("item-{}".format(i) for i in range(49))
+        assert (items["item-3"], items["item-10"], items["item-30"], items["item-31"]) == ("100", "300", "400", "31")
+
+        # unprocessed items are sent again
+        batch_write_item = particle.client.batch_write_item
+        calls = []
+        def throttled_batch_write_item(RequestItems):
+            calls.append(len(RequestItems[particle.table_name]))
+            if len(calls) == 1:
+                requests = RequestItems[particle.table_name]
+                batch_write_item(RequestItems={particle.table_name: requests[:5]})
+                return {"UnprocessedItems": {particle.table_name: requests[5:]}}
+            return batch_write_item(RequestItems=RequestItems)
+        monkeypatch.setattr(particle.client, "batch_write_item", throttled_batch_write_item)
+        monkeypatch.setattr("time.sleep", lambda seconds: None)
+
+        assert particle.batch_delete({"id": {"S": "item-{}".format(i)}} for i in range(20)) == 20
+        assert calls == [20, 15]
+        assert len(list(particle.batch_get(keys))) == 29
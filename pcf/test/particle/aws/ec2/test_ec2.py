@@ -14,9 +14,14 @@
 
 import moto
 import boto3
+import time
 
-from pcf.particle.aws.ec2.ec2_instance import EC2Instance
+from copy import deepcopy
+from pcf.particle.aws.ec2.ec2_instance import EC2Instance, UserdataWatcher
 from pcf.core import State
+from pcf.core.quasiparticle import Quasiparticle
+from pcf.util import metrics
+from pcf.util.aws.client_pool import ClientPool
 
 
 class TestEC2():
@@ -88,3 +93,145 @@ class TestEC2():
         particle.apply(sync=False)
 
         assert particle.get_state() == State.terminated
+
+    @moto.mock_ec2
+    def test_bulk_launch(self):
+        ec2_client = boto3.client('ec2', 'us-east-1')
+        vpc = ec2_client.create_vpc(CidrBlock='10.0.0.0/16')['Vpc']
+        subnet = ec2_client.create_subnet(VpcId=vpc['VpcId'], CidrBlock='10.0.1.0/24')['Subnet']['SubnetId']
+        security_group = ec2_client.create_security_group(Description='test', GroupName='test_sg', VpcId=vpc['VpcId'])
+
+        member_definition = deepcopy(self.particle_definition)
+        member_definition["aws_resource"]["SubnetId"] = subnet
+        member_definition["aws_resource"]["SecurityGroupIds"] = [security_group['GroupId']]
+        member_definition["aws_resource"].pop("IamInstanceProfile")
+        member_definition["aws_resource"]["custom_config"]["tags"] = {"Test": "Tag"}
+        member_definition["aws_resource"]["region_name"] = "us-east-1"
+        member_definition["multiplier"] = 5
+        quasiparticle = Quasiparticle({"pcf_name": "workers", "flavor": "quasiparticle", "particles": [member_definition]})
+
+        run_instances = metrics.API_CALLS.get(service="ec2", operation="RunInstances")
+        quasiparticle.set_desired_state(State.running)
+        quasiparticle.apply()
+
+        assert metrics.API_CALLS.get(service="ec2", operation="RunInstances") == run_instances + 1
+        instances = quasiparticle.pcf_field.get_particles(flavor="ec2_instance").values()
+        assert len({particle.get_instance_id() for particle in instances}) == 5
+        for particle in instances:
+            assert particle.get_state() == State.running
+            tags = {tag["Key"]: tag["Value"] for tag in particle.current_state_definition["Tags"]}
+            assert tags["PCFName"] == particle.instance_name
+            assert tags["Test"] == "Tag"
+
+    @moto.mock_ec2
+    def test_bulk_launch_resolves_lookups_of_mates(self, monkeypatch):
+        ec2_client = boto3.client('ec2', 'us-east-1')
+        vpc = ec2_client.create_vpc(CidrBlock='10.0.0.0/16')['Vpc']
+        subnet = ec2_client.create_subnet(VpcId=vpc['VpcId'], CidrBlock='10.0.1.0/24')['Subnet']['SubnetId']
+        ec2_client.create_tags(Resources=[subnet], Tags=[{'Key': 'Name', 'Value': 'Public'}])
+        security_group = ec2_client.create_security_group(Description='test', GroupName='test_sg', VpcId=vpc['VpcId'])
+
+        particles = []
+        for i in range(4):
+            definition = deepcopy(self.particle_definition)
+            definition["pcf_name"] = "lookup-{}".format(i)
+            definition["aws_resource"]["custom_config"]["instance_name"] = "lookup-{}".format(i)
+            definition["aws_resource"]["SubnetId"] = "$lookup$subnet$Public"
+            definition["aws_resource"]["SecurityGroupIds"] = [security_group['GroupId']]
+            definition["aws_resource"]["region_name"] = "us-east-1"
+            definition["aws_resource"].pop("IamInstanceProfile")
+            particles.append(EC2Instance(definition))
+        EC2Instance.link_batch(particles)
+
+        # tagging one of the mates fails, its instance is terminated rather than left without a PCFName
+        def failing_create_tags(create_tags):
+            def wrapper(Resources, Tags):
+                if Tags[0]["Value"] == "lookup-3":
+                    raise Exception("throttled")
+                return create_tags(Resources=Resources, Tags=Tags)
+            return wrapper
+        for client in {particle.client for particle in particles}:
+            monkeypatch.setattr(client, "create_tags", failing_create_tags(client.create_tags))
+
+        run_instances = metrics.API_CALLS.get(service="ec2", operation="RunInstances")
+        particles[0].set_desired_state(State.running)
+        for particle in particles[1:]:
+            particle.desired_state = State.running
+        particles[0].apply()
+
+        assert metrics.API_CALLS.get(service="ec2", operation="RunInstances") == run_instances + 1
+        assert all(particle._arn for particle in particles[:3])
+        assert particles[3]._arn is None
+        # the mates are resolved when they are applied themselves
+        assert particles[1].desired_state_definition["SubnetId"] == "$lookup$subnet$Public"
+        instances = [i for r in ec2_client.describe_instances()["Reservations"] for i in r["Instances"]]
+        assert sorted(i["State"]["Name"] for i in instances) == ["running"] * 3 + ["terminated"]
+        assert all(i["SubnetId"] == subnet for i in instances)
+
+    @moto.mock_ec2
+    def test_userdata_watcher(self):
+        ec2_client = ClientPool().client('ec2', region_name='us-east-1')
+        instance_ids = [
+            instance["InstanceId"]
+            for instance in ec2_client.run_instances(ImageId="ami-12345678", MinCount=5, MaxCount=5)["Instances"]
+        ]
+        ec2_client.create_tags(Resources=instance_ids[:2], Tags=[{"Key": "UserdataFinished", "Value": "True"}])
+        ec2_client.create_tags(Resources=instance_ids, Tags=[{"Key": "Other", "Value": "Tag"}])
+
+        watcher = UserdataWatcher(ec2_client, min_interval=60, max_interval=600)
+        watcher.RESOURCE_ID_BATCH = 2
+        describe_tags = metrics.API_CALLS.get(service="ec2", operation="DescribeTags")
+
+        # instances are answered from the last poll until the next tick
+        assert watcher.is_finished(instance_ids[0])
+        # and forgotten once they were reported finished
+        assert watcher.finished == {}
+        assert [watcher.is_finished(instance_id) for instance_id in instance_ids[1:]] == [False, False, False, False]
+        assert metrics.API_CALLS.get(service="ec2", operation="DescribeTags") == describe_tags + 1
+
+        # one poll covers every pending instance, in batches of resource ids
+        watcher.last_poll_time = 0
+        assert watcher.is_finished(instance_ids[1])
+        assert not watcher.is_finished(instance_ids[2])
+        assert metrics.API_CALLS.get(service="ec2", operation="DescribeTags") == describe_tags + 3
+        assert sorted(watcher.pending) == sorted(instance_ids[2:])
+        assert watcher.interval == 60
+
+        watcher.last_poll_time = 0
+        assert not watcher.is_finished(instance_ids[2])
+        assert metrics.API_CALLS.get(service="ec2", operation="DescribeTags") == describe_tags + 5
+        # nothing finished, the shared interval backs off
+        assert watcher.interval == 90
+
+        ec2_client.create_tags(Resources=instance_ids[2:], Tags=[{"Key": "UserdataFinished", "Value": "True"}])
+        watcher.last_poll_time = 0
+        assert all(watcher.is_finished(instance_id) for instance_id in instance_ids[2:])
+        assert watcher.interval == 60
+        assert watcher.pending == {}
+        assert watcher.finished == {}
+
+        # finished instances that are never asked about again are dropped like pending ones
+        watcher.finished[instance_ids[0]] = time.time() - 10 * watcher.max_interval
+        watcher.last_poll_time = 0
+        assert watcher.is_finished(instance_ids[1])
+        assert watcher.finished == {}
+
+    @moto.mock_ec2
+    def test_sync_state_keeps_finished_userdata(self, monkeypatch):
+        definition = deepcopy(self.particle_definition)
+        definition["aws_resource"]["custom_config"]["userdata_wait"] = True
+        particle = EC2Instance(definition)
+        instance_id = particle.client.run_instances(ImageId="ami-12345678", MinCount=1, MaxCount=1)["Instances"][0][
+            "InstanceId"]
+        particle.client.create_tags(Resources=[instance_id], Tags=[{"Key": "UserdataFinished", "Value": "True"}])
+        monkeypatch.setattr(particle, "get_instance_id", lambda: instance_id)
+        monkeypatch.setattr(particle, "get_current_definition", lambda: {"State": {"Name": "running"}})
+        monkeypatch.setattr(UserdataWatcher, "_watchers", {})
+
+        describe_tags = metrics.API_CALLS.get(service="ec2", operation="DescribeTags")
+        for _ in range(3):
+            particle.sync_state()
+            assert particle.state == State.running
+        # the watcher forgot the instance after the first answer, the particle remembers it
+        assert instance_id not in UserdataWatcher.for_particle(particle).finished
+        assert metrics.API_CALLS.get(service="ec2", operation="DescribeTags") == describe_tags + 1
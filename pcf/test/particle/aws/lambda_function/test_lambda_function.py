@@ -0,0 +1,123 @@
+# Copyright 2018 Capital One Services, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import base64
+import hashlib
+
+import boto3
+import moto
+import pytest
+
+from pcf.particle.aws.lambda_function.lambda_function import LambdaFunction
+from pcf.util import metrics, pcf_util
+
+
+def lambda_definition(name, code):
+    return {
+        "pcf_name": name,
+        "flavor": "lambda_function",
+        "aws_resource": {
+            "FunctionName": name,
+            "Runtime": "python3.8",
+            "Role": "arn:aws:iam::123456789012:role/lambda",
+            "Handler": "handler.handler",
+            "Code": code,
+            "region_name": "us-east-1",
+        }
+    }
+
+
+@pytest.fixture(autouse=True)
+def clear_code_sha256_cache(monkeypatch):
+    monkeypatch.setattr(LambdaFunction, "code_sha256_cache", {})
+
+
+def test_local_code_is_hashed_lazily_once(tmpdir, monkeypatch):
+    content = b"zip contents" * 1000
+    zip_path = tmpdir.join("function.zip")
+    zip_path.write_binary(content)
+    expected = base64.b64encode(hashlib.sha256(content).digest()).decode()
+
+    hashed = []
+    file_sha256 = pcf_util.file_sha256
+    monkeypatch.setattr(pcf_util, "file_sha256", lambda path, *args: hashed.append(path) or file_sha256(path, *args))
+
+    first = LambdaFunction(lambda_definition("first", {"ZipFile": str(zip_path)}))
+    second = LambdaFunction(lambda_definition("second", {"ZipFile": str(zip_path)}))
+    assert hashed == []
+    assert "CodeSha256" not in first.desired_state_definition
+
+    assert first.get_desired_state_definition()["CodeSha256"] == expected
+    assert second.get_desired_state_definition()["CodeSha256"] == expected
+    assert len(hashed) == 1
+
+    # a changed artifact is hashed again
+    zip_path.write_binary(content + b"changed")
+    third = LambdaFunction(lambda_definition("third", {"ZipFile": str(zip_path)}))
+    assert third.get_desired_state_definition()["CodeSha256"] != expected
+    assert len(hashed) == 2
+
+
+@moto.mock_s3
+def test_s3_code_is_streamed_and_cached_by_etag():
+    s3 = boto3.client("s3", region_name="us-east-1")
+    s3.create_bucket(Bucket="artifacts")
+    content = b"zip contents" * 1000
+    s3.put_object(Bucket="artifacts", Key="function.zip", Body=content)
+    expected = base64.b64encode(hashlib.sha256(content).digest()).decode()
+    code = {"S3Bucket": "artifacts", "S3Key": "function.zip"}
+
+    downloads = metrics.API_CALLS.get(service="s3", operation="GetObject")
+    first = LambdaFunction(lambda_definition("first", code))
+    assert first.get_desired_state_definition()["CodeSha256"] == expected
+    tags = s3.get_object_tagging(Bucket="artifacts", Key="function.zip")["TagSet"]
+    assert tags == [{"Key": "CodeSha256", "Value": expected}]
+
+    second = LambdaFunction(lambda_definition("second", code))
+    assert second.get_desired_state_definition()["CodeSha256"] == expected
+    assert metrics.API_CALLS.get(service="s3", operation="GetObject") == downloads + 1
+
+
+@moto.mock_iam
+@moto.mock_s3
+@moto.mock_lambda
+def test_large_local_code_is_staged_once(tmpdir):
+    role = boto3.client("iam", region_name="us-east-1").create_role(
+        RoleName="lambda", AssumeRolePolicyDocument="{}")["Role"]["Arn"]
+    boto3.client("s3", region_name="us-east-1").create_bucket(Bucket="staging")
+    zip_path = tmpdir.join("function.zip")
+    zip_path.write_binary(b"zip contents" * 1000)
+
+    def staged_function(name):
+        definition = lambda_definition(name, {"ZipFile": str(zip_path)})
+        definition["aws_resource"]["Role"] = role
+        definition["aws_resource"]["custom_config"] = {
+            "staging_bucket": "staging", "staging_prefix": "lambda/", "staging_threshold": 1000
+        }
+        return LambdaFunction(definition)
+
+    uploads = metrics.API_CALLS.get(service="s3", operation="PutObject")
+    functions = [staged_function("first"), staged_function("second")]
+    for function in functions:
+        assert function.is_code_staged()
+        function.set_desired_state("running")
+        function.apply(sync=True)
+
+    assert metrics.API_CALLS.get(service="s3", operation="PutObject") == uploads + 1
+    code_sha256 = functions[0].get_desired_state_definition()["CodeSha256"]
+    key = "lambda/{}.zip".format(base64.b64decode(code_sha256).hex())
+    tags = boto3.client("s3", region_name="us-east-1").get_object_tagging(Bucket="staging", Key=key)["TagSet"]
+    assert tags == [{"Key": "CodeSha256", "Value": code_sha256}]
+    for function in functions:
+        assert function.current_state_definition["CodeSha256"] == code_sha256
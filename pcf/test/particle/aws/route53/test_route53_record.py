@@ -12,12 +12,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import gc
 import moto
 import boto3
+import time
 
-from pcf.particle.aws.route53.route53_record import Route53Record
+from pcf.particle.aws.ec2.ec2_instance import EC2Instance
+from pcf.particle.aws.route53.route53_record import Route53Record, ZoneChangeCoalescer
 from pcf.core import State
-from pcf.util import pcf_util
+from pcf.core.pcf import PCF
+from pcf.util import metrics, pcf_util
 
 
 class TestRoute53Record():
@@ -104,6 +108,123 @@ class TestRoute53Record():
         assert particle.get_state() == State.terminated
 
 
+    @moto.mock_route53
+    def test_changes_are_batched_per_zone(self):
+        conn = boto3.client('route53', region_name='us-east-1')
+        hosted_zone_id = conn.create_hosted_zone(Name="batch.catz.com", CallerReference="batch")["HostedZone"]["Id"]
+        pcf_field = PCF([
+            {
+                "pcf_name": "record-{}".format(i),
+                "flavor": "route53_record",
+                "aws_resource": {
+                    "Name": "record-{}.batch.catz.com".format(i),
+                    "HostedZoneId": hosted_zone_id,
+                    "TTL": 10,
+                    "ResourceRecords": [{"Value": "10.0.0.{}".format(i)}],
+                    "Type": "A",
+                    "custom_config": {"wait_for_sync": True},
+                }
+            }
+            for i in range(5)
+        ])
+        records = pcf_field.get_particle_list()
+        changes = metrics.API_CALLS.get(service="route53", operation="ChangeResourceRecordSets")
+
+        for record in records:
+            record.set_desired_state(State.running)
+        pcf_field.apply()
+
+        assert metrics.API_CALLS.get(service="route53", operation="ChangeResourceRecordSets") == changes + 1
+        assert all(record.get_state() == State.running for record in records)
+        record_sets = conn.list_resource_record_sets(HostedZoneId=hosted_zone_id)["ResourceRecordSets"]
+        assert len([record_set for record_set in record_sets if record_set["Type"] == "A"]) == 5
+
+        for record in records:
+            record.set_desired_state(State.terminated)
+        pcf_field.apply()
+
+        assert metrics.API_CALLS.get(service="route53", operation="ChangeResourceRecordSets") == changes + 2
+        assert all(record.get_state() == State.terminated for record in records)
+
+    @moto.mock_route53
+    def test_records_sync_from_zone_index(self):
+        conn = boto3.client('route53', region_name='us-east-1')
+        hosted_zone_id = conn.create_hosted_zone(Name="index.catz.com", CallerReference="index")["HostedZone"]["Id"]
+        conn.change_resource_record_sets(HostedZoneId=hosted_zone_id, ChangeBatch={"Changes": [
+            {"Action": "CREATE", "ResourceRecordSet": {
+                "Name": "record-{}.index.catz.com.".format(i), "Type": "A", "TTL": 10,
+                "ResourceRecords": [{"Value": "10.0.0.{}".format(i)}]}}
+            for i in range(10)
+        ]})
+
+        def record(name, record_type):
+            return Route53Record({
+                "pcf_name": name + record_type,
+                "flavor": "route53_record",
+                "aws_resource": {"Name": name, "HostedZoneId": hosted_zone_id, "TTL": 10,
+                                 "ResourceRecords": [{"Value": "\"text\""}], "Type": record_type}
+            })
+
+        lists = metrics.API_CALLS.get(service="route53", operation="ListResourceRecordSets")
+        records = [record("record-{}.index.catz.com".format(i), "A") for i in range(10)]
+        assert all(r.get_state() == State.running for r in records)
+        assert records[3].current_state_definition["ResourceRecords"] == [{"Value": "10.0.0.3"}]
+        # a record of another type with the same name is not a match
+        assert record("record-3.index.catz.com", "TXT").get_state() == State.terminated
+        assert metrics.API_CALLS.get(service="route53", operation="ListResourceRecordSets") == lists + 1
+
+    @moto.mock_ec2
+    def test_parent_ips_are_cached(self):
+        ec2_client = boto3.client('ec2', region_name='us-east-1')
+        parents = []
+        for i in range(3):
+            ec2_client.run_instances(ImageId="ami-12c6146b", MinCount=1, MaxCount=1, TagSpecifications=[
+                {"ResourceType": "instance", "Tags": [{"Key": "PCFName", "Value": "parent-{}".format(i)}]}])
+            parents.append(EC2Instance({
+                "pcf_name": "parent-{}".format(i),
+                "flavor": "ec2_instance",
+                "aws_resource": {"custom_config": {"instance_name": "parent-{}".format(i)}}
+            }))
+        particle = Route53Record({
+            "pcf_name": "record",
+            "flavor": "route53_record",
+            "aws_resource": {"Name": "parents.catz.com", "HostedZoneId": "ABCDEFGHI", "TTL": 10,
+                             "ResourceRecords": [{"Value": "127.0.0.1"}], "Type": "A"}
+        })
+        particle.parents = set(parents)
+        ips = set(instance["PrivateIpAddress"] for reservation in ec2_client.describe_instances()["Reservations"]
+                  for instance in reservation["Instances"])
+
+        describes = metrics.API_CALLS.get(service="ec2", operation="DescribeInstances")
+        resource_records = particle.get_desired_state_definition()["ResourceRecords"]
+        assert set(x["Value"] for x in resource_records) == ips | {"127.0.0.1"}
+        for _ in range(5):
+            assert particle.get_desired_state_definition()["ResourceRecords"] == resource_records
+        assert metrics.API_CALLS.get(service="ec2", operation="DescribeInstances") == describes + 1
+
+        # a parent with a fresh state is used as is
+        parents[0].current_state_definition = {"PrivateIpAddress": "10.9.9.9"}
+        parents[0].state_last_refresh_time = time.time()
+        assert {"Value": "10.9.9.9"} in particle.get_desired_state_definition()["ResourceRecords"]
+        assert metrics.API_CALLS.get(service="ec2", operation="DescribeInstances") == describes + 1
+
+    def test_change_batches_respect_limits(self):
+        coalescer = ZoneChangeCoalescer(client=None, hosted_zone="ABCDEFGHI")
+        upserts = [(None, {"Action": "UPSERT", "ResourceRecordSet": {"ResourceRecords": [{"Value": "10.0.0.1"}]}})] * 700
+        assert [len(batch) for batch in coalescer._batches(upserts)] == [500, 200]
+        creates = [(None, {"Action": "CREATE", "ResourceRecordSet": {"ResourceRecords": [{"Value": "x" * 10000}]}})] * 7
+        assert [len(batch) for batch in coalescer._batches(creates)] == [3, 3, 1]
+
+    @moto.mock_route53
+    def test_submitted_changes_do_not_outlive_their_record(self):
+        coalescer = ZoneChangeCoalescer(client=None, hosted_zone="ABCDEFGHI")
+        record = Route53Record(self.particle_definition)
+        coalescer.submitted[record] = {"ChangeInfo": {"Status": "PENDING"}}
+        assert record in coalescer.submitted
+        del record
+        gc.collect()
+        assert len(coalescer.submitted) == 0
+
     @moto.mock_route53
     def test_incorrect_definitions(self):
 
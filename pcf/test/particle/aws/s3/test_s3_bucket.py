@@ -12,11 +12,20 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
+import io
 import moto
 import os
+import pytest
+import threading
 
-from pcf.particle.aws.s3.s3_bucket import S3Bucket
+from botocore.exceptions import ClientError
+from pcf.particle.aws.s3.s3_bucket import BucketInventory, S3Bucket
 from pcf.core import State
+from pcf.core.pcf import PCF
+from pcf.core.pcf_exceptions import ChecksumMismatchException
+from pcf.util import metrics
+from pcf.util.aws import s3_transfer
 
 
 class TestS3Bucket():
@@ -69,3 +78,188 @@ class TestS3Bucket():
         particle.apply()
 
         assert particle.get_state() == State.terminated
+
+    @moto.mock_s3
+    def test_transfers(self, tmpdir, monkeypatch):
+        # moto stores parts sent with trailing checksums as is
+        monkeypatch.setenv("AWS_REQUEST_CHECKSUM_CALCULATION", "when_required")
+        particle = S3Bucket(self.particle_definition)
+        particle.client.create_bucket(Bucket=particle.bucket_name)
+        part_size = 5 * 1024 * 1024
+        data = os.urandom(2 * part_size + 1024)
+        sha256 = hashlib.sha256(data).hexdigest()
+
+        # generators are streamed in parts and tagged with their sha256 afterwards
+        managers = len(s3_transfer.TRANSFERS)
+        progress = []
+        chunks = (data[i:i + 1000000] for i in range(0, len(data), 1000000))
+        parts = metrics.API_CALLS.get(service="s3", operation="UploadPart")
+        assert particle.upload_fileobj(chunks, "stream", callback=progress.append, part_size=part_size) == sha256
+        assert metrics.API_CALLS.get(service="s3", operation="UploadPart") == parts + 3
+        assert sum(progress) == len(data)
+        assert s3_transfer.get_sha256(particle.client, particle.bucket_name, "stream") == sha256
+
+        downloaded = io.BytesIO()
+        assert particle.download_fileobj("stream", downloaded, part_size=part_size) == sha256
+        assert downloaded.getvalue() == data
+
+        # files are tagged on upload, next to the tags passed in
+        source = tmpdir.join("source")
+        source.write_binary(data)
+        particle.upload_file(str(source), "file", extra_args={"Tagging": "team=pcf"}, part_size=part_size)
+        tag_set = particle.client.get_object_tagging(Bucket=particle.bucket_name, Key="file")["TagSet"]
+        assert {tag["Key"]: tag["Value"] for tag in tag_set} == {"team": "pcf", s3_transfer.SHA256_TAG: sha256}
+        target = tmpdir.join("target")
+        assert particle.download_file("file", str(target), part_size=part_size) == sha256
+        assert target.read_binary() == data
+        assert len(s3_transfer.TRANSFERS) == managers + 1
+
+        # a changed object fails verification and leaves no file behind
+        particle.client.put_object(Bucket=particle.bucket_name, Key="file", Body=b"changed",
+                                   Tagging="{}={}".format(s3_transfer.SHA256_TAG, sha256))
+        target.remove()
+        with pytest.raises(ChecksumMismatchException):
+            particle.download_file("file", str(target))
+        assert not target.exists()
+        assert particle.download_file("file", str(target), verify=False) is None
+        assert target.read_binary() == b"changed"
+
+    @moto.mock_s3
+    def test_sync(self, tmpdir, monkeypatch, config_cache_dir):
+        monkeypatch.setenv("AWS_REQUEST_CHECKSUM_CALCULATION", "when_required")
+        particle = S3Bucket(self.particle_definition)
+        particle.client.create_bucket(Bucket=particle.bucket_name)
+        part_size = 5 * 1024 * 1024
+        site = tmpdir.mkdir("site")
+        site.join("index.html").write("<html></html>")
+        site.mkdir("css").join("site.css").write("body {}")
+        site.join("model.bin").write_binary(os.urandom(2 * part_size + 1))
+        manifest = tmpdir.join("manifest.json")
+
+        result = particle.sync(str(site), "www", manifest_path=str(manifest), part_size=part_size)
+        assert result["uploaded"] == ["www/css/site.css", "www/index.html", "www/model.bin"]
+        assert manifest.exists()
+
+        # multipart ETags match, unchanged files are neither hashed nor uploaded
+        with monkeypatch.context() as m:
+            m.setattr(s3_transfer, "file_etag", None)
+            result = particle.sync(str(site), "www", manifest_path=str(manifest), part_size=part_size)
+        assert result == {"uploaded": [], "deleted": [], "unchanged": 3}
+
+        site.join("index.html").write("<html>changed</html>")
+        particle.client.put_object(Bucket=particle.bucket_name, Key="www/old.html", Body=b"old")
+        particle.client.put_object(Bucket=particle.bucket_name, Key="other/keep.html", Body=b"keep")
+        result = particle.sync(str(site), "www", delete=True, manifest_path=str(manifest), part_size=part_size)
+        assert result == {"uploaded": ["www/index.html"], "deleted": ["www/old.html"], "unchanged": 2}
+        keys = [obj["Key"] for obj in particle.client.list_objects_v2(Bucket=particle.bucket_name)["Contents"]]
+        assert sorted(keys) == ["other/keep.html", "www/css/site.css", "www/index.html", "www/model.bin"]
+
+        # by default manifests are kept in the cache directory, one per directory, bucket and prefix
+        particle.sync(str(site), "www", part_size=part_size)
+        particle.sync(str(site), "mirror", part_size=part_size)
+        assert not tmpdir.join("site.sync-manifest.json").exists()
+        assert len(os.listdir(os.path.join(config_cache_dir, "s3-sync"))) == 2
+
+    @moto.mock_s3
+    def test_force_delete(self, monkeypatch):
+        definition = {
+            "pcf_name": "pcf_s3_force_delete",
+            "flavor": "s3_bucket",
+            "aws_resource": {"Bucket": "pcf-force-delete", "custom_config": {"force_delete": True}}
+        }
+        particle = S3Bucket(definition)
+        particle.set_desired_state(State.running)
+        particle.apply()
+        particle.client.put_bucket_versioning(Bucket=particle.bucket_name,
+                                              VersioningConfiguration={"Status": "Enabled"})
+        for i in range(1500):
+            particle.client.put_object(Bucket=particle.bucket_name, Key="key-{}".format(i % 1200), Body=b"x")
+        particle.client.delete_object(Bucket=particle.bucket_name, Key="key-0")
+
+        # failed keys of a batch are retried on their own, moto is only called by one thread at a time
+        delete_objects = particle.client.delete_objects
+        list_object_versions = particle.client.list_object_versions
+        lock = threading.Lock()
+        calls = []
+        def flaky_delete_objects(**kwargs):
+            with lock:
+                calls.append(len(kwargs["Delete"]["Objects"]))
+                if len(calls) == 1:
+                    failed = kwargs["Delete"]["Objects"][:2]
+                    kwargs["Delete"]["Objects"] = kwargs["Delete"]["Objects"][2:]
+                    delete_objects(**kwargs)
+                    return {"Errors": [dict(obj, Code="InternalError", Message="retry") for obj in failed]}
+                return delete_objects(**kwargs)
+        def locked_list_object_versions(**kwargs):
+            with lock:
+                return list_object_versions(**kwargs)
+        monkeypatch.setattr(particle.client, "delete_objects", flaky_delete_objects)
+        monkeypatch.setattr(particle.client, "list_object_versions", locked_list_object_versions)
+        monkeypatch.setattr(S3Bucket, "DELETE_ATTEMPTS", 2)
+        monkeypatch.setattr("time.sleep", lambda seconds: None)
+
+        particle.set_desired_state(State.terminated)
+        particle.apply()
+
+        assert particle.get_state() == State.terminated
+        assert sorted(calls) == [2, 501, 1000]
+
+    @moto.mock_s3
+    def test_buckets_sync_from_inventory(self):
+        pcf_field = PCF([
+            {"pcf_name": "inventory-{}".format(i), "flavor": "s3_bucket",
+             "aws_resource": {"Bucket": "pcf-inventory-{}".format(i)}}
+            for i in range(5)
+        ])
+        buckets = pcf_field.get_particle_list()
+        BucketInventory.for_particle(buckets[0]).invalidate()
+        lists = metrics.API_CALLS.get(service="s3", operation="ListBuckets")
+        heads = metrics.API_CALLS.get(service="s3", operation="HeadBucket")
+
+        for bucket in buckets:
+            bucket.set_desired_state(State.running)
+        pcf_field.apply()
+
+        assert all(bucket.get_state() == State.running for bucket in buckets)
+        assert metrics.API_CALLS.get(service="s3", operation="ListBuckets") == lists + 1
+        assert metrics.API_CALLS.get(service="s3", operation="HeadBucket") == heads
+
+        # a bucket on its own is checked with head_bucket
+        bucket = S3Bucket({"pcf_name": "single", "flavor": "s3_bucket", "aws_resource": {"Bucket": "pcf-inventory-0"}})
+        assert bucket.get_state() == State.running
+        assert metrics.API_CALLS.get(service="s3", operation="HeadBucket") == heads + 1
+
+        for bucket in buckets:
+            bucket.set_desired_state(State.terminated)
+        pcf_field.apply()
+
+        assert all(bucket.get_state() == State.terminated for bucket in buckets)
+        assert metrics.API_CALLS.get(service="s3", operation="ListBuckets") == lists + 1
+
+    @moto.mock_s3
+    def test_inaccessible_buckets_are_not_missing(self, monkeypatch):
+        bucket = S3Bucket({"pcf_name": "foreign", "flavor": "s3_bucket", "aws_resource": {"Bucket": "pcf-foreign"}})
+        assert bucket.get_state() == State.terminated
+
+        def forbidden_head_bucket(**kwargs):
+            raise ClientError({"Error": {"Code": "403", "Message": "Forbidden"}}, "HeadBucket")
+        monkeypatch.setattr(bucket.client, "head_bucket", forbidden_head_bucket)
+        bucket.state_dirty = True
+        with pytest.raises(ClientError):
+            bucket.get_state()
+
+    @moto.mock_s3
+    def test_inventories_are_shared_across_regions(self):
+        pcf_field = PCF([
+            {"pcf_name": "bucket-{}".format(region), "flavor": "s3_bucket",
+             "aws_resource": {"Bucket": "pcf-{}".format(region), "region_name": region}}
+            for region in ("us-east-1", "eu-west-1", "ap-south-1")
+        ])
+        buckets = pcf_field.get_particle_list()
+        inventories = [BucketInventory.for_particle(bucket) for bucket in buckets]
+        assert all(inventory is inventories[0] for inventory in inventories)
+        BucketInventory.for_particle(buckets[0]).invalidate()
+        lists = metrics.API_CALLS.get(service="s3", operation="ListBuckets")
+
+        assert all(bucket.get_state() == State.terminated for bucket in buckets)
+        assert metrics.API_CALLS.get(service="s3", operation="ListBuckets") == lists + 1
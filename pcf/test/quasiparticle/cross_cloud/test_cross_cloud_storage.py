@@ -0,0 +1,55 @@
+# Copyright 2018 Capital One Services, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import moto
+
+from pcf.quasiparticle.cross_cloud.cross_cloud_storage.cross_cloud_storage import CrossCloudStorage
+from pcf.util import metrics
+
+
+@moto.mock_s3
+def test_put_and_delete_objects(tmpdir, monkeypatch):
+    # usage of examples/quasiparticle/cross_cloud/cross_cloud_storage.py, the gcp side is recorded
+    cross_cloud_storage = CrossCloudStorage({
+        "pcf_name": "cross_cloud_storage",
+        "flavor": "cross_cloud_storage",
+        "storage_name": "pcf-testing",
+    })
+    blobs = {}
+    monkeypatch.setattr(cross_cloud_storage.storage, "put_object",
+                        lambda blob_name, file_obj: blobs.__setitem__(blob_name, file_obj))
+    monkeypatch.setattr(cross_cloud_storage.storage, "put_file",
+                        lambda blob_name, file: blobs.__setitem__(blob_name, open(file, "rb").read()))
+    monkeypatch.setattr(cross_cloud_storage.storage, "delete_object", lambda blob_name: blobs.pop(blob_name))
+    client = cross_cloud_storage.s3.client
+    client.create_bucket(Bucket="pcf-testing")
+    test_file = tmpdir.join("test.txt")
+    test_file.write("file data")
+    taggings = metrics.API_CALLS.get(service="s3", operation="PutObjectTagging")
+
+    cross_cloud_storage.put_object(Bucket="pcf-testing", Key="data-object", Body=b"Here we have some data")
+    cross_cloud_storage.put_object(Bucket="pcf-testing", Key="text-object", Body="some text")
+    cross_cloud_storage.put_object(Bucket="pcf-testing", Key="data-file", Filename=str(test_file))
+
+    assert client.get_object(Bucket="pcf-testing", Key="data-object")["Body"].read() == b"Here we have some data"
+    assert client.get_object(Bucket="pcf-testing", Key="text-object")["Body"].read() == b"some text"
+    assert client.get_object(Bucket="pcf-testing", Key="data-file")["Body"].read() == b"file data"
+    assert blobs == {"data-object": b"Here we have some data", "text-object": b"some text", "data-file": b"file data"}
+    # objects are not tagged with checksums, which would need s3:PutObjectTagging
+    assert metrics.API_CALLS.get(service="s3", operation="PutObjectTagging") == taggings
+
+    for key in ("data-object", "text-object", "data-file"):
+        cross_cloud_storage.delete_object(Bucket="pcf-testing", Key=key)
+    assert client.list_objects_v2(Bucket="pcf-testing").get("KeyCount") == 0
+    assert blobs == {}
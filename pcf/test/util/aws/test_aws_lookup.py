@@ -15,10 +15,15 @@
 import moto
 import boto3
 import os
+import pytest
 
 from pcf.particle.aws.ec2.ec2_instance import EC2Instance
 from pcf.core.aws_resource import AWSResource
 from pcf.core import State
+from pcf.core.pcf_exceptions import ResourceLookupNotDefinedException
+from pcf.util import metrics
+from pcf.util.aws import aws_lookup
+from pcf.util.aws.aws_lookup import AWSLookup
 
 os.environ['AWS_DEFAULT_REGION'] = "us-east-1"
 
@@ -129,3 +134,88 @@ class TestLookup:
         assert particle.desired_state_definition["ImageId"][:3] == "ami"
         assert particle.desired_state_definition["SubnetId"][:6] == "subnet"
         #assert particle.desired_state_definition["IamInstanceProfile"]["Arn"] == "arn:aws:iam::123456789012:instance-profile/InstanceProfile-Default"
+
+
+def make_subnets(ec2_client, names):
+    vpc_id = ec2_client.create_vpc(CidrBlock='10.0.0.0/16')['Vpc']['VpcId']
+    subnet_ids = {}
+    for index, name in enumerate(names):
+        subnet_id = ec2_client.create_subnet(VpcId=vpc_id, CidrBlock='10.0.{}.0/24'.format(index))['Subnet']['SubnetId']
+        ec2_client.create_tags(Resources=[subnet_id], Tags=[{'Key': 'Name', 'Value': name}])
+        subnet_ids[name] = subnet_id
+    return subnet_ids
+
+
+@moto.mock_ec2
+def test_batched_lookups():
+    subnet_ids = make_subnets(boto3.client('ec2', 'us-east-1'), ["Public", "Private"])
+    particles = [
+        EC2Instance({
+            "pcf_name": "instance-{}".format(i),
+            "flavor": "ec2_instance",
+            "aws_resource": {
+                "custom_config": {"instance_name": "instance-{}".format(i)},
+                "SubnetId": "$lookup$subnet$" + ("Public" if i % 2 else "Private"),
+                "ImageId": "$lookup$ami$missing-image",
+            }
+        })
+        for i in range(20)
+    ]
+    describe_subnets = metrics.API_CALLS.get(service="ec2", operation="DescribeSubnets")
+
+    aws_lookup.prefetch_lookups(particles)
+    assert metrics.API_CALLS.get(service="ec2", operation="DescribeSubnets") == describe_subnets + 1
+
+    for particle in particles[:2]:
+        # the missing ami is looked up again and fails like before
+        with pytest.raises(ResourceLookupNotDefinedException):
+            particle.id_replace()
+    assert metrics.API_CALLS.get(service="ec2", operation="DescribeSubnets") == describe_subnets + 1
+    assert particles[0].desired_state_definition["SubnetId"] == subnet_ids["Private"]
+    assert particles[1].desired_state_definition["SubnetId"] == subnet_ids["Public"]
+
+
+@moto.mock_ec2
+def test_lookup_cache():
+    lookup = AWSLookup()
+    with pytest.raises(ResourceLookupNotDefinedException):
+        lookup.get_id("subnet", ["Public"])
+    # missing resources are not cached since they may be created later in the same apply
+    assert len(AWSLookup.cache) == 0
+
+    subnet_ids = make_subnets(boto3.client('ec2', 'us-east-1'), ["Public"])
+    describe_subnets = metrics.API_CALLS.get(service="ec2", operation="DescribeSubnets")
+    assert lookup.get_id("subnet", ["Public"]) == subnet_ids["Public"]
+    assert AWSLookup().get_id("subnet", ["Public"]) == subnet_ids["Public"]
+    assert metrics.API_CALLS.get(service="ec2", operation="DescribeSubnets") == describe_subnets + 1
+
+
+@moto.mock_ec2
+def test_region_aware_lookups():
+    subnet_ids = {
+        region: make_subnets(boto3.client('ec2', region), ["Public"])["Public"]
+        for region in ("us-east-1", "us-west-2", "eu-west-1")
+    }
+    particles = [
+        EC2Instance({
+            "pcf_name": "instance-" + region,
+            "flavor": "ec2_instance",
+            "aws_resource": {
+                "region_name": region,
+                "custom_config": {"instance_name": "instance-" + region},
+                "SubnetId": "$lookup$subnet$Public",
+            }
+        })
+        for region in subnet_ids
+    ]
+
+    aws_lookup.prefetch_lookups(particles)
+    assert len(AWSLookup.cache) == 3
+
+    for particle in particles:
+        particle.id_replace()
+        region = particle.particle_definition["aws_resource"]["region_name"]
+        assert particle.desired_state_definition["SubnetId"] == subnet_ids[region]
+
+    session = boto3.session.Session(region_name="us-west-2")
+    assert AWSLookup(session=session).get_id("subnet", ["Public"]) == subnet_ids["us-west-2"]
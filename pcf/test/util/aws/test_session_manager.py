@@ -0,0 +1,69 @@
+# Copyright 2018 Capital One Services, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import moto
+import pytest
+
+from pcf.core.aws_resource import AWSResource
+from pcf.core.pcf_exceptions import MissingInput
+from pcf.particle.aws.sqs.sqs_queue import SQSQueue
+from pcf.util import metrics
+from pcf.util.aws.session_manager import SessionManager
+
+
+@moto.mock_sts
+def test_sessions_are_cached_per_role():
+    manager = SessionManager(role_name="deployer", refresh_margin=120)
+    assume_role_calls = metrics.API_CALLS.get(service="sts", operation="AssumeRole")
+
+    session = manager.get_session(account="111111111111")
+    assert manager.get_session(role_arn="arn:aws:iam::111111111111:role/deployer") is session
+    assert manager.get_session(account="222222222222") is not session
+    assert metrics.API_CALLS.get(service="sts", operation="AssumeRole") == assume_role_calls + 2
+
+    credentials = session.get_credentials()
+    assert credentials.method == "sts-assume-role"
+    assert credentials._advisory_refresh_timeout == 120
+    assert manager.manages(session)
+
+    client = manager.client("sqs", account="111111111111", region_name="us-east-1")
+    assert manager.client("sqs", account="111111111111", region_name="us-east-1") is client
+
+
+def test_role_arn():
+    assert SessionManager(role_name="deployer").role_arn(account="1") == "arn:aws:iam::1:role/deployer"
+    assert SessionManager().role_arn(role_arn="arn:aws:iam::1:role/x") == "arn:aws:iam::1:role/x"
+    with pytest.raises(MissingInput):
+        SessionManager(role_name=None).role_arn()
+
+
+@moto.mock_sqs
+@moto.mock_sts
+def test_particles_use_managed_sessions(monkeypatch):
+    manager = SessionManager(role_name="deployer")
+    monkeypatch.setattr(AWSResource, "session_manager", manager)
+
+    def queue(name, account):
+        return SQSQueue({
+            "pcf_name": name,
+            "flavor": "sqs_queue",
+            "account": account,
+            "aws_resource": {"QueueName": name, "region_name": "us-east-1"},
+        })
+
+    first, second, other = queue("first", "111111111111"), queue("second", "111111111111"), queue("other", "222222222222")
+    assert first.session is second.session
+    assert first.session is not other.session
+    assert first.client is second.client
+    assert first.client is not other.client
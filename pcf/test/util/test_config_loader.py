@@ -0,0 +1,272 @@
+# Copyright 2018 Capital One Services, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import json
+import os
+import pytest
+import stat
+import time
+import yaml
+
+from pcf.util import config_loader
+from pcf.cli.utils import particles_from_file
+from pcf.particle.aws.ec2.ec2_instance import EC2Instance
+
+PARTICLES = [
+    {
+        "pcf_name": "parent",
+        "flavor": "ec2_instance",
+        "aws_resource": {"custom_config": {"instance_name": "parent"}}
+    },
+    {
+        "pcf_name": "child",
+        "flavor": "ec2_instance",
+        "parents": ["ec2_instance:parent"],
+        "aws_resource": {"custom_config": {"instance_name": "child", "note": "näme ✓"}}
+    },
+    {
+        "pcf_name": "unrelated",
+        "flavor": "ec2_instance",
+        "aws_resource": {"custom_config": {"instance_name": "unrelated", "size": 12345}}
+    },
+    "not a particle"
+]
+
+
+@pytest.fixture
+def json_config(tmpdir):
+    filename = str(tmpdir.join("fleet.json"))
+    with open(filename, "w", encoding="utf-8") as config_file:
+        json.dump(PARTICLES, config_file, indent=2, ensure_ascii=False)
+    return filename
+
+
+@pytest.fixture
+def yaml_config(tmpdir):
+    filename = str(tmpdir.join("fleet.yml"))
+    with open(filename, "w", encoding="utf-8") as config_file:
+        yaml.safe_dump(PARTICLES, config_file, allow_unicode=True)
+    return filename
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, config_loader.CHUNK_SIZE])
+def test_iter_json_entries(json_config, chunk_size):
+    entries = list(config_loader.iter_json_entries(json_config, chunk_size=chunk_size))
+    assert [entry for _, _, entry in entries] == PARTICLES
+
+    for offset, length, entry in entries:
+        assert config_loader.load_json_entry(json_config, offset, length) == entry
+
+
+def test_iter_json_single_entry(tmpdir):
+    filename = str(tmpdir.join("single.json"))
+    with open(filename, "w") as config_file:
+        json.dump(PARTICLES[0], config_file)
+    assert list(config_loader.iter_config_entries(filename)) == [PARTICLES[0]]
+
+
+@pytest.mark.parametrize("chunk_size", [1, config_loader.CHUNK_SIZE])
+def test_iter_json_entries_mixed_escapes(tmpdir, chunk_size):
+    filename = str(tmpdir.join("mixed.json"))
+    with open(filename, "wb") as config_file:
+        config_file.write('[{"pcf_name": "caf\\u00e9"}, {"pcf_name": "café"}, {"pcf_name": "\\u2603 ☃"}]'.encode("utf-8"))
+    with open(filename, encoding="utf-8") as config_file:
+        expected = json.load(config_file)
+    entries = list(config_loader.iter_json_entries(filename, chunk_size=chunk_size))
+    assert [entry for _, _, entry in entries] == expected
+    for offset, length, entry in entries:
+        assert config_loader.load_json_entry(filename, offset, length) == entry
+
+
+def test_iter_json_entries_invalid(tmpdir):
+    filename = str(tmpdir.join("bad.json"))
+    with open(filename, "w") as config_file:
+        config_file.write('[{"pcf_name": "a"} {"pcf_name": "b"}]')
+    with pytest.raises(ValueError):
+        list(config_loader.iter_config_entries(filename))
+
+
+def test_iter_yaml_entries(yaml_config):
+    assert list(config_loader.iter_config_entries(yaml_config)) == PARTICLES
+
+
+@pytest.mark.parametrize("config", ["json_config", "yaml_config"])
+def test_build_config_index(config, request):
+    filename = request.getfixturevalue(config)
+    index = config_loader.build_config_index(filename)
+    assert sorted(index) == ["child", "parent", "unrelated"]
+    assert index["child"].parents == ["ec2_instance:parent"]
+    assert config_loader.load_index_entry(filename, index["child"]) == PARTICLES[1]
+    assert config_loader.dependency_closure(index, "child") == ["child", "parent"]
+    assert config_loader.dependency_closure(index, "parent") == ["parent"]
+
+
+def test_dependency_closure_children(tmpdir):
+    filename = str(tmpdir.join("fleet.json"))
+    with open(filename, "w") as config_file:
+        json.dump([
+            {"pcf_name": "a", "flavor": "ec2_instance", "children": ["ec2_instance:b"]},
+            {"pcf_name": "b", "flavor": "ec2_instance"},
+        ], config_file)
+    index = config_loader.build_config_index(filename)
+    assert config_loader.dependency_closure(index, "b") == ["b", "a"]
+
+
+@pytest.mark.parametrize("config", ["json_config", "yaml_config"])
+def test_particles_from_file_loads_closure(config, request):
+    filename = request.getfixturevalue(config)
+    particle = particles_from_file("child", filename, quiet=True)[0]
+    assert isinstance(particle, EC2Instance)
+    assert [parent.name for parent in particle.parents] == ["parent"]
+    assert particle.particle_definition == PARTICLES[1]
+
+    particles = particles_from_file(None, filename, quiet=True)
+    assert [p.name for p in particles] == ["parent", "child", "unrelated"]
+
+
+@pytest.mark.parametrize("config", ["json_config", "yaml_config"])
+def test_config_cache(config, request, config_cache_dir, monkeypatch):
+    filename = request.getfixturevalue(config)
+    is_json = config_loader.is_json_file(filename)
+    assert list(config_loader.load_config_entries(filename)) == PARTICLES
+    index = config_loader.load_config_index(filename)
+    # json entries are streamed from the config file itself
+    assert len(os.listdir(config_cache_dir)) == (1 if is_json else 2)
+    assert all(name.endswith(".json") for name in os.listdir(config_cache_dir))
+
+    def no_parsing(*args, **kwargs):
+        raise AssertionError("config file was parsed again")
+
+    monkeypatch.setattr(config_loader, "build_config_index", no_parsing)
+    if not is_json:
+        monkeypatch.setattr(config_loader, "iter_config_entries", no_parsing)
+        assert list(config_loader.load_config_entries(filename)) == PARTICLES
+        with pytest.raises(AssertionError):
+            config_loader.load_config_entries(filename, use_cache=False)
+    cached_index = config_loader.load_config_index(filename)
+    assert sorted(cached_index) == sorted(index)
+    for name, config_entry in index.items():
+        assert cached_index[name].to_json() == config_entry.to_json()
+
+    # a changed file gets a new cache entry
+    with open(filename, "a") as config_file:
+        config_file.write("\n")
+    with pytest.raises(AssertionError):
+        config_loader.load_config_index(filename)
+
+
+def test_config_cache_is_private(yaml_config, config_cache_dir, monkeypatch):
+    list(config_loader.load_config_entries(yaml_config))
+    assert stat.S_IMODE(os.stat(config_cache_dir).st_mode) == 0o700
+    cache_path = config_loader._cache_path(config_loader.config_file_hash(yaml_config), "entries", config_cache_dir)
+    assert stat.S_IMODE(os.stat(cache_path).st_mode) == 0o600
+
+    # a cache that others could have written to is parsed again rather than trusted
+    with open(cache_path, "w") as cache_file:
+        cache_file.write(json.dumps({"pcf_name": "injected"}) + "\n")
+    os.chmod(cache_path, 0o666)
+    assert list(config_loader.load_config_entries(yaml_config)) == PARTICLES
+    assert list(config_loader.load_config_entries(yaml_config)) == PARTICLES
+
+    if hasattr(os, "getuid"):
+        monkeypatch.setattr(os, "getuid", lambda: os.stat(cache_path).st_uid + 1)
+        parsed = []
+        monkeypatch.setattr(config_loader, "build_config_index", lambda filename: parsed.append(filename) or {})
+        config_loader.load_config_index(yaml_config)
+        config_loader.load_config_index(yaml_config)
+        assert parsed == [yaml_config, yaml_config]
+
+
+def test_config_cache_skips_non_json_values(tmpdir, config_cache_dir):
+    filename = str(tmpdir.join("dates.yml"))
+    with open(filename, "w") as config_file:
+        config_file.write("- pcf_name: dated\n  flavor: ec2_instance\n  created: 2018-01-01\n  sizes: {1: small}\n")
+    entries = list(config_loader.load_config_entries(filename))
+    assert entries[0]["created"] == datetime.date(2018, 1, 1)
+    assert config_loader.load_config_index(filename)["dated"].definition == entries[0]
+    assert not os.path.exists(config_cache_dir) or os.listdir(config_cache_dir) == []
+    assert list(config_loader.load_config_entries(filename)) == entries
+
+
+def _best_time(load, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        load()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def test_config_cache_beats_parsing(tmpdir, config_cache_dir):
+    particles = [
+        {
+            "pcf_name": "instance-{}".format(i),
+            "flavor": "ec2_instance",
+            "parents": ["ec2_instance:instance-{}".format(i - 1)],
+            "aws_resource": {
+                "custom_config": {"instance_name": "instance-{}".format(i), "tags": {"team": "x" * 20}},
+                "ImageId": "ami-11111111",
+                "InstanceType": "m4.large",
+                "SecurityGroupIds": ["sg-11111111", "sg-22222222"]
+            }
+        } for i in range(1000)]
+    json_config = str(tmpdir.join("large.json"))
+    with open(json_config, "w") as config_file:
+        json.dump(particles, config_file)
+    yaml_config = str(tmpdir.join("large.yml"))
+    with open(yaml_config, "w") as config_file:
+        yaml.safe_dump(particles, config_file)
+
+    def load_entries(**kwargs):
+        return list(config_loader.load_config_entries(yaml_config, **kwargs))
+
+    assert load_entries() == particles
+    # yaml parsing is far slower than reading the cached json, the margin keeps this stable on busy machines
+    assert 3 * _best_time(load_entries) < _best_time(lambda: load_entries(use_cache=False))
+
+    for filename in (json_config, yaml_config):
+        config_loader.load_config_index(filename)
+        cached = _best_time(lambda: config_loader.load_config_index(filename))
+        parsed = _best_time(lambda: config_loader.load_config_index(filename, use_cache=False))
+        assert cached < parsed
+
+
+def test_config_cache_is_only_kept_complete(yaml_config, config_cache_dir):
+    entries = config_loader.load_config_entries(yaml_config)
+    assert next(entries) == PARTICLES[0]
+    entries.close()
+    assert not os.path.exists(config_cache_dir) or os.listdir(config_cache_dir) == []
+
+
+def test_config_cache_eviction(tmpdir, config_cache_dir, monkeypatch):
+    caches = []
+    for i in range(3):
+        filename = str(tmpdir.join("pcf-{}.yml".format(i)))
+        with open(filename, "w") as config_file:
+            yaml.safe_dump(PARTICLES + [i], config_file)
+        cache_path = config_loader._cache_path(config_loader.config_file_hash(filename), "entries", config_cache_dir)
+        caches.append((filename, cache_path))
+
+    for filename, _ in caches[:2]:
+        list(config_loader.load_config_entries(filename))
+    os.utime(caches[0][1], (1, 1))
+    os.utime(caches[1][1], (2, 2))
+    # using a cache makes it the most recently used one
+    list(config_loader.load_config_entries(caches[0][0]))
+
+    monkeypatch.setattr(config_loader, "CACHE_MAX_SIZE", 2 * os.path.getsize(caches[0][1]))
+    list(config_loader.load_config_entries(caches[2][0]))
+    assert [os.path.exists(cache_path) for _filename, cache_path in caches] == [True, False, True]
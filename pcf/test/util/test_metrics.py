@@ -0,0 +1,131 @@
+# Copyright 2018 Capital One Services, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import boto3
+import pytest
+import urllib.request
+
+from moto import mock_s3
+from pcf.core import State
+from pcf.core.particle import Particle
+from pcf.util import metrics
+
+
+class MetricsParticle(Particle):
+    flavor = "metrics_particle"
+
+    def __init__(self, particle_definition):
+        super(MetricsParticle, self).__init__(particle_definition)
+        self.desired_state_definition = {}
+        self.current_state_definition = {}
+        self.state = State.terminated
+
+    def sync_state(self):
+        pass
+
+    def _start(self):
+        if self.name == "broken":
+            raise Exception("start failed")
+        self.state = State.running
+
+    def _terminate(self):
+        self.state = State.terminated
+
+    def _update(self):
+        pass
+
+
+def test_render():
+    registry = metrics.Registry()
+    counter = registry.counter("test_total", "A counter", ("service",))
+    histogram = registry.histogram("test_seconds", "A histogram", buckets=(1, 10))
+    counter.inc(service='s3 "eu"')
+    counter.inc(2, service='s3 "eu"')
+    histogram.observe(0.5)
+    histogram.observe(5)
+
+    assert registry.counter("test_total", "A counter", ("service",)) is counter
+    with pytest.raises(ValueError):
+        registry.gauge("test_total", "A gauge")
+    with pytest.raises(ValueError):
+        counter.inc(region="us-east-1")
+
+    assert registry.render() == "\n".join([
+        "# HELP test_seconds A histogram",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{le="1"} 1',
+        'test_seconds_bucket{le="10"} 2',
+        'test_seconds_bucket{le="+Inf"} 2',
+        "test_seconds_sum 5.5",
+        "test_seconds_count 2",
+        "# HELP test_total A counter",
+        "# TYPE test_total counter",
+        'test_total{service="s3 \\"eu\\""} 3',
+    ]) + "\n"
+
+
+def test_write_to_file_and_serve(tmpdir):
+    registry = metrics.Registry()
+    registry.gauge("test_depth", "A gauge").set(4)
+
+    filename = str(tmpdir.join("batch", "pcf.prom"))
+    registry.write_to_file(filename)
+    with open(filename) as metrics_file:
+        assert "test_depth 4" in metrics_file.read()
+
+    server = registry.serve(port=0)
+    try:
+        with urllib.request.urlopen("http://{0}:{1}/metrics".format(*server.server_address)) as response:
+            assert response.headers["Content-Type"] == metrics.CONTENT_TYPE
+            assert "test_depth 4" in response.read().decode("utf-8")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_apply_metrics():
+    particle = MetricsParticle({"pcf_name": "good", "flavor": "metrics_particle"})
+    broken = MetricsParticle({"pcf_name": "broken", "flavor": "metrics_particle"})
+    transitions = metrics.TRANSITIONS.get(flavor="metrics_particle", transition="start", outcome="succeeded")
+    failures = metrics.TRANSITIONS.get(flavor="metrics_particle", transition="start", outcome="failed")
+    converged = metrics.CONVERGE_SECONDS.get(flavor="metrics_particle", outcome="converged")
+    cache_hits = metrics.STATE_CACHE.get(flavor="metrics_particle", result="hit")
+
+    particle.set_desired_state(State.running)
+    particle.apply(sync=False)
+    particle.get_state()
+    broken.set_desired_state(State.running)
+    with pytest.raises(Exception):
+        broken.apply(sync=False)
+
+    assert metrics.TRANSITIONS.get(flavor="metrics_particle", transition="start", outcome="succeeded") == transitions + 1
+    assert metrics.TRANSITIONS.get(flavor="metrics_particle", transition="start", outcome="failed") == failures + 1
+    assert metrics.CONVERGE_SECONDS.get(flavor="metrics_particle", outcome="applied") >= 1
+    assert metrics.CONVERGE_SECONDS.get(flavor="metrics_particle", outcome="converged") == converged
+    assert metrics.STATE_CACHE.get(flavor="metrics_particle", result="hit") > cache_hits
+
+
+@mock_s3
+def test_instrument_client():
+    client = metrics.instrument_client(boto3.client("s3", region_name="us-east-1"))
+    assert metrics.instrument_client(client) is client
+    calls = metrics.API_CALLS.get(service="s3", operation="ListBuckets")
+
+    client.list_buckets()
+    assert metrics.API_CALLS.get(service="s3", operation="ListBuckets") == calls + 1
+
+    throttles = metrics.API_THROTTLES.get(service="s3", operation="unknown")
+    metrics._record_throttle("s3", response=(None, {"Error": {"Code": "SlowDown"}}))
+    metrics._record_throttle("s3", response=(None, {"Error": {"Code": "NoSuchKey"}}))
+    assert metrics.API_THROTTLES.get(service="s3", operation="unknown") == throttles + 1
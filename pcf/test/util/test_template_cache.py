@@ -0,0 +1,62 @@
+# Copyright 2018 Capital One Services, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+from jinja2 import Environment
+from pcf.util.template_cache import TemplateCache
+
+
+def count_compiles(monkeypatch):
+    compiles = []
+    compile_templates = Environment.compile
+
+    def compile(self, source, *args, **kwargs):
+        compiles.append(source)
+        return compile_templates(self, source, *args, **kwargs)
+
+    monkeypatch.setattr(Environment, "compile", compile)
+    return compiles
+
+
+def test_file_templates_compile_once(tmpdir, monkeypatch):
+    compiles = count_compiles(monkeypatch)
+    template = tmpdir.join("userdata.sh")
+    template.write("echo {{ name }}")
+    cache = TemplateCache()
+
+    assert [cache.render_file(str(template), {"name": i}) for i in range(500)][-1] == "echo 499"
+    assert cache.render_file(str(template), {"name": 1}) == "echo 1"
+    assert len(compiles) == 1
+
+    template.write("echo hello {{ name }}")
+    os.utime(str(template), (0, 0))
+    assert cache.render_file(str(template), {"name": 1}) == "echo hello 1"
+    assert len(compiles) == 2
+
+
+def test_string_templates_and_bytecode(tmpdir, monkeypatch):
+    compiles = count_compiles(monkeypatch)
+    body = '{"Description": "{{ description }}"}'
+    cache = TemplateCache(bytecode_cache_dir=str(tmpdir.join("bytecode")))
+
+    assert cache.render_string(body, {"description": "a"}) == '{"Description": "a"}'
+    assert cache.render_string(body, {"description": "b"}) == '{"Description": "b"}'
+    assert cache.render_string("{{ 1 + 1 }}") == "2"
+    assert len(compiles) == 2
+
+    # a new process reuses the compiled bytecode
+    assert TemplateCache(bytecode_cache_dir=str(tmpdir.join("bytecode"))).render_string(body, {"description": "c"}) == \
+        '{"Description": "c"}'
+    assert len(compiles) == 2
@@ -0,0 +1,119 @@
+# Copyright 2018 Capital One Services, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tracemalloc
+import zipfile
+
+from pcf.util.zip_builder import ZipBuilder
+
+
+def make_tree(root):
+    package = root.join("package")
+    package.join("__init__.py").write("", ensure=True)
+    package.join("core.py").write("value = 1\n" * 1000)
+    package.join("data", "big.txt").write("pcf " * 100000, ensure=True)
+    handler = root.join("handler.py")
+    handler.write("def handler(event, context):\n    return event\n")
+    return package, handler
+
+
+def build(root, package, handler, name="function.zip", **kwargs):
+    builder = ZipBuilder(str(root.join(name)), **kwargs)
+    builder.add(str(package), "package")
+    builder.add(str(handler), "handler.py")
+    return builder, builder.build()
+
+
+def test_zip_is_deterministic_and_valid(tmpdir):
+    package, handler = make_tree(tmpdir)
+    build(tmpdir, package, handler, "first.zip")
+    os.utime(str(handler), (0, 0))
+    build(tmpdir, package, handler, "second.zip", max_workers=2, parallel_threshold=0)
+
+    assert tmpdir.join("first.zip").read_binary() == tmpdir.join("second.zip").read_binary()
+    with zipfile.ZipFile(str(tmpdir.join("first.zip"))) as archive:
+        assert archive.testzip() is None
+        assert archive.namelist() == ["handler.py", "package/__init__.py", "package/core.py", "package/data/big.txt"]
+        assert archive.read("package/data/big.txt") == b"pcf " * 100000
+        assert {info.date_time for info in archive.infolist()} == {(1980, 1, 1, 0, 0, 0)}
+
+
+def test_incremental_rebuild(tmpdir):
+    package, handler = make_tree(tmpdir)
+    builder, changed = build(tmpdir, package, handler)
+    assert changed and builder.compressed == 4
+    mtime = tmpdir.join("function.zip").mtime()
+
+    # touched but unchanged files are hashed, not compressed, and the zip is left alone
+    os.utime(str(package.join("core.py")), (0, 0))
+    builder, changed = build(tmpdir, package, handler)
+    assert not changed
+    assert (builder.reused, builder.compressed) == (4, 0)
+    assert tmpdir.join("function.zip").mtime() == mtime
+
+    handler.write("def handler(event, context):\n    return None\n")
+    builder, changed = build(tmpdir, package, handler)
+    assert changed
+    assert (builder.reused, builder.compressed) == (3, 1)
+    with zipfile.ZipFile(str(tmpdir.join("function.zip"))) as archive:
+        assert archive.testzip() is None
+        assert archive.read("handler.py").endswith(b"return None\n")
+        assert archive.read("package/core.py") == b"value = 1\n" * 1000
+
+    # a zip changed behind the manifest's back is rebuilt from scratch
+    tmpdir.join("function.zip").write_binary(b"")
+    builder, changed = build(tmpdir, package, handler)
+    assert changed and builder.compressed == 4
+
+
+def test_entries_are_streamed(tmpdir):
+    # random bytes do not compress, so a buffered entry would take as much memory as the file
+    content = os.urandom(16 * 1024 * 1024)
+    tmpdir.join("big.bin").write_binary(content)
+    small = tmpdir.join("small.txt")
+    small.write("small")
+
+    def build_peak(**kwargs):
+        builder = ZipBuilder(str(tmpdir.join("stream.zip")), **kwargs)
+        builder.add(str(tmpdir.join("big.bin")), "big.bin")
+        builder.add(str(small), "small.txt")
+        tracemalloc.start()
+        builder.build()
+        _current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return builder, peak
+
+    # compressed straight into the zip
+    builder, peak = build_peak(max_workers=1)
+    assert builder.compressed == 2
+    assert peak < 4 * 1024 * 1024, "peak: {}".format(peak)
+
+    # reused entries are copied from the previous zip in chunks
+    small.write("changed")
+    builder, peak = build_peak(max_workers=1)
+    assert (builder.reused, builder.compressed) == (1, 1)
+    assert peak < 4 * 1024 * 1024, "peak: {}".format(peak)
+
+    # entries compressed by worker processes are copied from their spool files, which are removed afterwards
+    tmpdir.join("stream.zip").remove()
+    builder, peak = build_peak(max_workers=2, parallel_threshold=0)
+    assert builder.compressed == 2
+    assert peak < 4 * 1024 * 1024, "peak: {}".format(peak)
+    assert sorted(os.listdir(str(tmpdir))) == ["big.bin", "small.txt", "stream.zip", "stream.zip.manifest.json"]
+
+    with zipfile.ZipFile(str(tmpdir.join("stream.zip"))) as archive:
+        assert archive.testzip() is None
+        assert archive.read("big.bin") == content
+        assert archive.read("small.txt") == b"changed"
@@ -13,45 +13,146 @@
 # limitations under the License.
 
 import boto3
+import logging
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pcf.core.pcf_exceptions import InvalidValueReplaceException
 from pcf.core.pcf_exceptions import ResourceLookupNotDefinedException
+from pcf.util.aws.client_pool import ClientPool
+
+logger = logging.getLogger(__name__)
+
+
+class LookupCache(object):
+    """
+    Thread safe cache of resolved lookups that expire after ttl seconds. Only found ids are cached since a missing
+    resource may be created later in the same apply.
+    """
+
+    def __init__(self, ttl=300):
+        """
+        Args:
+            ttl (float): seconds a resolved id is cached for
+        """
+        self.ttl = ttl
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns:
+            cached id or None when missing or expired
+        """
+        with self._lock:
+            cached = self._values.get(key)
+            if cached is None:
+                return None
+            value, expires = cached
+            if expires < time.time():
+                del self._values[key]
+                return None
+            return value
+
+    def set(self, key, value):
+        if value is None:
+            return
+        with self._lock:
+            self._values[key] = (value, time.time() + self.ttl)
+
+    def clear(self):
+        with self._lock:
+            self._values = {}
+
+    def __len__(self):
+        return len(self._values)
 
 
 class AWSLookup:
     """
-    Class of all the AWS lookup resources
+    Class of all the AWS lookup resources. Lookups run against the region and session they are created with.
+    Resolved ids are shared by all lookups through a TTL cache keyed by resource, names, region and session, and
+    clients come from a shared ClientPool so each region and session gets its own cached client.
 
     """
     methods = locals()
     region_name = os.environ.get('AWS_DEFAULT_REGION', 'us-east-1')
+    cache = LookupCache()
+    client_pool = ClientPool()
 
-    def __init__(self):
-        self._ec2_client = None
+    def __init__(self, region_name=None, session=None):
+        """
+        Args:
+            region_name (str): region to look resources up in, defaults to the session region or AWS_DEFAULT_REGION
+            session (boto3.session.Session): session used for the lookups, defaults to the boto3 default session
+        """
+        self.session = session
+        self.region_name = region_name or (session.region_name if session else None) or self.region_name
         self._ec2_resource = None
 
+    @property
+    def target(self):
+        """
+        Returns:
+            hashable (lookup class, region, session) that lookups sharing clients and cached ids have in common
+        """
+        return (type(self), self.region_name, self.session)
+
+    def _cache_key(self, resource, names):
+        return (resource, tuple(names), self.region_name, self.session)
+
     def get_id(self, resource, names):
         method = self.methods.get(resource)
         if not method:
             raise ResourceLookupNotDefinedException("{} resource lookup does not exist".format(resource))
-        resource_id = method(self, names)
+        cache_key = self._cache_key(resource, names)
+        resource_id = self.cache.get(cache_key)
+        if resource_id is None:
+            resource_id = method(self, names)
+            self.cache.set(cache_key, resource_id)
         if not resource_id:
             raise ResourceLookupNotDefinedException("No {} resource with {} name".format(resource, names))
         return resource_id
 
+    def prefetch(self, lookups):
+        """
+        Resolves many lookups into the cache. Uncached single name lookups of the same resource are gathered into one
+        filtered describe call, everything else is left to get_id(). Names that do not resolve to exactly one id are
+        not cached, so get_id() reports them the same way as an unbatched lookup.
+
+        Args:
+            lookups (list): (resource, names) tuples, ie from AWSResource.get_lookups()
+        """
+        pending = {}
+        for resource, names in lookups:
+            if resource in self.batch_methods and len(names) == 1 and self.cache.get(self._cache_key(resource, names)) is None:
+                pending.setdefault(resource, set()).add(names[0])
+
+        for resource, names in pending.items():
+            try:
+                found = self.batch_methods[resource](self, sorted(names))
+            except Exception as error:
+                logger.debug("Batched {0} lookup failed with {1}".format(resource, error))
+                continue
+            for name, ids in found.items():
+                if len(ids) == 1:
+                    self.cache.set(self._cache_key(resource, [name]), ids[0])
+
     @property
     def ec2_client(self):
-        if not self._ec2_client:
-            self._ec2_client = boto3.client("ec2", region_name=self.region_name)
-        return self._ec2_client
+        return self.client_pool.client("ec2", session=self.session, region_name=self.region_name)
+
+    @property
+    def iam_client(self):
+        return self.client_pool.client("iam", session=self.session)
 
     @property
     def ec2_resource(self):
         if not self._ec2_resource:
-            self._ec2_resource = boto3.resource("ec2", region_name=self.region_name)
+            self._ec2_resource = (self.session or boto3).resource("ec2", region_name=self.region_name)
         return self._ec2_resource
 
-
     def ami(self, names):
         """
         Uses boto3 api call to get ami id
@@ -59,15 +160,15 @@ class AWSLookup:
         Returns:
             Image ID with corresponding Image name
         """
-        images = self.ec2_resource.images.filter(
+        images = self.ec2_client.describe_images(
             Filters=[
                 {
                     'Name': 'name',
                     'Values': names
                 },
             ],
-        )
-        image_id = [image.image_id for image in images]
+        )["Images"]
+        image_id = [image["ImageId"] for image in images]
         if len(image_id) > 1:
             raise InvalidValueReplaceException("Ami name returned more than one id")
         if not image_id:
@@ -141,7 +242,7 @@ class AWSLookup:
         Returns:
             Either instance profile or role with given name
         """
-        iam = boto3.client("iam")
+        iam = self.iam_client
         try:
             arn_type = names[0]
             name = names[1]
@@ -154,3 +255,83 @@ class AWSLookup:
         except Exception:
             return None
 
+    def _batch_ami(self, names):
+        """
+        Returns:
+            dict of image name to the ids of the images with that name
+        """
+        found = {}
+        images = self.ec2_client.describe_images(Filters=[{'Name': 'name', 'Values': names}])["Images"]
+        for image in images:
+            found.setdefault(image.get("Name"), []).append(image["ImageId"])
+        return found
+
+    def _batch_instance_name(self, names):
+        """
+        Returns:
+            dict of instance id to its PCFName tag values
+        """
+        found = {}
+        paginator = self.ec2_client.get_paginator("describe_tags")
+        filters = [{'Name': 'resource-id', 'Values': names}, {'Name': 'key', 'Values': ['PCFName']}]
+        for page in paginator.paginate(Filters=filters):
+            for tag in page["Tags"]:
+                found.setdefault(tag["ResourceId"], []).append(tag["Value"])
+        return found
+
+    def _batch_tagged(self, operation, result_key, id_key, names):
+        found = {}
+        response = getattr(self.ec2_client, operation)(Filters=[{'Name': 'tag:Name', 'Values': names}])
+        for item in response[result_key]:
+            for tag in item.get("Tags", []):
+                # like subnet() and snapshot(), the first match of a name wins
+                if tag["Key"] == "Name" and tag["Value"] in names and tag["Value"] not in found:
+                    found[tag["Value"]] = [item[id_key]]
+        return found
+
+    def _batch_subnet(self, names):
+        """
+        Returns:
+            dict of subnet name to the first subnet id with that name
+        """
+        return self._batch_tagged("describe_subnets", "Subnets", "SubnetId", names)
+
+    def _batch_snapshot(self, names):
+        """
+        Returns:
+            dict of snapshot name to the first snapshot id with that name
+        """
+        return self._batch_tagged("describe_snapshots", "Snapshots", "SnapshotId", names)
+
+    batch_methods = {
+        "ami": _batch_ami,
+        "instance_name": _batch_instance_name,
+        "subnet": _batch_subnet,
+        "snapshot": _batch_snapshot,
+    }
+
+
+def prefetch_lookups(particles, max_workers=10):
+    """
+    Resolves the lookups of many particles with batched describe calls before they are applied, so that their
+    id_replace() is served from the lookup cache. Lookups are grouped by region and session and the groups are
+    resolved concurrently. Particles without lookups are ignored.
+
+    Args:
+        particles (list): particles, ie from PCF.get_particle_list()
+        max_workers (int): number of regions and sessions resolved concurrently
+    """
+    targets = {}
+    for particle in particles:
+        get_lookups = getattr(particle, "get_lookups", None)
+        particle_lookups = get_lookups() if get_lookups else None
+        if particle_lookups:
+            aws_lookup = particle.get_lookup()
+            targets.setdefault(aws_lookup.target, (aws_lookup, []))[1].extend(particle_lookups)
+
+    if len(targets) == 1:
+        aws_lookup, target_lookups = list(targets.values())[0]
+        aws_lookup.prefetch(target_lookups)
+    elif targets:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(targets))) as executor:
+            list(executor.map(lambda target: target[0].prefetch(target[1]), targets.values()))
@@ -0,0 +1,66 @@
+# Copyright 2018 Capital One Services, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+
+import boto3
+
+from pcf.util import metrics
+
+
+class ClientPool(object):
+    """
+    Thread safe cache of boto3 clients. Creating a client loads and parses the service model, so particles that share
+    a pool only pay for it once per service, region and session. boto3 clients are thread safe, resources are not and
+    are never pooled.
+    """
+
+    def __init__(self):
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(service_name, session, kwargs):
+        # sessions hash by identity and are kept alive by the key
+        return (service_name, session, tuple(sorted(kwargs.items())))
+
+    def client(self, service_name, session=None, **kwargs):
+        """
+        Args:
+            service_name (str): boto3 service name (ie ec2)
+            session (boto3.session.Session): session used to create the client, defaults to the boto3 default session
+            **kwargs: passed to client(), ie region_name
+
+        Returns:
+            boto3 client
+        """
+        key = self._key(service_name, session, kwargs)
+        client = self._clients.get(key)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(key)
+                if client is None:
+                    client = metrics.instrument_client((session or boto3).client(service_name, **kwargs))
+                    self._clients[key] = client
+        return client
+
+    def clear(self):
+        """
+        Drops all pooled clients
+        """
+        with self._lock:
+            self._clients = {}
+
+    def __len__(self):
+        return len(self._clients)
@@ -0,0 +1,199 @@
+# Copyright 2018 Capital One Services, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Syncing local directories to S3 prefixes by comparing ETags """
+
+import hashlib
+import json
+import logging
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+from pcf.util import config_loader
+from pcf.util.aws import s3_transfer
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 1
+# keys per delete_objects call
+DELETE_BATCH_SIZE = 1000
+
+
+def default_manifest_path(local_dir, bucket=None, prefix=""):
+    """
+    Manifests are kept below the pcf cache directory, see config_loader.CACHE_DIR, rather than next to the directory
+
+    Args:
+        local_dir (str): directory
+        bucket (str): bucket the directory is synced to
+        prefix (str): key prefix the directory maps to
+
+    Returns:
+        path of the manifest of a directory synced to a bucket and prefix
+    """
+    key = "\n".join([bucket or "", _key_prefix(prefix), os.path.abspath(local_dir)])
+    return os.path.join(config_loader.CACHE_DIR, "s3-sync", hashlib.sha256(key.encode("utf-8")).hexdigest() + ".json")
+
+
+class LocalManifest(object):
+    """
+    Size, mtime and S3 compatible ETag of every file below a directory. The manifest is kept in a json file between
+    runs and files whose size and mtime did not change are not hashed again. ETags depend on the part size, a
+    manifest of another part size is discarded.
+    """
+
+    def __init__(self, local_dir, manifest_path=None, part_size=s3_transfer.DEFAULT_PART_SIZE, max_workers=8):
+        """
+        Args:
+            local_dir (str): directory
+            manifest_path (str): path of the manifest, see default_manifest_path
+            part_size (int): part size of the uploads
+            max_workers (int): files hashed at the same time
+        """
+        self.local_dir = os.path.abspath(local_dir)
+        self.manifest_path = manifest_path or default_manifest_path(self.local_dir)
+        self.part_size = part_size
+        self.max_workers = max_workers
+        self.entries = {}
+        self.hashed = 0
+
+    def _load(self):
+        try:
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if manifest.get("version") != MANIFEST_VERSION or manifest.get("part_size") != self.part_size:
+            return {}
+        return manifest.get("entries", {})
+
+    def _save(self):
+        manifest = {"version": MANIFEST_VERSION, "part_size": self.part_size, "entries": self.entries}
+        try:
+            os.makedirs(os.path.dirname(self.manifest_path), exist_ok=True)
+            with open(self.manifest_path, "w") as f:
+                json.dump(manifest, f, indent=1, sort_keys=True)
+        except OSError as e:
+            logger.warning("Could not write sync manifest {0}: {1}".format(self.manifest_path, e))
+
+    def build(self):
+        """
+        Walks the directory, hashes new and changed files and writes the manifest
+
+        Returns:
+            dict of path relative to the directory, with / separators, to {size, mtime_ns, etag}
+        """
+        previous = self._load()
+        entries = {}
+        to_hash = []
+        for root, dirs, files in os.walk(self.local_dir):
+            for file in files:
+                path = os.path.join(root, file)
+                if path == self.manifest_path:
+                    continue
+                stat = os.stat(path)
+                name = os.path.relpath(path, self.local_dir).replace(os.sep, "/")
+                entry = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+                old = previous.get(name)
+                if old and old["size"] == entry["size"] and old["mtime_ns"] == entry["mtime_ns"]:
+                    entry["etag"] = old["etag"]
+                else:
+                    to_hash.append(name)
+                entries[name] = entry
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            paths = [os.path.join(self.local_dir, name) for name in to_hash]
+            for name, etag in zip(to_hash, executor.map(s3_transfer.file_etag, paths, [self.part_size] * len(paths))):
+                entries[name]["etag"] = etag
+        self.hashed = len(to_hash)
+        self.entries = entries
+        self._save()
+        return entries
+
+
+def _key_prefix(prefix):
+    prefix = (prefix or "").strip("/")
+    return prefix + "/" if prefix else ""
+
+
+def list_objects(client, bucket, prefix):
+    """
+    Pages through the objects below a prefix
+
+    Returns:
+        dict of key to (size, ETag without quotes)
+    """
+    objects = {}
+    for page in client.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            objects[obj["Key"]] = (obj["Size"], obj["ETag"].strip('"'))
+    return objects
+
+
+def sync(client, bucket, local_dir, prefix="", delete=False, manifest_path=None, max_workers=8, **transfer_args):
+    """
+    Uploads the files below local_dir that are missing below prefix or differ in size or ETag. Objects that were
+    uploaded with another part size or are encrypted with KMS have other ETags and are uploaded again.
+
+    Args:
+        client: boto3 s3 client
+        bucket (str): bucket name
+        local_dir (str): directory
+        prefix (str): key prefix the directory maps to
+        delete (bool): delete objects below prefix without a local file
+        manifest_path (str): path of the local manifest, defaults to default_manifest_path of the directory, bucket
+            and prefix
+        max_workers (int): files hashed and uploaded at the same time
+        **transfer_args: part_size, max_concurrency and verify, see s3_transfer.upload
+
+    Returns:
+        dict with the uploaded and deleted keys and the number of unchanged files
+    """
+    part_size = transfer_args.get("part_size", s3_transfer.DEFAULT_PART_SIZE)
+    key_prefix = _key_prefix(prefix)
+    manifest_path = manifest_path or default_manifest_path(local_dir, bucket, key_prefix)
+    manifest = LocalManifest(local_dir, manifest_path=manifest_path, part_size=part_size, max_workers=max_workers)
+    entries = manifest.build()
+    remote = list_objects(client, bucket, key_prefix)
+
+    uploads = []
+    for name, entry in sorted(entries.items()):
+        if remote.get(key_prefix + name) != (entry["size"], entry["etag"]):
+            uploads.append(name)
+
+    def upload(name):
+        s3_transfer.upload(client, bucket, key_prefix + name, os.path.join(manifest.local_dir, name), **transfer_args)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(upload, uploads))
+
+    deleted = []
+    if delete:
+        deleted = sorted(key for key in remote if key[len(key_prefix):] not in entries)
+        failed = set()
+        for i in range(0, len(deleted), DELETE_BATCH_SIZE):
+            response = client.delete_objects(Bucket=bucket, Delete={
+                "Objects": [{"Key": key} for key in deleted[i:i + DELETE_BATCH_SIZE]], "Quiet": True})
+            for error in response.get("Errors", []):
+                logger.warning("Could not delete s3://{0}/{1}: {2}".format(bucket, error["Key"], error.get("Message")))
+                failed.add(error["Key"])
+        deleted = [key for key in deleted if key not in failed]
+
+    logger.info("Synced {0} to s3://{1}/{2}: uploaded {3}, deleted {4}, {5} unchanged".format(
+        local_dir, bucket, key_prefix, len(uploads), len(deleted), len(entries) - len(uploads)))
+    return {
+        "uploaded": [key_prefix + name for name in uploads],
+        "deleted": deleted,
+        "unchanged": len(entries) - len(uploads),
+    }
@@ -0,0 +1,291 @@
+# Copyright 2018 Capital One Services, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Multipart S3 transfers on shared thread pools with sha256 verification """
+
+import hashlib
+import logging
+import os
+import threading
+
+from urllib.parse import parse_qsl, urlencode
+from boto3.s3.transfer import ProgressCallbackInvoker, TransferConfig
+from botocore.exceptions import ClientError
+from pcf.core.pcf_exceptions import ChecksumMismatchException
+from pcf.util import pcf_util
+from s3transfer.manager import TransferManager
+from s3transfer.utils import ChunksizeAdjuster
+
+logger = logging.getLogger(__name__)
+
+# object tag holding the sha256 hex digest of the uploaded bytes
+SHA256_TAG = "PCFSha256"
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+DEFAULT_CONCURRENCY = 10
+
+
+class TransferPool(object):
+    """
+    Shares transfer managers, and the thread pools behind them, by client, part size and concurrency. Particles with
+    pooled clients therefore also share their transfer threads.
+    """
+
+    def __init__(self):
+        self._managers = {}
+        self._lock = threading.Lock()
+
+    def manager(self, client, part_size=DEFAULT_PART_SIZE, max_concurrency=DEFAULT_CONCURRENCY):
+        """
+        Args:
+            client: boto3 s3 client
+            part_size (int): bytes per part, objects of at least this size are transferred in parts
+            max_concurrency (int): parts transferred at the same time
+
+        Returns:
+            s3transfer TransferManager
+        """
+        # clients hash by identity and are kept alive by the key
+        key = (client, part_size, max_concurrency)
+        manager = self._managers.get(key)
+        if manager is None:
+            with self._lock:
+                manager = self._managers.get(key)
+                if manager is None:
+                    config = TransferConfig(
+                        multipart_threshold=part_size,
+                        multipart_chunksize=part_size,
+                        max_concurrency=max_concurrency,
+                    )
+                    manager = TransferManager(client, config)
+                    self._managers[key] = manager
+        return manager
+
+    def shutdown(self):
+        """
+        Waits for running transfers and stops all thread pools
+        """
+        with self._lock:
+            managers = list(self._managers.values())
+            self._managers = {}
+        for manager in managers:
+            manager.shutdown()
+
+    def __len__(self):
+        return len(self._managers)
+
+
+TRANSFERS = TransferPool()
+
+
+class _HashingReader(object):
+    """
+    Non seekable reader over a file object or an iterable of bytes that hashes what is read
+    """
+
+    def __init__(self, source):
+        self.sha256 = hashlib.sha256()
+        self._read = source.read if hasattr(source, "read") else None
+        self._chunks = None if self._read else iter(source)
+        self._buffer = b""
+
+    def _next_chunk(self, size):
+        if self._read:
+            return self._read(size)
+        for chunk in self._chunks:
+            if chunk:
+                return chunk
+        return b""
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = self._buffer + b"".join(iter(lambda: self._next_chunk(pcf_util.HASH_CHUNK_SIZE), b""))
+            self._buffer = b""
+        else:
+            while len(self._buffer) < size:
+                chunk = self._next_chunk(size - len(self._buffer))
+                if not chunk:
+                    break
+                self._buffer += chunk
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        self.sha256.update(data)
+        return data
+
+
+class _HashingWriter(object):
+    """
+    Non seekable writer that hashes what is written, transfers then write the parts in order
+    """
+
+    def __init__(self, target):
+        self.sha256 = hashlib.sha256()
+        self._target = target
+
+    def write(self, data):
+        self.sha256.update(data)
+        return self._target.write(data)
+
+
+def file_etag(path, part_size=DEFAULT_PART_SIZE):
+    """
+    ETag S3 gives a file uploaded with this part size and without KMS or customer key encryption, the md5 of the file
+    or, for multipart uploads, the md5 of the md5s of its parts followed by the number of parts
+
+    Args:
+        path (str): path of the file
+        part_size (int): part size of the upload
+
+    Returns:
+        ETag without quotes
+    """
+    size = os.path.getsize(path)
+    # the part size is adjusted the way the transfer manager adjusts it
+    chunk_size = ChunksizeAdjuster().adjust_chunksize(part_size, size) if size >= part_size else size
+    digests = []
+    with open(path, "rb") as f:
+        for offset in range(0, max(size, 1), max(chunk_size, 1)):
+            md5 = hashlib.md5()
+            remaining = min(chunk_size, size - offset)
+            while remaining > 0:
+                data = f.read(min(remaining, pcf_util.HASH_CHUNK_SIZE))
+                if not data:
+                    break
+                md5.update(data)
+                remaining -= len(data)
+            digests.append(md5)
+    if size < part_size:
+        return digests[0].hexdigest()
+    return "{0}-{1}".format(hashlib.md5(b"".join(md5.digest() for md5 in digests)).hexdigest(), len(digests))
+
+
+def _seekable(fileobj):
+    try:
+        return fileobj.seekable()
+    except AttributeError:
+        return False
+
+
+def _fileobj_sha256(fileobj):
+    position = fileobj.tell()
+    sha256 = pcf_util.stream_sha256(iter(lambda: fileobj.read(pcf_util.HASH_CHUNK_SIZE), b""))
+    fileobj.seek(position)
+    return sha256
+
+
+def _tag_set(tagging, sha256):
+    tags = [(key, value) for key, value in parse_qsl(tagging or "") if key != SHA256_TAG]
+    return tags + [(SHA256_TAG, sha256)]
+
+
+def upload(client, bucket, key, source, extra_args=None, callback=None, part_size=DEFAULT_PART_SIZE,
+           max_concurrency=DEFAULT_CONCURRENCY, verify=True):
+    """
+    Uploads a file, a file object or an iterable of bytes. With verify the sha256 of the bytes is stored in the
+    PCFSha256 tag of the object, which downloads check. It is known upfront for files and seekable file objects.
+    Streams are hashed while they are sent and tagged afterwards.
+
+    Args:
+        client: boto3 s3 client
+        bucket (str): bucket name
+        key (str): object key
+        source (str, file object or iterable): path of a file, readable file object or iterable of bytes
+        extra_args (dict): ExtraArgs of boto3 upload_fileobj, ie ContentType or Tagging
+        callback (function): called with the number of bytes transferred since the last call
+        part_size (int): bytes per part, objects of at least this size are uploaded in parts
+        max_concurrency (int): parts uploaded at the same time
+        verify (bool): tag the object with its sha256
+
+    Returns:
+        sha256 hex digest of the uploaded bytes, None without verify
+    """
+    extra_args = dict(extra_args or {})
+    sha256 = None
+    reader = None
+    if isinstance(source, str):
+        if verify:
+            sha256 = pcf_util.file_sha256(source)
+    elif hasattr(source, "read") and _seekable(source):
+        if verify:
+            sha256 = _fileobj_sha256(source)
+    elif verify or not hasattr(source, "read"):
+        source = reader = _HashingReader(source)
+
+    if sha256:
+        extra_args["Tagging"] = urlencode(_tag_set(extra_args.get("Tagging"), sha256))
+    subscribers = [ProgressCallbackInvoker(callback)] if callback else None
+    manager = TRANSFERS.manager(client, part_size, max_concurrency)
+    manager.upload(source, bucket, key, extra_args=extra_args, subscribers=subscribers).result()
+
+    if verify and reader is not None:
+        sha256 = reader.sha256.hexdigest()
+        tag_set = [{"Key": k, "Value": v} for k, v in _tag_set(extra_args.get("Tagging"), sha256)]
+        client.put_object_tagging(Bucket=bucket, Key=key, Tagging={"TagSet": tag_set})
+    logger.debug("Uploaded s3://{0}/{1} with sha256 {2}".format(bucket, key, sha256))
+    return sha256
+
+
+def get_sha256(client, bucket, key, version_id=None):
+    """
+    Returns:
+        sha256 hex digest in the PCFSha256 tag of the object, None for objects without it
+    """
+    kwargs = {"VersionId": version_id} if version_id else {}
+    tag_set = client.get_object_tagging(Bucket=bucket, Key=key, **kwargs)["TagSet"]
+    return next((tag["Value"] for tag in tag_set if tag["Key"] == SHA256_TAG), None)
+
+
+def download(client, bucket, key, target, extra_args=None, callback=None, part_size=DEFAULT_PART_SIZE,
+             max_concurrency=DEFAULT_CONCURRENCY, verify=True):
+    """
+    Downloads an object to a file or a writable file object. With verify the sha256 of the downloaded bytes is
+    compared to the PCFSha256 tag of the object when it has one.
+
+    Args:
+        client: boto3 s3 client
+        bucket (str): bucket name
+        key (str): object key
+        target (str or file object): path of the file or writable file object
+        extra_args (dict): ExtraArgs of boto3 download_fileobj, ie VersionId
+        callback (function): called with the number of bytes transferred since the last call
+        part_size (int): bytes per ranged get, objects of at least this size are downloaded in parts
+        max_concurrency (int): parts downloaded at the same time
+        verify (bool): check the sha256 of the downloaded bytes
+
+    Returns:
+        sha256 hex digest of the downloaded bytes, None when they were not verified
+    """
+    extra_args = extra_args or {}
+    expected = None
+    if verify:
+        try:
+            expected = get_sha256(client, bucket, key, extra_args.get("VersionId"))
+        except ClientError as e:
+            # objects without tagging permission are downloaded unverified, missing objects fail the download
+            if e.response["Error"]["Code"] != "AccessDenied":
+                raise e
+        if expected is None:
+            logger.debug("s3://{0}/{1} has no {2} tag and is not verified".format(bucket, key, SHA256_TAG))
+
+    writer = _HashingWriter(target) if expected and not isinstance(target, str) else None
+    subscribers = [ProgressCallbackInvoker(callback)] if callback else None
+    manager = TRANSFERS.manager(client, part_size, max_concurrency)
+    manager.download(bucket, key, writer or target, extra_args=extra_args, subscribers=subscribers).result()
+
+    if not expected:
+        return None
+    sha256 = writer.sha256.hexdigest() if writer else pcf_util.file_sha256(target)
+    if sha256 != expected:
+        if not writer:
+            os.remove(target)
+        raise ChecksumMismatchException("s3://{0}/{1}".format(bucket, key), expected, sha256)
+    return sha256
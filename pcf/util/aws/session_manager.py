@@ -0,0 +1,148 @@
+# Copyright 2018 Capital One Services, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import os
+import threading
+
+import boto3
+import botocore.session
+from botocore.credentials import RefreshableCredentials
+from pcf.core.pcf_exceptions import MissingInput
+from pcf.util.aws.client_pool import ClientPool
+
+logger = logging.getLogger(__name__)
+
+
+class SessionManager(object):
+    """
+    Hands out one boto3 session per assumed role. The temporary credentials of a role are cached in its session and
+    refreshed refresh_margin seconds before they expire, so STS is only called once per role and expiry and config
+    files are only read once per role. Clients of managed sessions come from a shared ClientPool.
+    """
+
+    def __init__(self, role_name=None, session_name="pcf", duration=3600, refresh_margin=300, base_session=None,
+                 client_pool=None):
+        """
+        Args:
+            role_name (str): role assumed in an account when only the account is given, defaults to the
+                PCF_ASSUME_ROLE_NAME environment variable
+            session_name (str): RoleSessionName of the assumed roles
+            duration (int): seconds the temporary credentials are valid for
+            refresh_margin (int): seconds before expiry the credentials are refreshed
+            base_session (boto3.session.Session): session that assumes the roles, defaults to the default chain
+            client_pool (ClientPool): pool of the clients of managed sessions, defaults to a new pool
+        """
+        self.role_name = role_name or os.environ.get("PCF_ASSUME_ROLE_NAME")
+        self.session_name = session_name
+        self.duration = duration
+        self.refresh_margin = refresh_margin
+        self.base_session = base_session
+        self.client_pool = client_pool if client_pool is not None else ClientPool()
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def role_arn(self, account=None, role_arn=None):
+        """
+        Args:
+            account (str): account id, combined with role_name
+            role_arn (str): full role arn, takes precedence over account
+
+        Returns:
+            arn of the role to assume
+        """
+        if role_arn:
+            return role_arn
+        if not account:
+            raise MissingInput("An account or role_arn is required to assume a role")
+        if not self.role_name:
+            raise MissingInput("A role_name or PCF_ASSUME_ROLE_NAME is required to assume a role in account {}".format(account))
+        return "arn:aws:iam::{0}:role/{1}".format(account, self.role_name)
+
+    def _assume_role(self, role_arn):
+        sts = self.client_pool.client("sts", session=self.base_session)
+        logger.debug("Assuming role {}".format(role_arn))
+        credentials = sts.assume_role(
+            RoleArn=role_arn, RoleSessionName=self.session_name, DurationSeconds=self.duration
+        )["Credentials"]
+        return {
+            "access_key": credentials["AccessKeyId"],
+            "secret_key": credentials["SecretAccessKey"],
+            "token": credentials["SessionToken"],
+            "expiry_time": credentials["Expiration"].isoformat(),
+        }
+
+    def _create_session(self, role_arn):
+        credentials = RefreshableCredentials.create_from_metadata(
+            metadata=self._assume_role(role_arn),
+            refresh_using=lambda: self._assume_role(role_arn),
+            method="sts-assume-role",
+        )
+        # botocore refreshes once the credentials are this close to expiring
+        credentials._advisory_refresh_timeout = self.refresh_margin
+        credentials._mandatory_refresh_timeout = min(self.refresh_margin, RefreshableCredentials._mandatory_refresh_timeout)
+
+        botocore_session = botocore.session.get_session()
+        botocore_session._credentials = credentials
+        base_region = self.base_session.region_name if self.base_session else None
+        if base_region:
+            botocore_session.set_config_variable("region", base_region)
+        return boto3.session.Session(botocore_session=botocore_session)
+
+    def get_session(self, account=None, role_arn=None):
+        """
+        Args:
+            account (str): account id, combined with role_name
+            role_arn (str): full role arn, takes precedence over account
+
+        Returns:
+            cached boto3 session with the credentials of the role
+        """
+        role_arn = self.role_arn(account=account, role_arn=role_arn)
+        session = self._sessions.get(role_arn)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(role_arn)
+                if session is None:
+                    session = self._create_session(role_arn)
+                    self._sessions[role_arn] = session
+        return session
+
+    def manages(self, session):
+        """
+        Returns:
+            True if the session was created by this manager
+        """
+        return any(session is managed for managed in list(self._sessions.values()))
+
+    def client(self, service_name, account=None, role_arn=None, **kwargs):
+        """
+        Args:
+            service_name (str): boto3 service name (ie ec2)
+            account (str): account id, combined with role_name
+            role_arn (str): full role arn, takes precedence over account
+            **kwargs: passed to client(), ie region_name
+
+        Returns:
+            pooled boto3 client with the credentials of the role
+        """
+        return self.client_pool.client(service_name, session=self.get_session(account, role_arn), **kwargs)
+
+    def clear(self):
+        """
+        Drops all cached sessions and their clients
+        """
+        with self._lock:
+            self._sessions = {}
+        self.client_pool.clear()
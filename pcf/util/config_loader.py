@@ -0,0 +1,590 @@
+# Copyright 2018 Capital One Services, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Incremental loading of large PCF config files """
+
+import hashlib
+import itertools
+import json
+import logging
+import os
+import re
+import tempfile
+import yaml
+
+from stat import S_IWGRP, S_IWOTH
+
+from pcf import VERSION
+from pcf.util import pcf_util
+
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
+JSON_EXTENSIONS = (".json",)
+YAML_EXTENSIONS = (".yml", ".yaml")
+
+logger = logging.getLogger(__name__)
+
+# bytes read from disk at a time while scanning json config files
+CHUNK_SIZE = 1024 * 1024
+
+# parsed configs are cached here keyed by the config file content hash and the pcf version
+CACHE_DIR = os.environ.get("PCF_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".pcf", "cache"))
+# the least recently used caches are removed once the cache directory grows beyond this many bytes
+CACHE_MAX_SIZE = int(os.environ.get("PCF_CACHE_MAX_SIZE", 256 * 1024 * 1024))
+# bumped whenever the layout of the cache files changes
+_CACHE_FORMAT = 3
+# caches only ever hold plain json, loading them never runs code
+_CACHE_SUFFIX = ".json"
+
+# json is scanned as latin-1 so that every character is exactly one byte and decoder positions are byte offsets.
+# All json structural characters are ascii, so entry boundaries are found correctly. Entries with non ascii bytes
+# are loaded again from their raw bytes as utf-8.
+_SCAN_ENCODING = "latin-1"
+_NON_ASCII = re.compile(b"[\x80-\xff]")
+_decoder = json.JSONDecoder()
+_WHITESPACE = " \t\n\r"
+
+
+class ConfigEntry(object):
+    """
+    Lightweight description of one top level particle definition in a config file. Only the fields needed to find
+    a particle and its relatives are kept, the full definition is loaded on demand.
+    """
+    __slots__ = ("pcf_name", "flavor", "parents", "children", "offset", "length", "definition")
+
+    def __init__(self, definition, offset=None, length=None, keep_definition=False):
+        self.pcf_name = definition.get("pcf_name")
+        self.flavor = definition.get("flavor")
+        self.parents = list(definition.get("parents", []))
+        self.children = list(definition.get("children", []))
+        self.offset = offset
+        self.length = length
+        self.definition = definition if keep_definition else None
+
+    @property
+    def pcf_id(self):
+        return pcf_util.generate_pcf_id(self.flavor, self.pcf_name)
+
+    def to_json(self):
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    @classmethod
+    def from_json(cls, values):
+        config_entry = cls.__new__(cls)
+        for field in cls.__slots__:
+            setattr(config_entry, field, values[field])
+        return config_entry
+
+
+def is_json_file(filename):
+    return os.path.splitext(filename)[1] in JSON_EXTENSIONS
+
+
+def load_yaml(stream):
+    """
+    Loads yaml with the C loader when libyaml is available
+
+    Args:
+        stream (file or str): yaml content
+
+    Returns:
+        loaded yaml
+    """
+    return yaml.load(stream, Loader=YamlLoader)
+
+
+def _skip_whitespace(buffer, position):
+    while position < len(buffer) and buffer[position] in _WHITESPACE:
+        position += 1
+    return position
+
+
+def iter_json_entries(filename, chunk_size=CHUNK_SIZE):
+    """
+    Iterates over the top level entries of a json config file without loading the whole file. The file can either
+    be a list of particle definitions or a single definition.
+
+    Args:
+        filename (str): path to the json file
+        chunk_size (int): number of bytes read at a time
+
+    Returns:
+        generator of (offset, length, entry) where offset and length locate the entry in the file in bytes
+    """
+    with open(filename, "rb") as config_file:
+        buffer = ""
+        buffer_offset = 0
+        position = 0
+        eof = False
+        ascii_only = True
+
+        def read_more(size=chunk_size):
+            nonlocal buffer, buffer_offset, position, eof, ascii_only
+            chunk = config_file.read(size)
+            if not chunk:
+                eof = True
+                return False
+            ascii_only = ascii_only and not _NON_ASCII.search(chunk)
+            # drop everything that was already consumed
+            buffer_offset += position
+            buffer = buffer[position:] + chunk.decode(_SCAN_ENCODING)
+            position = 0
+            return True
+
+        def next_char():
+            nonlocal position
+            position = _skip_whitespace(buffer, position)
+            while position >= len(buffer) and read_more():
+                position = _skip_whitespace(buffer, position)
+            return buffer[position] if position < len(buffer) else None
+
+        def decode_value():
+            nonlocal position
+            while True:
+                try:
+                    value, end = _decoder.raw_decode(buffer, position)
+                    # a number at the end of the buffer could continue in the next chunk
+                    if end < len(buffer) or eof:
+                        start = position
+                        position = end
+                        if not ascii_only:
+                            value = json.loads(buffer[start:end].encode(_SCAN_ENCODING).decode("utf-8"))
+                        return buffer_offset + start, end - start, value
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                # grow the buffer geometrically so very large entries are not decoded over and over again
+                read_more(max(chunk_size, len(buffer) - position))
+
+        first = next_char()
+        if first is None:
+            return
+        if first != "[":
+            yield decode_value()
+            if next_char() is not None:
+                raise json.JSONDecodeError("Extra data", buffer, position)
+            return
+
+        position += 1
+        if next_char() == "]":
+            return
+
+        while True:
+            yield decode_value()
+            separator = next_char()
+            if separator == ",":
+                position += 1
+                next_char()
+            elif separator == "]":
+                return
+            else:
+                raise json.JSONDecodeError("Expecting ',' delimiter", buffer, position)
+
+
+def load_json_entry(filename, offset, length):
+    """
+    Loads a single entry of a json config file
+
+    Args:
+        filename (str): path to the json file
+        offset (int): byte offset of the entry
+        length (int): length of the entry in bytes
+
+    Returns:
+        entry
+    """
+    with open(filename, "rb") as config_file:
+        config_file.seek(offset)
+        return json.loads(config_file.read(length).decode("utf-8"))
+
+
+def iter_config_entries(filename):
+    """
+    Iterates over the top level entries of a json or yaml config file
+
+    Args:
+        filename (str): path to the config file
+
+    Returns:
+        generator of entries
+    """
+    if is_json_file(filename):
+        for _offset, _length, entry in iter_json_entries(filename):
+            yield entry
+    else:
+        with open(filename, "r") as config_file:
+            pcf_config = load_yaml(config_file)
+        if isinstance(pcf_config, dict):
+            pcf_config = [pcf_config]
+        for entry in pcf_config or []:
+            yield entry
+
+
+def build_config_index(filename):
+    """
+    Builds an index of pcf_name to ConfigEntry. For json files entries only hold their byte offset in the file, for
+    yaml files the loaded definitions are kept. Entries that are not dicts are skipped and the first entry wins
+    when a pcf_name is defined twice.
+
+    Args:
+        filename (str): path to the config file
+
+    Returns:
+        dict of pcf_name to ConfigEntry
+    """
+    index = {}
+    if is_json_file(filename):
+        for offset, length, entry in iter_json_entries(filename):
+            if not isinstance(entry, dict):
+                continue
+            name = entry.get("pcf_name")
+            if name not in index:
+                index[name] = ConfigEntry(entry, offset=offset, length=length)
+    else:
+        for entry in iter_config_entries(filename):
+            if not isinstance(entry, dict):
+                continue
+            name = entry.get("pcf_name")
+            if name not in index:
+                index[name] = ConfigEntry(entry, keep_definition=True)
+    return index
+
+
+def load_index_entry(filename, config_entry):
+    """
+    Args:
+        filename (str): path to the config file
+        config_entry (ConfigEntry): entry from build_config_index()
+
+    Returns:
+        particle definition
+    """
+    if config_entry.definition is None:
+        config_entry.definition = load_json_entry(filename, config_entry.offset, config_entry.length)
+    return config_entry.definition
+
+
+def dependency_closure(index, pcf_name):
+    """
+    Finds the particle and every particle it depends on. A particle depends on the particles in its parents list
+    and on the particles that list it as a child.
+
+    Args:
+        index (dict): index from build_config_index()
+        pcf_name (str): name of the requested particle
+
+    Returns:
+        list of pcf names starting with pcf_name
+    """
+    parents_of = {}
+    for config_entry in index.values():
+        for child_pcf_id in config_entry.children:
+            parents_of.setdefault(child_pcf_id, []).append(config_entry.pcf_id)
+
+    closure = []
+    pending = [pcf_name]
+    while pending:
+        name = pending.pop(0)
+        if name in closure or name not in index:
+            continue
+        closure.append(name)
+        config_entry = index[name]
+        for pcf_id in config_entry.parents + parents_of.get(config_entry.pcf_id, []):
+            flavor, parent_name = pcf_util.extract_components_from_pcf_id(pcf_id)
+            parent = index.get(parent_name)
+            if parent and parent.flavor == flavor:
+                pending.append(parent_name)
+    return closure
+
+
+def config_file_hash(filename):
+    """
+    Args:
+        filename (str): path to the config file
+
+    Returns:
+        sha256 hex digest of the file content, the pcf version and the cache format
+    """
+    sha256 = hashlib.sha256()
+    sha256.update("{}:{}:".format(VERSION, _CACHE_FORMAT).encode("utf-8"))
+    with open(filename, "rb") as config_file:
+        for chunk in iter(lambda: config_file.read(CHUNK_SIZE), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _cache_path(content_hash, kind, cache_dir):
+    return os.path.join(cache_dir, "{}-{}{}".format(content_hash, kind, _CACHE_SUFFIX))
+
+
+def _touch(cache_path):
+    # the modification time of a cache is when it was last used, see _evict
+    try:
+        os.utime(cache_path)
+    except OSError:
+        pass
+
+
+def _evict(cache_dir, keep):
+    """
+    Removes the least recently used caches until the cache directory holds at most CACHE_MAX_SIZE bytes. keep, the
+    cache that was just written, is never removed.
+    """
+    caches = []
+    try:
+        for name in os.listdir(cache_dir):
+            if name.endswith(_CACHE_SUFFIX):
+                path = os.path.join(cache_dir, name)
+                stat = os.stat(path)
+                caches.append((stat.st_mtime, stat.st_size, path))
+    except OSError as error:
+        logger.debug("Could not list config cache {0}: {1}".format(cache_dir, error))
+        return
+
+    size = sum(cache_size for _mtime, cache_size, _path in caches)
+    for _mtime, cache_size, path in sorted(caches):
+        if size <= CACHE_MAX_SIZE:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            # removed by a concurrent run
+            pass
+        size -= cache_size
+
+
+def _is_trusted(cache_file):
+    """
+    Cached definitions decide what gets deployed, so only caches that the current user wrote and nobody else can
+    modify are used
+    """
+    if not hasattr(os, "getuid"):
+        return True
+    stat = os.fstat(cache_file.fileno())
+    if stat.st_uid != os.getuid() or stat.st_mode & (S_IWGRP | S_IWOTH):
+        logger.warning("Ignoring config cache {0} that is not private to the current user".format(cache_file.name))
+        return False
+    return True
+
+
+def _open_cache(cache_path):
+    """
+    Returns:
+        the opened cache file or None when there is no trusted cache
+    """
+    try:
+        cache_file = open(cache_path, "r", encoding="utf-8")
+    except OSError:
+        return None
+    if not _is_trusted(cache_file):
+        cache_file.close()
+        return None
+    return cache_file
+
+
+def _dump_json(value):
+    """
+    Returns:
+        value as a single line of json, or None when json can not hold value exactly, e.g. yaml dates or non string
+        keys
+    """
+    try:
+        dumped = json.dumps(value)
+    except (TypeError, ValueError):
+        return None
+    if json.loads(dumped) != value:
+        return None
+    return dumped
+
+
+def _read_cache(cache_path):
+    cache_file = _open_cache(cache_path)
+    if cache_file is None:
+        return None
+    try:
+        with cache_file:
+            value = json.load(cache_file)
+    except ValueError as error:
+        logger.debug("Ignoring unreadable config cache {0}: {1}".format(cache_path, error))
+        return None
+    _touch(cache_path)
+    return value
+
+
+def _open_cache_tmp(cache_dir):
+    os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+    # write to a temp file first so concurrent runs never read a partial cache. mkstemp creates it readable and
+    # writable by the current user only.
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+    return os.fdopen(fd, "w", encoding="utf-8"), tmp_path
+
+
+def _remove_cache_tmp(tmp_path):
+    try:
+        os.remove(tmp_path)
+    except OSError:
+        pass
+
+
+def _write_cache(cache_path, value):
+    dumped = _dump_json(value)
+    if dumped is None:
+        logger.debug("Not caching {0}, it can not be stored as json".format(cache_path))
+        return
+    cache_dir = os.path.dirname(cache_path)
+    try:
+        cache_file, tmp_path = _open_cache_tmp(cache_dir)
+        with cache_file:
+            cache_file.write(dumped)
+        os.replace(tmp_path, cache_path)
+    except OSError as error:
+        logger.debug("Could not write config cache {0}: {1}".format(cache_path, error))
+        return
+    _evict(cache_dir, cache_path)
+
+
+def _cached(filename, kind, load, use_cache, cache_dir, encode, decode):
+    if not use_cache:
+        return load(filename)
+
+    cache_path = _cache_path(config_file_hash(filename), kind, cache_dir or CACHE_DIR)
+    value = _read_cache(cache_path)
+    if value is None:
+        value = load(filename)
+        _write_cache(cache_path, encode(value))
+        return value
+    logger.debug("Using cached {0} for {1}".format(kind, filename))
+    return decode(value)
+
+
+def _read_entries_cache(filename, cache_file):
+    """
+    Reads the entries of an entries cache one line at a time. When the cache turns out to be unreadable the
+    remaining entries are parsed from the config file.
+    """
+    read = 0
+    with cache_file:
+        for line in cache_file:
+            try:
+                entry = json.loads(line)
+            except ValueError as error:
+                logger.debug("Ignoring unreadable config cache {0}: {1}".format(cache_file.name, error))
+                break
+            read += 1
+            yield entry
+        else:
+            return
+    for entry in itertools.islice(iter_config_entries(filename), read, None):
+        yield entry
+
+
+def _write_entries_cache(cache_path, entries):
+    """
+    Writes entries as json lines while they are yielded. The cache is only kept once every entry was written.
+    """
+    cache_dir = os.path.dirname(cache_path)
+    try:
+        cache_file, tmp_path = _open_cache_tmp(cache_dir)
+    except OSError as error:
+        logger.debug("Could not write config cache {0}: {1}".format(cache_path, error))
+        cache_file = None
+
+    try:
+        for entry in entries:
+            if cache_file:
+                dumped = _dump_json(entry)
+                try:
+                    if dumped is None:
+                        raise ValueError("entry can not be stored as json")
+                    cache_file.write(dumped + "\n")
+                except (OSError, ValueError) as error:
+                    logger.debug("Could not write config cache {0}: {1}".format(cache_path, error))
+                    cache_file.close()
+                    cache_file = None
+                    _remove_cache_tmp(tmp_path)
+            yield entry
+    except BaseException:
+        if cache_file:
+            cache_file.close()
+            _remove_cache_tmp(tmp_path)
+        raise
+
+    if cache_file:
+        try:
+            cache_file.close()
+            os.replace(tmp_path, cache_path)
+        except OSError as error:
+            logger.debug("Could not write config cache {0}: {1}".format(cache_path, error))
+            _remove_cache_tmp(tmp_path)
+            return
+        _evict(cache_dir, cache_path)
+
+
+def _encode_index(index):
+    return [config_entry.to_json() for config_entry in index.values()]
+
+
+def _decode_index(values):
+    index = {}
+    for value in values:
+        config_entry = ConfigEntry.from_json(value)
+        index[config_entry.pcf_name] = config_entry
+    return index
+
+
+def load_config_entries(filename, use_cache=True, cache_dir=None):
+    """
+    Iterates over the top level entries of a config file, using the on disk cache of yaml files when the file
+    content is unchanged. Cached entries are read one at a time so the entries are never all in memory. json files
+    are always streamed from the file itself, their cache would be no faster to parse.
+
+    Args:
+        filename (str): path to the config file
+        use_cache (bool): read and write the config cache
+        cache_dir (str): overrides CACHE_DIR
+
+    Returns:
+        generator of entries
+    """
+    if not use_cache or is_json_file(filename):
+        return iter_config_entries(filename)
+
+    cache_path = _cache_path(config_file_hash(filename), "entries", cache_dir or CACHE_DIR)
+    cache_file = _open_cache(cache_path)
+    if cache_file is None:
+        return _write_entries_cache(cache_path, iter_config_entries(filename))
+    logger.debug("Using cached entries for {0}".format(filename))
+    _touch(cache_path)
+    return _read_entries_cache(filename, cache_file)
+
+
+def load_config_index(filename, use_cache=True, cache_dir=None):
+    """
+    Builds the index of a config file with build_config_index(), using the on disk cache when the file content
+    is unchanged
+
+    Args:
+        filename (str): path to the config file
+        use_cache (bool): read and write the config cache
+        cache_dir (str): overrides CACHE_DIR
+
+    Returns:
+        dict of pcf_name to ConfigEntry
+    """
+    return _cached(filename, "index", build_config_index, use_cache, cache_dir, _encode_index, _decode_index)
@@ -0,0 +1,336 @@
+# Copyright 2018 Capital One Services, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Process wide metrics rendered in the Prometheus text format """
+
+import logging
+import os
+import socketserver
+import tempfile
+import threading
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# seconds, from a quick poll up to a slow resource like a cloudfront distribution
+CONVERGE_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+THROTTLING_ERROR_CODES = {
+    "Throttling",
+    "ThrottlingException",
+    "ThrottledException",
+    "RequestThrottledException",
+    "TooManyRequestsException",
+    "ProvisionedThroughputExceededException",
+    "TransactionInProgressException",
+    "RequestLimitExceeded",
+    "BandwidthLimitExceeded",
+    "LimitExceededException",
+    "RequestThrottled",
+    "SlowDown",
+    "PriorRequestNotComplete",
+    "EC2ThrottledException",
+}
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(label_names, label_values, extra=()):
+    pairs = list(zip(label_names, label_values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{0}="{1}"'.format(name, _escape(value)) for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    """
+    Base class of metrics with an optional set of labels. Values are kept per combination of label values.
+    """
+    metric_type = None
+
+    def __init__(self, name, documentation, label_names=()):
+        """
+        Args:
+            name (str): metric name
+            documentation (str): help text
+            label_names (tuple): names of the labels values are split by
+        """
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError("{0} expects labels {1}, got {2}".format(self.name, self.label_names, sorted(labels)))
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def get(self, **labels):
+        """
+        Returns:
+            current value for the labels
+        """
+        return self._values.get(self._key(labels), 0)
+
+    def clear(self):
+        with self._lock:
+            self._values = {}
+
+    def samples(self):
+        """
+        Returns:
+            list of (suffix, label values, extra labels, value)
+        """
+        with self._lock:
+            return [("", key, (), value) for key, value in sorted(self._values.items())]
+
+    def render(self):
+        lines = [
+            "# HELP {0} {1}".format(self.name, self.documentation),
+            "# TYPE {0} {1}".format(self.name, self.metric_type),
+        ]
+        for suffix, key, extra, value in self.samples():
+            lines.append("{0}{1}{2} {3}".format(
+                self.name, suffix, _format_labels(self.label_names, key, extra), _format_value(value)))
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    metric_type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    metric_type = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    metric_type = "histogram"
+
+    def __init__(self, name, documentation, label_names=(), buckets=CONVERGE_BUCKETS):
+        """
+        Args:
+            name (str): metric name
+            documentation (str): help text
+            label_names (tuple): names of the labels values are split by
+            buckets (tuple): sorted upper bounds of the buckets
+        """
+        super(Histogram, self).__init__(name, documentation, label_names)
+        self.buckets = tuple(buckets) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    def get(self, **labels):
+        """
+        Returns:
+            number of observations for the labels
+        """
+        counts, _total = self._values.get(self._key(labels), ([0], 0))
+        return counts[-1]
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    samples.append(("_bucket", key, (("le", _format_value(bound)),), count))
+                samples.append(("_sum", key, (), total))
+                samples.append(("_count", key, (), counts[-1]))
+        return samples
+
+
+class Registry(object):
+    """
+    Collection of metrics rendered together
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing:
+                if type(existing) is not type(metric) or existing.label_names != metric.label_names:
+                    raise ValueError("Metric {} is already registered with another type or labels".format(metric.name))
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, label_names=()):
+        return self._register(Counter(name, documentation, label_names))
+
+    def gauge(self, name, documentation, label_names=()):
+        return self._register(Gauge(name, documentation, label_names))
+
+    def histogram(self, name, documentation, label_names=(), buckets=CONVERGE_BUCKETS):
+        return self._register(Histogram(name, documentation, label_names, buckets))
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def clear(self):
+        """
+        Resets the values of all metrics
+        """
+        for metric in list(self._metrics.values()):
+            metric.clear()
+
+    def render(self):
+        """
+        Returns:
+            all metrics in the Prometheus text exposition format
+        """
+        return "\n".join(metric.render() for _, metric in sorted(self._metrics.items())) + "\n"
+
+    def write_to_file(self, filename):
+        """
+        Atomically writes all metrics to a file, ie for the node exporter textfile collector after a batch run
+
+        Args:
+            filename (str): path of the .prom file
+        """
+        directory = os.path.dirname(os.path.abspath(filename))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as metrics_file:
+            metrics_file.write(self.render())
+        os.replace(tmp_path, filename)
+
+    def serve(self, host="127.0.0.1", port=9090):
+        """
+        Serves GET /metrics in a background thread
+
+        Args:
+            host (str): address to listen on, defaults to localhost only
+            port (int): port to listen on, 0 picks a free port
+
+        Returns:
+            the server, server_address holds the address it listens on
+        """
+        server = MetricsServer((host, port), type("Handler", (MetricsRequestHandler,), {"registry": self}))
+        threading.Thread(target=server.serve_forever, name="pcf-metrics", daemon=True).start()
+        return server
+
+
+class MetricsServer(socketserver.ThreadingMixIn, HTTPServer):
+    """
+    HTTPServer handling each request on its own thread (http.server.ThreadingHTTPServer is only in python 3.7+)
+    """
+    daemon_threads = True
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    registry = None
+
+    def send_metrics(self):
+        content = self.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        if self.path.split("?")[0].rstrip("/") in ("", "/metrics"):
+            return self.send_metrics()
+        self.send_error(404)
+
+    def log_message(self, format, *args):
+        logger.debug("Metrics api: " + format % args)
+
+
+REGISTRY = Registry()
+
+TRANSITIONS = REGISTRY.counter(
+    "pcf_transitions_total", "State transitions called by apply", ("flavor", "transition", "outcome"))
+CONVERGE_SECONDS = REGISTRY.histogram(
+    "pcf_apply_converge_seconds", "Seconds apply took to reach the desired state", ("flavor", "outcome"))
+STATE_CACHE = REGISTRY.counter(
+    "pcf_state_cache_total", "State lookups by whether the cached state was used", ("flavor", "result"))
+API_CALLS = REGISTRY.counter(
+    "pcf_api_calls_total", "AWS API calls by service and operation", ("service", "operation"))
+API_THROTTLES = REGISTRY.counter(
+    "pcf_api_throttles_total", "Throttled AWS API attempts by service and operation", ("service", "operation"))
+QUEUE_DEPTH = REGISTRY.gauge(
+    "pcf_queue_depth", "Particles waiting to be started or reconciled", ("queue",))
+RECONCILES = REGISTRY.counter(
+    "pcf_reconciles_total", "Reconciles run by the reconciler", ("flavor", "outcome"))
+RECONCILES_RUNNING = REGISTRY.gauge(
+    "pcf_reconciles_running", "Reconciles currently running")
+
+
+def _record_api_call(service_name, model=None, **kwargs):
+    API_CALLS.inc(service=service_name, operation=model.name if model else "unknown")
+
+
+def _record_throttle(service_name, response=None, operation=None, **kwargs):
+    if not response:
+        return None
+    _http_response, parsed = response
+    if parsed and parsed.get("Error", {}).get("Code") in THROTTLING_ERROR_CODES:
+        API_THROTTLES.inc(service=service_name, operation=operation.name if operation else "unknown")
+    # never change the retry decision
+    return None
+
+
+def instrument_client(client):
+    """
+    Counts the API calls and throttled attempts of a boto3 client. Instrumenting a client twice has no effect.
+
+    Args:
+        client: boto3 client
+
+    Returns:
+        client
+    """
+    if getattr(client, "_pcf_instrumented", False):
+        return client
+    service_name = client.meta.service_model.service_name
+    events = client.meta.events
+    events.register("after-call", lambda **kwargs: _record_api_call(service_name, **kwargs),
+                    unique_id="pcf-metrics-after-call")
+    events.register("needs-retry", lambda **kwargs: _record_throttle(service_name, **kwargs),
+                    unique_id="pcf-metrics-needs-retry")
+    client._pcf_instrumented = True
+    return client
@@ -12,12 +12,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import functools
+import hashlib
 import importlib
 import inspect
 import pkgutil
 from copy import deepcopy
 from pcf.core.pcf_exceptions import InvalidConfigException
 
+HASH_CHUNK_SIZE = 1024 * 1024
+
 
 def generate_pcf_id(flavor, pcf_name):
     return "{}:{}".format(flavor, pcf_name)
@@ -36,6 +40,28 @@ def update_dict(curr_dict, updated_dict):
     return new_dict, _update_dict(new_dict, updated_dict, diff_dict={})
 
 
+def stream_sha256(chunks):
+    """
+    Hashes an iterable of byte chunks without holding more than one chunk in memory
+
+    Returns:
+        sha256 hex digest
+    """
+    sha256 = hashlib.sha256()
+    for chunk in chunks:
+        sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def file_sha256(path, chunk_size=HASH_CHUNK_SIZE):
+    """
+    Returns:
+        sha256 hex digest of a file read in chunks
+    """
+    with open(path, "rb") as f:
+        return stream_sha256(iter(lambda: f.read(chunk_size), b""))
+
+
 def diff_dict(curr_dict, updated_dict):
     return _update_dict(curr_dict, updated_dict, diff_dict={}, eval=True)
 
@@ -398,17 +424,26 @@ def particle_class_from_flavor(flavor):
     """ Return the class object of the given flavor (or None) by searching
         through all particle and quasiparticle submodules in the pcf module
     """
+    return _particle_classes_by_flavor().get(flavor)
+
 
+@functools.lru_cache(maxsize=None)
+def _particle_classes_by_flavor():
+    """ Walks the particle and quasiparticle packages once and returns a dict of
+        flavor to class object. The first class found for a flavor wins.
+    """
     particle_submodules = pkg_submodules("pcf.particle")
     quasiparticle_submodules = pkg_submodules("pcf.quasiparticle")
     modules = particle_submodules + quasiparticle_submodules
 
+    classes_by_flavor = {}
     for module in modules:
         classes = inspect.getmembers(module, inspect.isclass)
 
         if classes:
             for _name, class_obj in classes:
-                if getattr(class_obj, "flavor", None) == flavor:
-                    return class_obj
+                flavor = getattr(class_obj, "flavor", None)
+                if isinstance(flavor, str):
+                    classes_by_flavor.setdefault(flavor, class_obj)
 
-    return None
+    return classes_by_flavor
@@ -0,0 +1,142 @@
+# Copyright 2018 Capital One Services, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Compiled and rendered jinja templates shared by all particles """
+
+import hashlib
+import json
+import os
+import threading
+
+from collections import OrderedDict
+from jinja2 import BaseLoader, Environment, FileSystemBytecodeCache, TemplateNotFound
+
+STRING_PREFIX = "sha256:"
+
+
+class _TemplateLoader(BaseLoader):
+    """
+    Loads templates by file path, or by the content hash of a template string registered with the cache
+    """
+
+    def __init__(self, sources):
+        self.sources = sources
+
+    def get_source(self, environment, name):
+        if name.startswith(STRING_PREFIX):
+            source = self.sources.get(name)
+            if source is None:
+                raise TemplateNotFound(name)
+            # the name is the hash of the source, it is never outdated
+            return source, None, lambda: True
+
+        try:
+            mtime = os.path.getmtime(name)
+            with open(name, "r") as f:
+                source = f.read()
+        except OSError:
+            raise TemplateNotFound(name)
+        return source, name, lambda: os.path.exists(name) and os.path.getmtime(name) == mtime
+
+
+class TemplateCache(object):
+    """
+    Compiles each template once, keyed by file path and mtime or by the hash of a template string, and caches
+    rendered output by template and a hash of the context. Compiled code is also written to bytecode_cache_dir when
+    it is set, so later processes skip compiling as well.
+    """
+
+    def __init__(self, max_size=400, max_rendered=1024, bytecode_cache_dir=None):
+        """
+        Args:
+            max_size (int): number of compiled templates kept
+            max_rendered (int): number of rendered outputs kept
+            bytecode_cache_dir (str): directory of the compiled bytecode, defaults to the PCF_TEMPLATE_CACHE_DIR
+                environment variable. No bytecode is written when neither is set
+        """
+        bytecode_cache_dir = bytecode_cache_dir or os.environ.get("PCF_TEMPLATE_CACHE_DIR")
+        if bytecode_cache_dir:
+            os.makedirs(bytecode_cache_dir, exist_ok=True)
+        self._sources = OrderedDict()
+        self._rendered = OrderedDict()
+        self.max_size = max_size
+        self.max_rendered = max_rendered
+        self.environment = Environment(
+            loader=_TemplateLoader(self._sources),
+            cache_size=max_size,
+            auto_reload=True,
+            bytecode_cache=FileSystemBytecodeCache(bytecode_cache_dir) if bytecode_cache_dir else None,
+        )
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _context_hash(context):
+        return hashlib.sha256(json.dumps(context, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def _render(self, name, version, context):
+        key = (name, version, self._context_hash(context))
+        with self._lock:
+            rendered = self._rendered.get(key)
+            if rendered is not None:
+                self._rendered.move_to_end(key)
+                return rendered
+
+        rendered = self.environment.get_template(name).render(context)
+        with self._lock:
+            self._rendered[key] = rendered
+            while len(self._rendered) > self.max_rendered:
+                self._rendered.popitem(last=False)
+        return rendered
+
+    def render_file(self, filename, context=None):
+        """
+        Args:
+            filename (str): path of the template, reloaded when its mtime changes
+            context (dict): template variables
+
+        Returns:
+            rendered template
+        """
+        filename = os.path.abspath(filename)
+        stat = os.stat(filename)
+        return self._render(filename, (stat.st_mtime_ns, stat.st_size), context or {})
+
+    def render_string(self, source, context=None):
+        """
+        Args:
+            source (str): template
+            context (dict): template variables
+
+        Returns:
+            rendered template
+        """
+        name = STRING_PREFIX + hashlib.sha256(source.encode("utf-8")).hexdigest()
+        with self._lock:
+            self._sources[name] = source
+            self._sources.move_to_end(name)
+            while len(self._sources) > self.max_size:
+                self._sources.popitem(last=False)
+        return self._render(name, None, context or {})
+
+    def clear(self):
+        """
+        Drops all compiled templates and rendered output
+        """
+        with self._lock:
+            self._sources.clear()
+            self._rendered.clear()
+        self.environment.cache.clear()
+
+
+TEMPLATES = TemplateCache()
@@ -0,0 +1,320 @@
+# Copyright 2018 Capital One Services, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Deterministic zip archives that are rebuilt incrementally from a content hash manifest """
+
+import filecmp
+import hashlib
+import json
+import logging
+import os
+import struct
+import tempfile
+import threading
+import zlib
+
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from pcf.util import pcf_util
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 1
+
+# same layouts as the zipfile module
+LOCAL_HEADER = struct.Struct("<4s2B4HL2L2H")
+CENTRAL_HEADER = struct.Struct("<4s4B4HL2L5H2L")
+END_RECORD = struct.Struct("<4s4H2LH")
+LOCAL_SIGNATURE = b"PK\003\004"
+CENTRAL_SIGNATURE = b"PK\001\002"
+END_SIGNATURE = b"PK\005\006"
+
+ZIP_VERSION = 20
+UNIX_SYSTEM = 3
+ZIP_DEFLATED = 8
+UTF8_FLAG = 0x800
+# every entry is dated 1980-01-01 00:00:00, the earliest date a zip can hold
+ZIP_TIME = 0
+ZIP_DATE = (1 << 5) | 1
+MAX_SIZE = 0xFFFFFFFF
+
+
+def _deflate(path, level, out):
+    """
+    Streams a file through sha256, crc32 and raw deflate into out
+
+    Returns:
+        (sha256 hex digest, crc32, file size, compressed size)
+    """
+    sha256 = hashlib.sha256()
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    crc = 0
+    size = 0
+    compress_size = 0
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(pcf_util.HASH_CHUNK_SIZE), b""):
+            sha256.update(chunk)
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            compress_size += out.write(compressor.compress(chunk))
+    compress_size += out.write(compressor.flush())
+    return sha256.hexdigest(), crc, size, compress_size
+
+
+def _compress_file(path, level, spool_dir):
+    """
+    Deflates a file into a spool file that the zip is then copied from. Runs in worker processes.
+
+    Returns:
+        (sha256 hex digest, crc32, file size, compressed size, spool file path)
+    """
+    fd, spool_path = tempfile.mkstemp(dir=spool_dir)
+    with os.fdopen(fd, "wb") as spool:
+        return _deflate(path, level, spool) + (spool_path,)
+
+
+def _copy(source, out, length):
+    """
+    Copies length bytes from the current position of source to out in chunks
+    """
+    while length:
+        chunk = source.read(min(length, pcf_util.HASH_CHUNK_SIZE))
+        if not chunk:
+            raise ValueError("Unexpected end of {}".format(source.name))
+        out.write(chunk)
+        length -= len(chunk)
+
+
+def _local_header(crc, compress_size, size, flags, name):
+    return LOCAL_HEADER.pack(LOCAL_SIGNATURE, ZIP_VERSION, 0, flags, ZIP_DEFLATED, ZIP_TIME, ZIP_DATE, crc,
+                             compress_size, size, len(name), 0) + name
+
+
+def _check_size(arcname, size, compress_size, offset):
+    if size > MAX_SIZE or compress_size > MAX_SIZE or offset > MAX_SIZE:
+        raise ValueError("{} is too large for a zip without zip64 extensions".format(arcname))
+
+
+def _arcname(path):
+    # same normalization as zipfile.ZipInfo.from_file
+    arcname = os.path.normpath(os.path.splitdrive(path)[1])
+    while arcname[0] in (os.sep, os.altsep):
+        arcname = arcname[1:]
+    return arcname.replace(os.sep, "/")
+
+
+class ZipBuilder(object):
+    """
+    Builds a zip whose bytes only depend on the names, contents and executable bits of its files. Entries are sorted
+    by name and carry fixed timestamps, so an unchanged set of files gives a byte identical archive and the same
+    CodeSha256. A manifest next to the zip records the size, mtime and sha256 of every file and where its compressed
+    entry is in the zip. The next build only hashes files whose size or mtime changed and copies the compressed
+    entries of files with unchanged contents from the previous zip. Everything else is compressed, across processes
+    when there is enough of it.
+    """
+
+    def __init__(self, zip_path, manifest_path=None, compression_level=6, max_workers=None,
+                 parallel_threshold=8 * 1024 * 1024):
+        """
+        Args:
+            zip_path (str): path of the zip
+            manifest_path (str): path of the manifest, defaults to <zip_path>.manifest.json
+            compression_level (int): zlib compression level
+            max_workers (int): processes compressing files, defaults to the number of cpus. 1 compresses inline
+            parallel_threshold (int): bytes to compress before worker processes are used
+        """
+        self.zip_path = zip_path
+        self.manifest_path = manifest_path or zip_path + ".manifest.json"
+        self.compression_level = compression_level
+        self.max_workers = max_workers
+        self.parallel_threshold = parallel_threshold
+        self.files = {}
+        self.reused = 0
+        self.compressed = 0
+
+    def add(self, path, arcname=None):
+        """
+        Adds a file, or every file below a directory
+
+        Args:
+            path (str): file or directory
+            arcname (str): name in the zip, defaults to the normalized path
+        """
+        arcname = _arcname(arcname or path)
+        if not os.path.isdir(path):
+            self.files.setdefault(arcname, path)
+            return
+        for root, dirs, files in os.walk(path):
+            for file in files:
+                filepath = os.path.join(root, file)
+                self.add(filepath, os.path.join(arcname, os.path.relpath(filepath, path)))
+
+    def _load_manifest(self):
+        """
+        Returns:
+            entries of the previous build, empty when the zip was changed or removed since
+        """
+        try:
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+            zip_stat = os.stat(self.zip_path)
+        except (OSError, ValueError):
+            return {}
+        if manifest.get("version") != MANIFEST_VERSION or manifest.get("level") != self.compression_level or \
+                manifest.get("zip") != [zip_stat.st_size, zip_stat.st_mtime_ns]:
+            return {}
+        return manifest.get("entries", {})
+
+    def _write_manifest(self, entries):
+        zip_stat = os.stat(self.zip_path)
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "level": self.compression_level,
+            "zip": [zip_stat.st_size, zip_stat.st_mtime_ns],
+            "entries": entries,
+        }
+        with open(self.manifest_path, "w") as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+
+    def _plan(self, previous):
+        """
+        Returns:
+            (entries, files to compress). Reused entries keep the offset of their data in the previous zip.
+        """
+        entries = {}
+        to_compress = []
+        for arcname, path in sorted(self.files.items()):
+            stat = os.stat(path)
+            entry = {
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "mode": 0o755 if stat.st_mode & 0o111 else 0o644,
+            }
+            old = previous.get(arcname)
+            if old is not None:
+                unchanged = old["size"] == stat.st_size and old["mtime_ns"] == stat.st_mtime_ns
+                if unchanged or (old["size"] == stat.st_size and pcf_util.file_sha256(path) == old["sha256"]):
+                    entry.update({key: old[key] for key in ("sha256", "crc", "compress_size", "offset")})
+                    entries[arcname] = entry
+                    continue
+            entries[arcname] = entry
+            to_compress.append(arcname)
+        return entries, to_compress
+
+    def _compress(self, arcnames, spool_dir):
+        """
+        Compresses the files across processes when there is enough to compress. Other files are compressed straight
+        into the zip while it is written, see _write.
+
+        Returns:
+            dict of arcname to (sha256, crc32, size, compressed size, spool file path)
+        """
+        paths = [self.files[arcname] for arcname in arcnames]
+        total = sum(os.path.getsize(path) for path in paths)
+        if self.max_workers == 1 or len(paths) < 2 or total < self.parallel_threshold:
+            return {}
+        with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+            results = list(executor.map(_compress_file, paths, repeat(self.compression_level), repeat(spool_dir),
+                                        chunksize=16))
+        return dict(zip(arcnames, results))
+
+    @staticmethod
+    def _copy_entry(previous_zip, offset, compress_size, out):
+        previous_zip.seek(offset)
+        header = LOCAL_HEADER.unpack(previous_zip.read(LOCAL_HEADER.size))
+        if header[0] != LOCAL_SIGNATURE:
+            raise ValueError("No zip entry at offset {}".format(offset))
+        previous_zip.seek(header[10] + header[11], os.SEEK_CUR)
+        _copy(previous_zip, out, compress_size)
+
+    def _write(self, out, entries, to_compress, compressed, previous_zip):
+        """
+        Writes the entries in order. Compressed data is never held in memory: spooled and reused entries are copied
+        in chunks, and other files are deflated into out behind a header that is filled in once their crc and sizes
+        are known.
+        """
+        central_directory = []
+        to_compress = set(to_compress)
+        for arcname, entry in sorted(entries.items()):
+            name = arcname.encode("utf-8")
+            flags = UTF8_FLAG if name != arcname.encode("ascii", "ignore") else 0
+            # reused entries still hold the offset of their data in the previous zip
+            previous_offset = entry.get("offset")
+            entry["offset"] = out.tell()
+            if arcname in compressed:
+                entry["sha256"], entry["crc"], size, entry["compress_size"], spool_path = compressed[arcname]
+                _check_size(arcname, size, entry["compress_size"], entry["offset"])
+                out.write(_local_header(entry["crc"], entry["compress_size"], size, flags, name))
+                with open(spool_path, "rb") as spool:
+                    _copy(spool, out, entry["compress_size"])
+                os.remove(spool_path)
+            elif arcname in to_compress:
+                out.write(_local_header(0, 0, 0, flags, name))
+                entry["sha256"], entry["crc"], size, entry["compress_size"] = _deflate(
+                    self.files[arcname], self.compression_level, out)
+                _check_size(arcname, size, entry["compress_size"], entry["offset"])
+                end = out.tell()
+                out.seek(entry["offset"])
+                out.write(_local_header(entry["crc"], entry["compress_size"], size, flags, name))
+                out.seek(end)
+            else:
+                size = entry["size"]
+                _check_size(arcname, size, entry["compress_size"], entry["offset"])
+                out.write(_local_header(entry["crc"], entry["compress_size"], size, flags, name))
+                self._copy_entry(previous_zip, previous_offset, entry["compress_size"], out)
+            central_directory.append(CENTRAL_HEADER.pack(
+                CENTRAL_SIGNATURE, ZIP_VERSION, UNIX_SYSTEM, ZIP_VERSION, 0, flags, ZIP_DEFLATED, ZIP_TIME, ZIP_DATE,
+                entry["crc"], entry["compress_size"], size, len(name), 0, 0, 0, 0, (0o100000 | entry["mode"]) << 16,
+                entry["offset"]) + name)
+
+        directory_offset = out.tell()
+        for header in central_directory:
+            out.write(header)
+        out.write(END_RECORD.pack(END_SIGNATURE, 0, 0, len(central_directory), len(central_directory),
+                                  out.tell() - directory_offset, directory_offset, 0))
+
+    def build(self):
+        """
+        Writes the zip and its manifest. The zip is left untouched when its bytes did not change.
+
+        Returns:
+            True if the zip was written, False if it was already up to date
+        """
+        previous = self._load_manifest()
+        entries, to_compress = self._plan(previous)
+        self.compressed = len(to_compress)
+        self.reused = len(entries) - len(to_compress)
+
+        # not mkstemp, the zip keeps the default permissions
+        tmp_path = "{0}.{1}.{2}.tmp".format(self.zip_path, os.getpid(), threading.get_ident())
+        try:
+            with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(self.zip_path))) as spool_dir:
+                compressed = self._compress(to_compress, spool_dir)
+                with open(tmp_path, "wb") as out:
+                    if self.reused:
+                        with open(self.zip_path, "rb") as previous_zip:
+                            self._write(out, entries, to_compress, compressed, previous_zip)
+                    else:
+                        self._write(out, entries, to_compress, compressed, None)
+            changed = not (os.path.exists(self.zip_path) and filecmp.cmp(tmp_path, self.zip_path, shallow=False))
+            if changed:
+                os.replace(tmp_path, self.zip_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        self._write_manifest(entries)
+        logger.debug("Built {0}: reused {1} and compressed {2} entries, {3}".format(
+            self.zip_path, self.reused, self.compressed, "changed" if changed else "unchanged"))
+        return changed